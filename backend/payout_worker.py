@@ -0,0 +1,347 @@
+"""
+Weekly profit payouts: applying claimed payouts and paying one shard of a
+distribution run, plus the transaction and ledger helpers they share with
+server.py. Shard worker processes import only this module, so it must not
+import server.py (its Mongo client, scheduler registrations and config).
+"""
+import asyncio
+import logging
+import os
+import random
+import secrets
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import Any, Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# ==================== DB TRANSACTIONS ====================
+
+# Same retry budget as the driver's own with_transaction helper
+TRANSACTION_RETRY_SECONDS = 120
+transactions_supported: Optional[bool] = None  # unknown until the first attempt
+
+async def _abort_quietly(session):
+    if session.in_transaction:
+        try:
+            await session.abort_transaction()
+        except PyMongoError:
+            pass
+
+async def _transaction_backoff(attempt: int):
+    # Jittered so transactions that conflicted on the same document spread out
+    await asyncio.sleep(random.uniform(0, min(0.5, 0.005 * 2 ** attempt)))
+
+async def run_in_transaction(callback, mongo_client):
+    """
+    Run callback(session) as one multi-document transaction. The callback is
+    retried on TransientTransactionError (e.g. a write conflict) and the
+    commit on UnknownTransactionCommitResult. A standalone server (no
+    replica set) cannot run transactions, so there callback(None) runs
+    without one.
+    """
+    global transactions_supported
+    if transactions_supported is False:
+        return await callback(None)
+    
+    deadline = time.monotonic() + TRANSACTION_RETRY_SECONDS
+    async with await mongo_client.start_session() as session:
+        attempt = 0
+        while True:
+            attempt += 1
+            session.start_transaction()
+            try:
+                result = await callback(session)
+            except PyMongoError as e:
+                await _abort_quietly(session)
+                if isinstance(e, OperationFailure) and e.code == 20 and "Transaction numbers" in str(e):
+                    transactions_supported = False
+                    logger.warning("MongoDB is standalone, running without multi-document transactions")
+                    return await callback(None)
+                if e.has_error_label("TransientTransactionError") and time.monotonic() < deadline:
+                    await _transaction_backoff(attempt)
+                    continue
+                raise
+            except BaseException:
+                await _abort_quietly(session)
+                raise
+            
+            while True:
+                try:
+                    await session.commit_transaction()
+                    transactions_supported = True
+                    return result
+                except PyMongoError as e:
+                    if e.has_error_label("UnknownTransactionCommitResult") and time.monotonic() < deadline:
+                        continue
+                    if e.has_error_label("TransientTransactionError") and time.monotonic() < deadline:
+                        break  # retry the whole transaction
+                    raise
+            await _transaction_backoff(attempt)
+
+# ==================== WALLET LEDGER ENTRIES ====================
+
+# seq is microseconds since the epoch * 1000 plus a per-process salt, so
+# entries written by separate workers still sort by time and never collide
+LEDGER_SEQ_SALT = secrets.randbelow(1000)
+_last_ledger_seq = 0
+
+def next_ledger_seq() -> int:
+    global _last_ledger_seq
+    seq = max(time.time_ns() // 1000 * 1000 + LEDGER_SEQ_SALT, _last_ledger_seq + 1000)
+    _last_ledger_seq = seq
+    return seq
+
+def ledger_entry(user_id: str, amount: float, kind: str, description: str = "",
+                 ref: Optional[str] = None, balance_after: Optional[float] = None,
+                 status: str = "applied") -> Dict[str, Any]:
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "seq": next_ledger_seq(),
+        "amount": amount,
+        "type": kind,  # commission, binary, deposit, profit, weekly_profit, withdrawal, withdrawal_hold, withdrawal_release, withdrawal_refund
+        "description": description,
+        "ref": ref,  # transaction / payout id; (ref, type) is unique
+        "balance_after": balance_after,
+        "status": status,  # pending, applied; entries written before this field are applied
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+
+# An entry with a ref is inserted "pending" before the balance moves. The
+# balance update pushes the entry id onto the user's ledger_applied_ids in the
+# same write and only matches while the id is absent, so re-driving a pending
+# entry after a crash cannot move the balance twice. The entry is then marked
+# applied and its id pulled from the user again.
+LEDGER_APPLIED_IDS = "ledger_applied_ids"
+
+def unapplied_entry_filter(entry: Dict[str, Any]) -> Dict[str, Any]:
+    return {"id": entry["user_id"], LEDGER_APPLIED_IDS: {"$ne": entry["id"]}}
+
+def applied_entry_update(entry: Dict[str, Any], inc: Dict[str, Any]) -> Dict[str, Any]:
+    return {"$inc": inc, "$push": {LEDGER_APPLIED_IDS: entry["id"]}}
+
+async def settle_ledger_entries(database, entries: List[Dict[str, Any]], session=None):
+    """Mark entries whose balance update has landed as applied and drop their markers"""
+    if not entries:
+        return
+    await database.wallet_ledger.update_many(
+        {"id": {"$in": [entry["id"] for entry in entries]}},
+        {"$set": {"status": "applied"}},
+        session=session
+    )
+    await database.users.bulk_write([UpdateOne(
+        {"id": entry["user_id"]},
+        {"$pull": {LEDGER_APPLIED_IDS: entry["id"]}}
+    ) for entry in entries], ordered=False, session=session)
+
+# ==================== WEEKLY PAYOUTS ====================
+
+WEEKLY_PROFIT_RATE = 0.05
+DISTRIBUTION_CHUNK_SIZE = 1000
+
+def calculate_weekly_profit(amount):
+    """Weekly profit for an investment amount (float or NumPy array)"""
+    return amount * WEEKLY_PROFIT_RATE
+
+DISTRIBUTION_LEASE_SECONDS = 120
+
+def weekly_profit_transaction(payout: Dict[str, Any]) -> Dict[str, Any]:
+    """Transaction document for a payout, in the shape of server.Transaction"""
+    return {
+        "id": payout["id"],
+        "user_id": payout["user_id"],
+        "type": "weekly_profit",
+        "amount": payout["amount"],
+        "crypto_type": None,
+        "status": "completed",
+        "description": f"Weekly 5% profit on {payout['package']} package",
+        "wallet_address": None,
+        "tx_hash": None,
+        "created_at": payout["created_at"],
+        "updated_at": None
+    }
+
+async def insert_many_skip_duplicates(collection, documents: List[Dict[str, Any]], session=None) -> List[int]:
+    """insert_many that tolerates already-present documents; returns the duplicate indexes"""
+    if not documents:
+        return []
+    try:
+        await collection.insert_many(documents, ordered=False, session=session)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(err.get("code") != 11000 for err in errors):
+            raise
+        return [err["index"] for err in errors]
+    return []
+
+async def apply_payouts(database, payouts: List[Dict[str, Any]], session=None):
+    """
+    Apply claimed payouts. The wallet ledger's unique (ref, type) key is the
+    idempotency key: each payout gets one ledger entry, and the balance moves
+    only through that entry (see LEDGER_APPLIED_IDS), so re-applying a chunk
+    after a crash finishes half-applied payouts without paying anyone twice.
+    """
+    if not payouts:
+        return
+    
+    existing = {doc["ref"]: doc for doc in await database.wallet_ledger.find(
+        {"type": "weekly_profit", "ref": {"$in": [payout["id"] for payout in payouts]}},
+        {"_id": 0, "id": 1, "ref": 1, "user_id": 1, "status": 1},
+        session=session
+    ).to_list(None)}
+    new_payouts = [payout for payout in payouts if payout["id"] not in existing]
+    
+    ledger = [
+        ledger_entry(payout["user_id"], payout["amount"], "weekly_profit",
+                     weekly_profit_transaction(payout)["description"], ref=payout["id"], status="pending")
+        for payout in new_payouts
+    ]
+    # Without a transaction a concurrent writer could slip in between the
+    # lookup and the insert; the unique index still rejects its entries
+    duplicates = set(await insert_many_skip_duplicates(database.wallet_ledger, ledger, session=session))
+    entries = {entry["ref"]: entry for index, entry in enumerate(ledger) if index not in duplicates}
+    # Pending entries left by an interrupted attempt are driven to completion
+    entries.update({ref: doc for ref, doc in existing.items() if doc.get("status") == "pending"})
+    payouts_to_apply = [payout for payout in payouts if payout["id"] in entries]
+    
+    if payouts_to_apply:
+        await database.users.bulk_write([UpdateOne(
+            unapplied_entry_filter(entries[payout["id"]]),
+            applied_entry_update(entries[payout["id"]], {"weekly_earnings": payout["amount"], "wallet_balance": payout["amount"]})
+        ) for payout in payouts_to_apply], ordered=False, session=session)
+        await database.investments.bulk_write([UpdateOne(
+            {"id": payout["investment_id"], "last_payout_id": {"$ne": payout["id"]}},
+            {
+                "$set": {"last_profit_date": payout["created_at"], "last_payout_id": payout["id"]},
+                "$inc": {"total_earnings": payout["amount"]}
+            }
+        ) for payout in payouts_to_apply], ordered=False, session=session)
+        await insert_many_skip_duplicates(
+            database.transactions, [weekly_profit_transaction(payout) for payout in payouts_to_apply], session=session
+        )
+        await settle_ledger_entries(database, list(entries.values()), session=session)
+    
+    await database.distribution_payouts.update_many(
+        {"id": {"$in": [payout["id"] for payout in payouts]}},
+        {"$set": {"status": "applied"}},
+        session=session
+    )
+
+async def apply_weekly_profit_chunk(database, run_id: str, investments: List[Dict[str, Any]], session=None):
+    """Claim then pay one chunk; investments already paid in this run are skipped"""
+    now = datetime.now(timezone.utc).isoformat()
+    already_claimed = {doc["investment_id"] for doc in await database.distribution_payouts.find(
+        {"run_id": run_id, "investment_id": {"$in": [inv["id"] for inv in investments]}},
+        {"_id": 0, "investment_id": 1},
+        session=session
+    ).to_list(None)}
+    payouts = [{
+        "id": str(uuid.uuid4()),
+        "run_id": run_id,
+        "investment_id": inv["id"],
+        "user_id": inv["user_id"],
+        "package": inv["package"],
+        "amount": calculate_weekly_profit(inv["amount"]),
+        "status": "claimed",  # claimed, applied
+        "created_at": now
+    } for inv in investments if inv["id"] not in already_claimed]
+    
+    # The unique (run_id, investment_id) index is the claim: only payouts
+    # inserted here are applied, so an investment is paid once per run
+    duplicates = set(await insert_many_skip_duplicates(database.distribution_payouts, payouts, session=session))
+    payouts = [payout for index, payout in enumerate(payouts) if index not in duplicates]
+    
+    await apply_payouts(database, payouts, session=session)
+    return len(payouts), sum(payout["amount"] for payout in payouts)
+
+async def hold_distribution_lease(database, run_id: str, owner: str, session=None):
+    """Extend the run's lease, or raise if another worker has taken it over"""
+    now = datetime.now(timezone.utc)
+    held = await database.distribution_runs.find_one_and_update(
+        {"id": run_id, "lease_owner": owner, "lease_expires_at": {"$gt": now.isoformat()}},
+        {"$set": {"lease_expires_at": (now + timedelta(seconds=DISTRIBUTION_LEASE_SECONDS)).isoformat()}},
+        projection={"_id": 0, "id": 1},
+        session=session
+    )
+    if not held:
+        raise RuntimeError(f"Distribution run {run_id} lost its lease")
+
+async def distribute_shard(database, run_id: str, shard: str, owner: str) -> Dict[str, Any]:
+    """
+    Pay one hash range of users. Active investments in the range are streamed in
+    (user_shard, id) order, the order of the investments index, in fixed-size
+    chunks. The shard checkpoints the last paid [user_shard, id], so a
+    re-invoked run continues where the previous attempt stopped.
+    """
+    run = await database.distribution_runs.find_one({"id": run_id}, {"_id": 0, "shard_count": 1, f"shards.{shard}": 1})
+    state = run["shards"][shard]
+    if state["status"] == "completed":
+        return state
+    
+    query: Dict[str, Any] = {"is_active": True}
+    if run["shard_count"] > 1:
+        low, high = state["range"]
+        query["user_shard"] = {"$gte": low, "$lt": high}
+    # An id-only checkpoint predates the (user_shard, id) order; the shard then
+    # starts over and the run's payout claims skip investments already paid
+    if isinstance(state["checkpoint"], list):
+        last_shard, last_id = state["checkpoint"]
+        query["$or"] = [{"user_shard": {"$gt": last_shard}}, {"user_shard": last_shard, "id": {"$gt": last_id}}]
+    cursor = database.investments.find(
+        query,
+        {"_id": 0, "id": 1, "user_id": 1, "user_shard": 1, "package": 1, "amount": 1}
+    ).sort([("user_shard", 1), ("id", 1)]).batch_size(DISTRIBUTION_CHUNK_SIZE)
+    
+    async def commit_chunk(chunk: List[Dict[str, Any]]):
+        # Payouts, balances and the checkpoint commit together, and only
+        # while this worker still holds the run's lease
+        async def commit(session):
+            await hold_distribution_lease(database, run_id, owner, session)
+            count, amount = await apply_weekly_profit_chunk(database, run_id, chunk, session)
+            await database.distribution_runs.update_one(
+                {"id": run_id},
+                {
+                    "$set": {f"shards.{shard}.checkpoint": [chunk[-1]["user_shard"], chunk[-1]["id"]], f"shards.{shard}.status": "running"},
+                    "$inc": {
+                        f"shards.{shard}.processed": count,
+                        f"shards.{shard}.total_amount": amount,
+                        "processed": count,
+                        "total_amount": amount
+                    }
+                },
+                session=session
+            )
+        
+        await run_in_transaction(commit, database.client)
+    
+    chunk: List[Dict[str, Any]] = []
+    async for inv in cursor:
+        chunk.append(inv)
+        if len(chunk) >= DISTRIBUTION_CHUNK_SIZE:
+            await commit_chunk(chunk)
+            chunk = []
+    if chunk:
+        await commit_chunk(chunk)
+    
+    await database.distribution_runs.update_one(
+        {"id": run_id},
+        {"$set": {f"shards.{shard}.status": "completed"}}
+    )
+    return state
+
+async def _distribution_shard_main(run_id: str, shard: str, owner: str):
+    shard_client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    try:
+        await distribute_shard(shard_client[os.environ['DB_NAME']], run_id, shard, owner)
+    finally:
+        shard_client.close()
+
+def run_distribution_shard_process(run_id: str, shard: str, owner: str):
+    """Entry point of a pool worker process; it talks to Mongo through its own client"""
+    asyncio.run(_distribution_shard_main(run_id, shard, owner))
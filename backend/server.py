@@ -1,5 +1,6 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Response, Request, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -7,16 +8,40 @@ import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, get_args
 import uuid
+import json
+import csv
+import io
+import socket
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone, timedelta
 import httpx
 import secrets
 import jwt
 import hashlib
 import smtplib
+import asyncio
+import base64
+import functools
+import time
+import re
+from html import escape as html_escape
+import numpy as np
+import pandas as pd
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+import payout_worker
+from payout_worker import (
+    DISTRIBUTION_CHUNK_SIZE, DISTRIBUTION_LEASE_SECONDS, LEDGER_APPLIED_IDS, apply_payouts,
+    applied_entry_update, calculate_weekly_profit, distribute_shard, insert_many_skip_duplicates,
+    ledger_entry, next_ledger_seq, run_distribution_shard_process, unapplied_entry_filter
+)
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.header import Header
+from email.utils import formatdate, make_msgid
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -32,6 +57,13 @@ api_router = APIRouter(prefix="/api")
 
 # ==================== MODELS ====================
 
+def normalize_search(text: str) -> str:
+    return text.strip().lower()
+
+def normalize_referral_code(code: str) -> str:
+    """Referral codes are matched case-insensitively, ignoring surrounding spaces"""
+    return code.strip().lower()
+
 class User(BaseModel):
     model_config = ConfigDict(extra="ignore", populate_by_name=True)
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -61,6 +93,8 @@ class User(BaseModel):
     career_points: float = 0.0
     career_rewards: float = 0.0
     wallet_balance: float = 0.0
+    held_balance: float = 0.0  # reserved by pending withdrawal requests
+    ledger_opened: bool = True  # new accounts start with an empty wallet ledger
     is_admin: bool = False
     is_super_admin: bool = False
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
@@ -73,6 +107,15 @@ class User(BaseModel):
     password_change_token: Optional[str] = None
     password_change_token_expires: Optional[str] = None
     new_password_hash: Optional[str] = None
+    # Lowercase copies backing the indexed admin prefix search
+    name_lower: Optional[str] = None
+    email_lower: Optional[str] = None
+
+    def model_post_init(self, __context: Any):
+        if self.name_lower is None:
+            self.name_lower = normalize_search(self.name)
+        if self.email_lower is None:
+            self.email_lower = normalize_search(self.email)
 
 
 class ReferralCode(BaseModel):
@@ -86,6 +129,12 @@ class ReferralCode(BaseModel):
     is_used: bool = False
     used_by: Optional[str] = None
     used_at: Optional[str] = None
+    # Unique lookup key for the code
+    code_normalized: Optional[str] = None
+
+    def model_post_init(self, __context: Any):
+        if self.code_normalized is None:
+            self.code_normalized = normalize_referral_code(self.code)
 
 class UserSession(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -94,10 +143,17 @@ class UserSession(BaseModel):
     expires_at: datetime
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+# Users are split into hash ranges of user_id for sharded batch jobs
+SHARD_SPACE = 4096
+
+def user_shard(user_id: str) -> int:
+    return int.from_bytes(hashlib.md5(user_id.encode()).digest()[:4], "big") % SHARD_SPACE
+
 class Investment(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
+    user_shard: Optional[int] = None
     package: str
     amount: float
     investment_date: str
@@ -106,6 +162,10 @@ class Investment(BaseModel):
     is_active: bool = True
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
+    def model_post_init(self, __context: Any):
+        if self.user_shard is None:
+            self.user_shard = user_shard(self.user_id)
+
 
 class InvestmentRequest(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -120,6 +180,7 @@ class InvestmentRequest(BaseModel):
     amount: float
     status: str = "pending"  # pending, approved, rejected
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: Optional[str] = None  # set on every status change
 
 
 class WithdrawalRequest(BaseModel):
@@ -129,8 +190,12 @@ class WithdrawalRequest(BaseModel):
     full_name: str
     iban: str
     amount: float
-    status: str = "pending"  # pending, approved, rejected
+    status: str = "pending"  # pending, processing, approved, rejected
+    funds_held: bool = False  # amount moved to held_balance when requested
+    transaction_id: Optional[str] = None
+    processing_at: Optional[str] = None  # when an approval claimed it
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: Optional[str] = None  # set on every status change
 
 
 class Transaction(BaseModel):
@@ -145,6 +210,7 @@ class Transaction(BaseModel):
     wallet_address: Optional[str] = None
     tx_hash: Optional[str] = None
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: Optional[str] = None  # set when an admin approves or rejects it
 
 class PackageInfo(BaseModel):
     name: str
@@ -252,6 +318,17 @@ async def require_super_admin(request: Request) -> User:
         raise HTTPException(status_code=403, detail="Super admin access required")
     return user
 
+async def fetch_users_by_id(user_ids, fields=("name", "email")) -> Dict[str, Dict[str, Any]]:
+    """Look up many users with one $in query, keyed by id"""
+    ids = list({user_id for user_id in user_ids if user_id})
+    if not ids:
+        return {}
+    docs = await db.users.find(
+        {"id": {"$in": ids}},
+        {"_id": 0, "id": 1, **{field: 1 for field in fields}}
+    ).to_list(None)
+    return {doc["id"]: doc for doc in docs}
+
 class InvestmentRequestCreate(BaseModel):
     full_name: str
     username: str
@@ -266,6 +343,9 @@ class WithdrawalRequestCreate(BaseModel):
     iban: str
     amount: float
 
+class WithdrawalBulkApprove(BaseModel):
+    request_ids: List[str]
+
 
 # ==================== JWT AUTH CONFIG ====================
 
@@ -286,28 +366,11 @@ class RegisterRequest(BaseModel):
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
 
-async def send_welcome_email(user_email: str, user_name: str):
-    """Send welcome email to new users via SMTP"""
-    try:
-        # SMTP configuration from environment variables
-        smtp_host = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
-        smtp_port = int(os.environ.get('SMTP_PORT', '587'))
-        smtp_email = os.environ.get('SMTP_EMAIL', '')
-        smtp_password = os.environ.get('SMTP_PASSWORD', '')
-        
-        # Skip if SMTP not configured
-        if not smtp_email or not smtp_password:
-            logger.warning("SMTP not configured. Skipping welcome email.")
-            return False
-        
-        # Create message
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = "🚀 Parlacapital ile Network Marketing'de Büyük Kazançlar Sizi Bekliyor!"
-        msg['From'] = f"Parlacapital <{smtp_email}>"
-        msg['To'] = user_email
-        
-        # Email body
-        text = f"""
+# ==================== EMAIL TEMPLATES ====================
+
+WELCOME_EMAIL_SUBJECT = "🚀 Parlacapital ile Network Marketing'de Büyük Kazançlar Sizi Bekliyor!"
+
+WELCOME_EMAIL_TEXT = """
 Merhaba {user_name},
 
 Parlacapital ailesine hoş geldiniz! 🎉 Şimdi network marketing dünyasında inanılmaz fırsatlar kapınızı çalıyor! 💥
@@ -325,8 +388,8 @@ Bugün attığınız küçük bir adım, yarın büyük bir fark yaratabilir.
 Başarı ve bolluk dileklerimizle,
 ✨ Parlacapital Ekibi
         """
-        
-        html = f"""
+
+WELCOME_EMAIL_HTML = """
         <html>
           <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto;">
             <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 30px; text-align: center;">
@@ -373,49 +436,10 @@ Başarı ve bolluk dileklerimizle,
           </body>
         </html>
         """
-        
-        part1 = MIMEText(text, 'plain', 'utf-8')
-        part2 = MIMEText(html, 'html', 'utf-8')
-        msg.attach(part1)
-        msg.attach(part2)
-        
-        # Send email with SSL
-        with smtplib.SMTP_SSL(smtp_host, smtp_port) as server:
-            server.login(smtp_email, smtp_password)
-            server.send_message(msg)
-        
-        logger.info(f"Welcome email sent to {user_email}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Failed to send welcome email to {user_email}: {str(e)}")
-        return False
 
-async def send_verification_email(user_email: str, user_name: str, verification_token: str):
-    """Send email verification link to new users"""
-    try:
-        smtp_host = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
-        smtp_port = int(os.environ.get('SMTP_PORT', '587'))
-        smtp_email = os.environ.get('SMTP_EMAIL', '')
-        smtp_password = os.environ.get('SMTP_PASSWORD', '')
-        
-        if not smtp_email or not smtp_password:
-            logger.warning("SMTP not configured. Skipping verification email.")
-            return False
-        
-        # Get frontend URL from environment
-        frontend_url = os.environ.get('FRONTEND_URL', 'https://user-access-restored.preview.emergentagent.com')
-        verification_link = f"{frontend_url}/verify-email?token={verification_token}"
-        with open("/tmp/email_debug.log", "a") as f:
-            f.write(f"🔗 VERIFICATION LINK: {verification_link}\n")
-        logger.info(f"Generated verification link: {verification_link}")
-        
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = "✅ Email Adresinizi Doğrulayın - Parlacapital"
-        msg['From'] = f"Parlacapital <{smtp_email}>"
-        msg['To'] = user_email
-        
-        text = f"""
+VERIFICATION_EMAIL_SUBJECT = "✅ Email Adresinizi Doğrulayın - Parlacapital"
+
+VERIFICATION_EMAIL_TEXT = """
 Merhaba {user_name},
 
 Parlacapital'e hoş geldiniz! 🎉
@@ -430,8 +454,8 @@ Email adresinizi doğruladıktan sonra hesabınıza giriş yapabilir ve yatırı
 Saygılarımızla,
 Parlacapital Ekibi
         """
-        
-        html = f"""
+
+VERIFICATION_EMAIL_HTML = """
         <html>
           <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto;">
             <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 30px; text-align: center;">
@@ -475,44 +499,10 @@ Parlacapital Ekibi
           </body>
         </html>
         """
-        
-        part1 = MIMEText(text, 'plain', 'utf-8')
-        part2 = MIMEText(html, 'html', 'utf-8')
-        msg.attach(part1)
-        msg.attach(part2)
-        
-        with smtplib.SMTP_SSL(smtp_host, smtp_port) as server:
-            server.login(smtp_email, smtp_password)
-            server.send_message(msg)
-        
-        logger.info(f"Verification email sent to {user_email}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Failed to send verification email to {user_email}: {str(e)}")
-        return False
 
-async def send_password_change_email(user_email: str, user_name: str, password_change_token: str):
-    """Send password change confirmation email"""
-    try:
-        smtp_host = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
-        smtp_port = int(os.environ.get('SMTP_PORT', '587'))
-        smtp_email = os.environ.get('SMTP_EMAIL', '')
-        smtp_password = os.environ.get('SMTP_PASSWORD', '')
-        
-        if not smtp_email or not smtp_password:
-            logger.warning("SMTP not configured. Skipping password change email.")
-            return False
-        
-        frontend_url = os.environ.get('FRONTEND_URL', 'https://user-access-restored.preview.emergentagent.com')
-        confirmation_link = f"{frontend_url}/confirm-password-change?token={password_change_token}"
-        
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = "🔐 Şifre Değişikliği Onayı - Parlacapital"
-        msg['From'] = f"Parlacapital <{smtp_email}>"
-        msg['To'] = user_email
-        
-        text = f"""
+PASSWORD_CHANGE_EMAIL_SUBJECT = "🔐 Şifre Değişikliği Onayı - Parlacapital"
+
+PASSWORD_CHANGE_EMAIL_TEXT = """
 Merhaba {user_name},
 
 Hesabınız için şifre değişikliği talebinde bulundunuz.
@@ -527,8 +517,8 @@ Eğer bu talebi siz yapmadıysanız, bu emaili görmezden gelebilirsiniz. Şifre
 Saygılarımızla,
 Parlacapital Ekibi
         """
-        
-        html = f"""
+
+PASSWORD_CHANGE_EMAIL_HTML = """
         <html>
           <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto;">
             <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 30px; text-align: center;">
@@ -578,21 +568,550 @@ Parlacapital Ekibi
           </body>
         </html>
         """
+
+WEEKLY_PROFIT_EMAIL_SUBJECT = "💰 Haftalık Kar Payınız Hesabınıza Eklendi - Parlacapital"
+
+WEEKLY_PROFIT_EMAIL_TEXT = """
+Merhaba {user_name},
+
+Bu haftaki kar payınız olan ${amount} cüzdan bakiyenize eklendi. 🎉
+
+Güncel bakiyenizi ve kazanç geçmişinizi kontrol panelinizden görüntüleyebilirsiniz.
+
+Saygılarımızla,
+Parlacapital Ekibi
+        """
+
+WEEKLY_PROFIT_EMAIL_HTML = """
+        <html>
+          <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto;">
+            <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 30px; text-align: center;">
+              <h1 style="color: white; margin: 0;">Haftalık Kar Payınız Hazır 💰</h1>
+            </div>
+            <div style="padding: 30px; background: #f9f9f9;">
+              <h2 style="color: #667eea;">Merhaba {user_name},</h2>
+              
+              <p style="font-size: 16px;">
+                Bu haftaki kar payınız cüzdan bakiyenize eklendi. 🎉
+              </p>
+              
+              <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 20px; border-radius: 10px; text-align: center; margin: 30px 0;">
+                <p style="font-size: 24px; margin: 0; font-weight: bold;">
+                  ${amount}
+                </p>
+              </div>
+              
+              <p style="font-size: 16px;">
+                Güncel bakiyenizi ve kazanç geçmişinizi kontrol panelinizden görüntüleyebilirsiniz.
+              </p>
+              
+              <div style="text-align: center; margin-top: 40px; padding-top: 20px; border-top: 2px solid #e0e0e0;">
+                <p style="color: #667eea; font-size: 16px; margin: 0;">
+                  Saygılarımızla,<br/>
+                  <strong>✨ Parlacapital Ekibi</strong>
+                </p>
+              </div>
+            </div>
+          </body>
+        </html>
+        """
+
+class EmailTemplate:
+    """
+    Email compiled once at startup. Static text is split around {placeholders}
+    and pre-encoded as bytes, so rendering a message only encodes the values.
+    """
+    PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+    def __init__(self, subject: str, text: str, html: str):
+        self.boundary = f"=_parlacapital_{secrets.token_hex(16)}"
+        self.subject_header = Header(subject, 'utf-8').encode(linesep='\r\n').encode()
+        self.text_parts = self._compile(text)
+        self.html_parts = self._compile(html)
+        self.text_head = (
+            f"--{self.boundary}\r\n"
+            "Content-Type: text/plain; charset=\"utf-8\"\r\n"
+            "Content-Transfer-Encoding: 8bit\r\n\r\n"
+        ).encode()
+        self.html_head = (
+            f"\r\n--{self.boundary}\r\n"
+            "Content-Type: text/html; charset=\"utf-8\"\r\n"
+            "Content-Transfer-Encoding: 8bit\r\n\r\n"
+        ).encode()
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self.mime_headers = (
+            "MIME-Version: 1.0\r\n"
+            f"Content-Type: multipart/alternative; boundary=\"{self.boundary}\"\r\n\r\n"
+        ).encode()
+
+    @classmethod
+    def _compile(cls, source: str) -> List[Any]:
+        """Alternate pre-encoded static chunks (bytes) with placeholder names (str)"""
+        source = source.replace("\r\n", "\n").replace("\n", "\r\n")
+        parts: List[Any] = []
+        position = 0
+        for match in cls.PLACEHOLDER.finditer(source):
+            parts.append(source[position:match.start()].encode('utf-8'))
+            parts.append(match.group(1))
+            position = match.end()
+        parts.append(source[position:].encode('utf-8'))
+        return parts
+
+    @staticmethod
+    def _fill(parts: List[Any], values: Dict[str, bytes], out: List[bytes]):
+        for part in parts:
+            out.append(values[part] if part.__class__ is str else part)
+
+    def render(self, sender: bytes, to: str, context: Dict[str, Any]) -> bytes:
+        # Values are single-line; newlines would break the 8bit body and headers
+        text_values = {k: str(v).replace("\r", " ").replace("\n", " ").encode('utf-8') for k, v in context.items()}
+        html_values = {k: html_escape(v.decode('utf-8')).encode('utf-8') for k, v in text_values.items()}
+        out = [
+            sender,
+            b"To: ", to.encode('utf-8'), b"\r\n",
+            b"Subject: ", self.subject_header, b"\r\n",
+            b"Date: ", formatdate(usegmt=True).encode(), b"\r\n",
+            b"Message-ID: ", make_msgid(domain=EMAIL_MESSAGE_ID_DOMAIN).encode(), b"\r\n",
+            self.mime_headers,
+            self.text_head
+        ]
+        self._fill(self.text_parts, text_values, out)
+        out.append(self.html_head)
+        self._fill(self.html_parts, html_values, out)
+        out.append(self.tail)
+        return b"".join(out)
+
+# Computed once: make_msgid() would otherwise resolve the host FQDN for every message
+EMAIL_MESSAGE_ID_DOMAIN = os.environ.get('EMAIL_MESSAGE_ID_DOMAIN', 'parlacapital.com')
+
+EMAIL_TEMPLATES = {
+    "welcome": EmailTemplate(WELCOME_EMAIL_SUBJECT, WELCOME_EMAIL_TEXT, WELCOME_EMAIL_HTML),
+    "verification": EmailTemplate(VERIFICATION_EMAIL_SUBJECT, VERIFICATION_EMAIL_TEXT, VERIFICATION_EMAIL_HTML),
+    "password_change": EmailTemplate(PASSWORD_CHANGE_EMAIL_SUBJECT, PASSWORD_CHANGE_EMAIL_TEXT, PASSWORD_CHANGE_EMAIL_HTML),
+    "weekly_profit": EmailTemplate(WEEKLY_PROFIT_EMAIL_SUBJECT, WEEKLY_PROFIT_EMAIL_TEXT, WEEKLY_PROFIT_EMAIL_HTML)
+}
+
+def sender_header(sender_email: str) -> bytes:
+    return f"From: Parlacapital <{sender_email}>\r\n".encode('utf-8')
+
+# ==================== EMAIL OUTBOX ====================
+
+# Emails are persisted in db.email_outbox and delivered by background workers,
+# so a slow SMTP server never blocks the request that triggered the email.
+EMAIL_OUTBOX_WORKERS = int(os.environ.get('EMAIL_OUTBOX_WORKERS', '2'))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', '6'))
+EMAIL_RETRY_BASE_SECONDS = 30  # 30s, 1m, 2m, 4m, 8m ...
+EMAIL_POLL_INTERVAL_SECONDS = 5
+EMAIL_SENDING_TIMEOUT_SECONDS = 300  # reclaim messages left in "sending" by a crashed worker
+EMAIL_IDLE_DISCONNECT_SECONDS = 60
+
+# Set whenever a message is queued so idle workers pick it up without waiting for the next poll
+email_outbox_wakeup = asyncio.Event()
+
+def get_smtp_settings() -> Dict[str, Any]:
+    return {
+        "host": os.environ.get('SMTP_HOST', 'smtp.gmail.com'),
+        "port": int(os.environ.get('SMTP_PORT', '587')),
+        "email": os.environ.get('SMTP_EMAIL', ''),
+        "password": os.environ.get('SMTP_PASSWORD', ''),
+        # Implicit TLS; SMTP_SSL=false for plain local stand-ins (MailHog, aiosmtpd)
+        "ssl": os.environ.get('SMTP_SSL', 'true').lower() != 'false'
+    }
+
+def smtp_configured() -> bool:
+    settings = get_smtp_settings()
+    return bool(settings["email"] and settings["password"])
+
+class SMTPConnection:
+    """Reusable SMTP_SSL connection. Methods block, run them with asyncio.to_thread."""
+
+    def __init__(self):
+        self.server: Optional[smtplib.SMTP] = None
+        self.settings = get_smtp_settings()
+        self.sender = sender_header(self.settings["email"])
+
+    def connect(self):
+        self.close()
+        smtp_class = smtplib.SMTP_SSL if self.settings["ssl"] else smtplib.SMTP
+        server = smtp_class(self.settings["host"], self.settings["port"], timeout=30)
+        server.login(self.settings["email"], self.settings["password"])
+        self.server = server
+
+    def send(self, to: str, raw: bytes):
+        if self.server is None:
+            self.connect()
+        try:
+            self._sendmail(to, raw)
+        except smtplib.SMTPServerDisconnected:
+            # Server dropped the idle connection, log in again once
+            self.connect()
+            self._sendmail(to, raw)
+
+    def _sendmail(self, to: str, raw: bytes):
+        # Rendered templates carry 8bit UTF-8 bodies
+        options = ["BODY=8BITMIME"] if self.server.has_extn("8bitmime") else []
+        self.server.sendmail(self.settings["email"], [to], raw, mail_options=options)
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+async def enqueue_email(kind: str, to: str, context: Dict[str, Any]) -> str:
+    """Persist an email in the outbox and return immediately. Only the template
+    name and its placeholder values are stored; workers render at send time."""
+    now = datetime.now(timezone.utc).isoformat()
+    message_id = str(uuid.uuid4())
+    await db.email_outbox.insert_one({
+        "id": message_id,
+        "kind": kind,
+        "to": to,
+        "context": context,
+        "status": "pending",  # pending, sending, sent, dead
+        "attempts": 0,
+        "next_attempt_at": now,
+        "locked_at": None,
+        "last_error": None,
+        "created_at": now,
+        "sent_at": None
+    })
+    email_outbox_wakeup.set()
+    return message_id
+
+async def claim_next_email() -> Optional[Dict[str, Any]]:
+    now = datetime.now(timezone.utc)
+    stale_before = (now - timedelta(seconds=EMAIL_SENDING_TIMEOUT_SECONDS)).isoformat()
+    return await db.email_outbox.find_one_and_update(
+        {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now.isoformat()}},
+            {"status": "sending", "locked_at": {"$lt": stale_before}}
+        ]},
+        {"$set": {"status": "sending", "locked_at": now.isoformat()}, "$inc": {"attempts": 1}},
+        sort=[("next_attempt_at", 1)],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+def render_outbox_email(message: Dict[str, Any], sender: bytes) -> bytes:
+    if "context" in message:
+        return EMAIL_TEMPLATES[message["kind"]].render(sender, message["to"], message["context"])
+    
+    # Messages queued before templates were precompiled carry full bodies
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = message["subject"]
+    msg['To'] = message["to"]
+    msg.attach(MIMEText(message["text"], 'plain', 'utf-8'))
+    msg.attach(MIMEText(message["html"], 'html', 'utf-8'))
+    return sender + msg.as_bytes()
+
+async def deliver_outbox_email(connection: SMTPConnection, message: Dict[str, Any]):
+    try:
+        raw = render_outbox_email(message, connection.sender)
+        await asyncio.to_thread(connection.send, message["to"], raw)
+    except Exception as e:
+        await asyncio.to_thread(connection.close)
+        attempts = message["attempts"]
+        if attempts >= EMAIL_MAX_ATTEMPTS:
+            await db.email_outbox.update_one(
+                {"id": message["id"]},
+                {"$set": {"status": "dead", "last_error": str(e)}}
+            )
+            logger.error(f"Email {message['id']} to {message['to']} moved to dead letter after {attempts} attempts: {e}")
+        else:
+            retry_at = datetime.now(timezone.utc) + timedelta(seconds=EMAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+            await db.email_outbox.update_one(
+                {"id": message["id"]},
+                {"$set": {"status": "pending", "next_attempt_at": retry_at.isoformat(), "last_error": str(e)}}
+            )
+            logger.warning(f"Email {message['id']} to {message['to']} failed (attempt {attempts}), retrying at {retry_at.isoformat()}: {e}")
+        return
+    
+    logger.info(f"{message['kind']} email sent to {message['to']}")
+    # The email is out; retry recording that a few times so a brief database
+    # hiccup does not leave it to be reclaimed and sent again
+    for attempt in range(3):
+        try:
+            await db.email_outbox.update_one(
+                {"id": message["id"]},
+                {"$set": {"status": "sent", "sent_at": datetime.now(timezone.utc).isoformat(), "last_error": None}}
+            )
+            return
+        except PyMongoError as e:
+            if attempt == 2:
+                logger.error(f"Email {message['id']} was sent but could not be marked sent: {e}")
+            else:
+                await asyncio.sleep(1 + attempt)
+
+async def email_outbox_worker(worker_id: int):
+    """Drain the outbox over a single SMTP connection that is kept open while there is work"""
+    connection = SMTPConnection()
+    idle_since = None
+    try:
+        while True:
+            try:
+                message = await claim_next_email()
+            except Exception as e:
+                logger.error(f"Email worker {worker_id} failed to read outbox: {e}")
+                message = None
+            
+            if message:
+                idle_since = None
+                try:
+                    await deliver_outbox_email(connection, message)
+                except Exception as e:
+                    # Left in "sending"; claim_next_email picks it up again once stale
+                    logger.error(f"Email worker {worker_id} failed to record outcome of {message['id']}: {e}")
+                continue
+            
+            now = datetime.now(timezone.utc)
+            if idle_since is None:
+                idle_since = now
+            elif connection.server and (now - idle_since).total_seconds() > EMAIL_IDLE_DISCONNECT_SECONDS:
+                await asyncio.to_thread(connection.close)
+            
+            try:
+                await asyncio.wait_for(email_outbox_wakeup.wait(), EMAIL_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            email_outbox_wakeup.clear()
+    finally:
+        await asyncio.to_thread(connection.close)
+
+# ==================== BULK NOTIFICATIONS ====================
+
+# Bulk sends (e.g. weekly profit notices) stream recipients from a users cursor
+# and shard them across a few SMTP connections that stay logged in for the run.
+BULK_EMAIL_CONNECTIONS = int(os.environ.get('BULK_EMAIL_CONNECTIONS', '4'))
+BULK_EMAIL_RATE_PER_SECOND = float(os.environ.get('BULK_EMAIL_RATE_PER_SECOND', '10'))
+BULK_EMAIL_QUEUE_SIZE = 100
+BULK_EMAIL_PROGRESS_SECONDS = 2
+# A running notification run whose heartbeat is older than this has lost its process
+BULK_EMAIL_STALE_SECONDS = 30
+
+class SendRateLimiter:
+    """Spaces sends evenly so all connections together stay under rate_per_second"""
+
+    def __init__(self, rate_per_second: float):
+        self.interval = 1.0 / rate_per_second if rate_per_second > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            now = loop.time()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+def weekly_profit_recipients_pipeline(distribution_run_id: str) -> List[Dict[str, Any]]:
+    """Everyone paid in a distribution run, with the total they were actually paid"""
+    return [
+        {"$match": {"run_id": distribution_run_id, "status": "applied"}},
+        {"$group": {"_id": "$user_id", "amount": {"$sum": "$amount"}}},
+        {"$lookup": {"from": "users", "localField": "_id", "foreignField": "id", "as": "user"}},
+        {"$unwind": "$user"},
+        {"$match": {"user.email": {"$nin": [None, ""]}}},
+        {"$project": {"_id": 0, "email": "$user.email", "name": "$user.name", "amount": 1}}
+    ]
+
+async def weekly_profit_recipients(distribution_run_id: str):
+    cursor = db.distribution_payouts.aggregate(
+        weekly_profit_recipients_pipeline(distribution_run_id),
+        allowDiskUse=True
+    ).batch_size(500)
+    async for doc in cursor:
+        yield {
+            "email": doc["email"],
+            "context": {"user_name": doc.get("name") or "", "amount": f"{doc['amount']:,.2f}"}
+        }
+
+async def count_weekly_profit_recipients(distribution_run_id: str) -> int:
+    result = await db.distribution_payouts.aggregate(
+        weekly_profit_recipients_pipeline(distribution_run_id) + [{"$count": "total"}],
+        allowDiskUse=True
+    ).to_list(1)
+    return result[0]["total"] if result else 0
+
+async def run_bulk_notification(run_id: str, kind: str, recipients, connections: int, rate: float):
+    template = EMAIL_TEMPLATES[kind]
+    limiter = SendRateLimiter(rate)
+    queues = [asyncio.Queue(maxsize=BULK_EMAIL_QUEUE_SIZE) for _ in range(connections)]
+    counters = {"sent": 0, "failed": 0}
+    new_failures: List[Dict[str, Any]] = []
+    
+    async def report_progress(**extra):
+        heartbeat_at = datetime.now(timezone.utc).isoformat()
+        update: Dict[str, Any] = {"$set": {**counters, "heartbeat_at": heartbeat_at, **extra}}
+        if new_failures:
+            update["$push"] = {"failures": {"$each": list(new_failures), "$slice": -100}}
+            new_failures.clear()
+        await db.notification_runs.update_one({"id": run_id}, update)
+    
+    async def progress_reporter():
+        while True:
+            await asyncio.sleep(BULK_EMAIL_PROGRESS_SECONDS)
+            await report_progress()
+    
+    async def sender(queue: asyncio.Queue):
+        connection = SMTPConnection()
+        try:
+            while True:
+                recipient = await queue.get()
+                if recipient is None:
+                    return
+                await limiter.acquire()
+                try:
+                    raw = template.render(connection.sender, recipient["email"], recipient["context"])
+                    await asyncio.to_thread(connection.send, recipient["email"], raw)
+                    counters["sent"] += 1
+                except Exception as e:
+                    await asyncio.to_thread(connection.close)
+                    counters["failed"] += 1
+                    new_failures.append({"email": recipient["email"], "error": str(e)})
+                    # Let the outbox retry it with backoff instead of stalling the run
+                    await enqueue_email(kind, recipient["email"], recipient["context"])
+        finally:
+            await asyncio.to_thread(connection.close)
+    
+    senders = [asyncio.create_task(sender(queue)) for queue in queues]
+    reporter = asyncio.create_task(progress_reporter())
+    
+    async def hand_to(index: int, item):
+        """Queue item for a sender; raises if that sender has died instead of waiting forever"""
+        queue, task = queues[index], senders[index]
+        if not queue.full():
+            queue.put_nowait(item)
+            return
+        put = asyncio.ensure_future(queue.put(item))
+        await asyncio.wait({put, task}, return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            error = task.exception() if not task.cancelled() else None
+            raise RuntimeError(f"Email sender {index} stopped: {error}")
+    
+    status = "completed"
+    try:
+        index = 0
+        async for recipient in recipients:
+            await hand_to(index % connections, recipient)
+            index += 1
+        for index in range(connections):
+            await hand_to(index, None)
+        await asyncio.gather(*senders)
+    except Exception as e:
+        logger.error(f"Bulk notification {run_id} failed: {e}")
+        status = "failed"
+        for task in senders:
+            task.cancel()
+    finally:
+        reporter.cancel()
+        await report_progress(status=status, finished_at=datetime.now(timezone.utc).isoformat())
+    
+    logger.info(f"Bulk notification {run_id} {status}: {counters['sent']} sent, {counters['failed']} failed")
+
+async def start_weekly_profit_notification(distribution_run_id: str, admin: User) -> Dict[str, Any]:
+    """Notify everyone paid in a distribution run of the amount they received"""
+    return await start_bulk_notification(
+        "weekly_profit",
+        weekly_profit_recipients(distribution_run_id),
+        await count_weekly_profit_recipients(distribution_run_id),
+        admin,
+        distribution_run_id=distribution_run_id
+    )
+
+async def start_bulk_notification(kind: str, recipients, total: int, admin: User, **details) -> Dict[str, Any]:
+    run = {
+        "id": str(uuid.uuid4()),
+        "kind": kind,
+        **details,
+        "status": "running",  # running, completed, failed
+        "total": total,
+        "sent": 0,
+        "failed": 0,
+        "failures": [],
+        "connections": BULK_EMAIL_CONNECTIONS,
+        "rate_per_second": BULK_EMAIL_RATE_PER_SECOND,
+        "started_by": admin.id,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "heartbeat_at": datetime.now(timezone.utc).isoformat(),
+        "finished_at": None
+    }
+    await db.notification_runs.insert_one(dict(run))
+    spawn_background_task(run_bulk_notification(
+        run["id"], kind, recipients, BULK_EMAIL_CONNECTIONS, BULK_EMAIL_RATE_PER_SECOND
+    ))
+    return run
+
+async def send_welcome_email(user_email: str, user_name: str):
+    """Queue welcome email to new users for delivery by the outbox workers"""
+    try:
+        # Skip if SMTP not configured
+        if not smtp_configured():
+            logger.warning("SMTP not configured. Skipping welcome email.")
+            return False
+        
+        await enqueue_email("welcome", user_email, {"user_name": user_name})
+        
+        logger.info(f"Welcome email queued for {user_email}")
+        return True
+        
+    except Exception as e:
+        logger.error(f"Failed to queue welcome email to {user_email}: {str(e)}")
+        return False
+
+async def send_verification_email(user_email: str, user_name: str, verification_token: str):
+    """Send email verification link to new users"""
+    try:
+        if not smtp_configured():
+            logger.warning("SMTP not configured. Skipping verification email.")
+            return False
+        
+        # Get frontend URL from environment
+        frontend_url = os.environ.get('FRONTEND_URL', 'https://user-access-restored.preview.emergentagent.com')
+        verification_link = f"{frontend_url}/verify-email?token={verification_token}"
+        with open("/tmp/email_debug.log", "a") as f:
+            f.write(f"🔗 VERIFICATION LINK: {verification_link}\n")
+        logger.info(f"Generated verification link: {verification_link}")
+        
+        await enqueue_email("verification", user_email, {
+            "user_name": user_name,
+            "verification_link": verification_link
+        })
+        
+        logger.info(f"Verification email queued for {user_email}")
+        return True
+        
+    except Exception as e:
+        logger.error(f"Failed to queue verification email to {user_email}: {str(e)}")
+        return False
+
+async def send_password_change_email(user_email: str, user_name: str, password_change_token: str):
+    """Send password change confirmation email"""
+    try:
+        if not smtp_configured():
+            logger.warning("SMTP not configured. Skipping password change email.")
+            return False
         
-        part1 = MIMEText(text, 'plain', 'utf-8')
-        part2 = MIMEText(html, 'html', 'utf-8')
-        msg.attach(part1)
-        msg.attach(part2)
+        frontend_url = os.environ.get('FRONTEND_URL', 'https://user-access-restored.preview.emergentagent.com')
+        confirmation_link = f"{frontend_url}/confirm-password-change?token={password_change_token}"
         
-        with smtplib.SMTP_SSL(smtp_host, smtp_port) as server:
-            server.login(smtp_email, smtp_password)
-            server.send_message(msg)
+        await enqueue_email("password_change", user_email, {
+            "user_name": user_name,
+            "confirmation_link": confirmation_link
+        })
         
-        logger.info(f"Password change email sent to {user_email}")
+        logger.info(f"Password change email queued for {user_email}")
         return True
         
     except Exception as e:
-        logger.error(f"Failed to send password change email to {user_email}: {str(e)}")
+        logger.error(f"Failed to queue password change email to {user_email}: {str(e)}")
         return False
 
 
@@ -652,14 +1171,7 @@ async def register(req: RegisterRequest):
     
     # Validate referral code (OPTIONAL)
     if req.referral_code:
-        # Clean the code
-        clean_code = req.referral_code.strip()
-        
-        # Find referral code in referral_codes collection (case-insensitive)
-        import re
-        referral_doc = await db.referral_codes.find_one({
-            "code": {"$regex": f"^{re.escape(clean_code)}$", "$options": "i"}
-        }, {"_id": 0})
+        referral_doc = await find_referral_code(req.referral_code)
         
         if not referral_doc:
             raise HTTPException(status_code=400, detail="Geçersiz referans kodu. Lütfen doğru kodu girdiğinizden emin olun.")
@@ -711,9 +1223,11 @@ async def register(req: RegisterRequest):
                 "used_at": datetime.now(timezone.utc).isoformat()
             }}
         )
+        forget_active_referral_code(referral.user_id)
     
     user_dict = user.model_dump()
     await db.users.insert_one(user_dict)
+    await bump_stats(total_users=1)
     
     # Email verification is disabled - user can login immediately
     # Create session token
@@ -918,14 +1432,7 @@ async def confirm_password_change(token: str):
 @api_router.get("/auth/validate-referral/{referral_code}")
 async def validate_referral_code(referral_code: str):
     """Validate if a referral code exists and is valid"""
-    # Clean the code (trim whitespace)
-    clean_code = referral_code.strip()
-    
-    # Search for code (case-insensitive using regex)
-    import re
-    referral_doc = await db.referral_codes.find_one({
-        "code": {"$regex": f"^{re.escape(clean_code)}$", "$options": "i"}
-    }, {"_id": 0})
+    referral_doc = await find_referral_code(referral_code)
     
     if not referral_doc:
         return {
@@ -966,28 +1473,99 @@ async def validate_referral_code(referral_code: str):
 
 # ==================== REFERRAL CODE ENDPOINTS ====================
 
-async def ensure_user_has_referral_code(user_id: str) -> str:
-    """Ensure user has at least one active referral code, create one if needed"""
-    # Check if user has any active (unused and not expired) referral code
+async def find_referral_code(code: str) -> Optional[Dict[str, Any]]:
+    """Point read on the unique code_normalized index"""
+    return await db.referral_codes.find_one({"code_normalized": normalize_referral_code(code)}, {"_id": 0})
+
+async def create_referral_code(user_id: str, position: str = "auto") -> ReferralCode:
+    """Insert a fresh code, drawing again in the rare case it collides case-insensitively"""
+    while True:
+        new_code = ReferralCode(user_id=user_id, code=secrets.token_urlsafe(8), position=position)
+        try:
+            await db.referral_codes.insert_one(new_code.model_dump())
+            return new_code
+        except DuplicateKeyError:
+            continue
+
+async def backfill_referral_code_keys():
+    """Set code_normalized on referral codes created before it was stored"""
+    while True:
+        codes = await db.referral_codes.find(
+            {"code_normalized": {"$exists": False}},
+            {"_id": 0, "id": 1, "code": 1}
+        ).limit(1000).to_list(1000)
+        if not codes:
+            return
+        try:
+            await db.referral_codes.bulk_write([
+                UpdateOne({"id": c["id"]}, {"$set": {"code_normalized": normalize_referral_code(c["code"])}})
+                for c in codes
+            ], ordered=False)
+        except BulkWriteError as e:
+            # Codes differing only by case: the first keeps the key, the others
+            # are marked so they stop matching and are not picked up again
+            duplicates = [err["op"]["q"]["id"] for err in e.details.get("writeErrors", []) if err.get("code") == 11000]
+            logger.warning(f"Referral codes colliding case-insensitively: {duplicates}")
+            await db.referral_codes.update_many(
+                {"id": {"$in": duplicates}},
+                {"$set": {"code_normalized": None}}
+            )
+
+# Each user's active code, cached per process until shortly before it
+# expires. Entries are also re-checked after ACTIVE_CODE_CACHE_SECONDS so a
+# code used through another worker is not shown for long. The cache keeps
+# the ACTIVE_CODE_CACHE_MAX_ENTRIES most recently used users.
+ACTIVE_CODE_MIN_REMAINING = timedelta(seconds=60)
+ACTIVE_CODE_CACHE_SECONDS = 60
+ACTIVE_CODE_CACHE_MAX_ENTRIES = 10000
+active_referral_codes: Dict[str, Dict[str, Any]] = {}
+active_referral_code_lookups: Dict[str, asyncio.Task] = {}
+
+def forget_active_referral_code(user_id: str):
+    """Drop the cached code once it has been used"""
+    active_referral_codes.pop(user_id, None)
+
+async def load_active_referral_code(user_id: str) -> Dict[str, Any]:
+    # An unused code with enough time left, newest first, from the
+    # (user_id, is_used, expires_at) index
     active_code = await db.referral_codes.find_one({
         "user_id": user_id,
         "is_used": False,
-        "expires_at": {"$gt": datetime.now(timezone.utc).isoformat()}
-    }, {"_id": 0})
-    
-    if active_code:
-        return active_code["code"]
-    
-    # Create new referral code
-    new_code = ReferralCode(
-        user_id=user_id,
-        code=secrets.token_urlsafe(8)
-    )
-    
-    code_dict = new_code.model_dump()
-    await db.referral_codes.insert_one(code_dict)
-    
-    return new_code.code
+        "expires_at": {"$gt": (datetime.now(timezone.utc) + ACTIVE_CODE_MIN_REMAINING).isoformat()}
+    }, {"_id": 0, "code": 1, "expires_at": 1}, sort=[("expires_at", -1)])
+    
+    if not active_code:
+        new_code = await create_referral_code(user_id)
+        active_code = {"code": new_code.code, "expires_at": new_code.expires_at}
+    
+    entry = {
+        "code": active_code["code"],
+        "valid_until": min(
+            datetime.fromisoformat(active_code["expires_at"]) - ACTIVE_CODE_MIN_REMAINING,
+            datetime.now(timezone.utc) + timedelta(seconds=ACTIVE_CODE_CACHE_SECONDS)
+        )
+    }
+    active_referral_codes.pop(user_id, None)
+    active_referral_codes[user_id] = entry
+    while len(active_referral_codes) > ACTIVE_CODE_CACHE_MAX_ENTRIES:
+        active_referral_codes.pop(next(iter(active_referral_codes)))
+    return entry
+
+async def ensure_user_has_referral_code(user_id: str) -> str:
+    """Ensure user has at least one active referral code, create one if needed"""
+    entry = active_referral_codes.pop(user_id, None)
+    if entry and entry["valid_until"] > datetime.now(timezone.utc):
+        active_referral_codes[user_id] = entry  # back to the most recently used end
+        return entry["code"]
+    
+    # Concurrent dashboard loads for one user share a lookup, so they
+    # cannot each insert a new code
+    lookup = active_referral_code_lookups.get(user_id)
+    if not lookup:
+        lookup = asyncio.ensure_future(load_active_referral_code(user_id))
+        active_referral_code_lookups[user_id] = lookup
+        lookup.add_done_callback(lambda _: active_referral_code_lookups.pop(user_id, None))
+    return (await asyncio.shield(lookup))["code"]
 
 @api_router.post("/referral/generate")
 async def generate_referral_code(request: Request, position: str = "auto"):
@@ -999,14 +1577,7 @@ async def generate_referral_code(request: Request, position: str = "auto"):
         raise HTTPException(status_code=400, detail="Position must be 'left', 'right', or 'auto'")
     
     # Create new referral code
-    new_code = ReferralCode(
-        user_id=user.id,
-        code=secrets.token_urlsafe(8),
-        position=position
-    )
-    
-    code_dict = new_code.model_dump()
-    await db.referral_codes.insert_one(code_dict)
+    new_code = await create_referral_code(user.id, position)
     
     position_text = {
         "left": "Sol Kol",
@@ -1036,16 +1607,15 @@ async def get_my_referral_codes(request: Request):
     
     codes = await codes_cursor.to_list(length=None)
     
-    # Get referral user details for each code
+    # Get referred user details for all codes at once
+    referred_users = await fetch_users_by_id(
+        (code_doc.get("used_by") for code_doc in codes),
+        fields=("name", "email", "created_at")
+    )
     result = []
     for code_doc in codes:
         code = ReferralCode(**code_doc)
-        
-        # Get referred user info
-        referred_user = await db.users.find_one(
-            {"id": code.used_by},
-            {"_id": 0, "name": 1, "email": 1, "created_at": 1}
-        )
+        referred_user = referred_users.get(code.used_by)
         
         result.append({
             "code": code.code,
@@ -1082,7 +1652,7 @@ async def join_network_with_code(req: JoinNetworkRequest, current_user: User = D
         )
     
     # Find referral code
-    referral_doc = await db.referral_codes.find_one({"code": req.referral_code}, {"_id": 0})
+    referral_doc = await find_referral_code(req.referral_code)
     if not referral_doc:
         raise HTTPException(status_code=400, detail="Geçersiz referans kodu.")
     
@@ -1132,6 +1702,7 @@ async def join_network_with_code(req: JoinNetworkRequest, current_user: User = D
             "used_at": datetime.now(timezone.utc).isoformat()
         }}
     )
+    forget_active_referral_code(referral.user_id)
     
     return {
         "message": f"Başarılı! {sponsor.name} ağına katıldınız.",
@@ -1175,6 +1746,7 @@ async def create_session(request: Request, response: Response):
         )
         user_dict = user.model_dump()
         await db.users.insert_one(user_dict)
+        await bump_stats(total_users=1)
     
     # Create session
     session_token = auth_data["session_token"]
@@ -1218,34 +1790,751 @@ async def logout(request: Request, response: Response):
     response.delete_cookie("session_token", path="/")
     return {"message": "Logged out successfully"}
 
-# ==================== PACKAGE ENDPOINTS ====================
+# ==================== DB TRANSACTIONS ====================
 
-PACKAGES = {
-    "silver": PackageInfo(name="Silver", amount=250.0, commission_rate=0.05),
-    "gold": PackageInfo(name="Gold", amount=500.0, commission_rate=0.10),
-    "platinum": PackageInfo(name="Platinum", amount=1000.0, commission_rate=0.15)
-}
+async def run_in_transaction(callback, mongo_client=None):
+    """payout_worker.run_in_transaction on the app's client unless another is given"""
+    return await payout_worker.run_in_transaction(callback, mongo_client or client)
 
-@api_router.get("/packages")
-async def get_packages():
-    return list(PACKAGES.values())
+# ==================== WALLET LEDGER ====================
 
+# Every wallet_balance change is also appended to wallet_ledger. The balance on
+# the user document stays the O(1) read path; the ledger makes it replayable.
+WALLET_CHECKPOINT_CHUNK_SIZE = 1000
+WALLET_CHECKPOINT_LAG_SECONDS = 60
 
-@api_router.post("/investment/request")
-async def create_investment_request(
-    req: InvestmentRequestCreate,
-    user: User = Depends(require_auth)
-):
-    # Check if user already has an approved investment
-    existing_approved = await db.investment_requests.find_one({
-        "user_id": user.id,
-        "status": "approved"
-    })
+async def change_wallet(
+    user_id: str,
+    amount: float,
+    kind: str,
+    description: str = "",
+    ref: Optional[str] = None,
+    inc: Optional[Dict[str, Any]] = None,
+    set_fields: Optional[Dict[str, Any]] = None,
+    guard: Optional[Dict[str, Any]] = None,
+    session=None
+) -> Optional[Dict[str, Any]]:
+    """
+    Change a user's wallet_balance and append the matching ledger entry.
+    Extra guard conditions make it conditional; returns None if nothing matched.
+    With a ref the ledger entry is written first, as pending, and the balance
+    moves through it (see LEDGER_APPLIED_IDS). (ref, type) is unique, so a
+    repeated call for the same ref finishes an interrupted change or, once the
+    entry is applied, is a no-op that returns None.
+    """
+    update: Dict[str, Any] = {"$inc": {"wallet_balance": amount, **(inc or {})}}
+    if set_fields:
+        update["$set"] = set_fields
+    
+    if ref is None:
+        user_doc = await db.users.find_one_and_update(
+            {"id": user_id, **(guard or {})},
+            update,
+            projection={"_id": 0, "wallet_balance": 1},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if user_doc is not None:
+            await db.wallet_ledger.insert_one(
+                ledger_entry(user_id, amount, kind, description, balance_after=user_doc["wallet_balance"]),
+                session=session
+            )
+        return user_doc
     
-    if existing_approved:
-        raise HTTPException(
-            status_code=400,
-            detail="Zaten onaylanmış bir yatırımınız var. Sadece bir kez yatırım yapabilirsiniz."
+    entry = ledger_entry(user_id, amount, kind, description, ref, status="pending")
+    redrive = False
+    try:
+        await db.wallet_ledger.insert_one(entry, session=session)
+    except DuplicateKeyError:
+        if session is not None:
+            raise  # the transaction is aborted, let the caller see why
+        # A pending entry was left by an interrupted call: drive it to completion
+        entry = await db.wallet_ledger.find_one({"ref": ref, "type": kind, "status": "pending"}, {"_id": 0})
+        if entry is None:
+            return None
+        redrive = True
+    
+    user_doc = await db.users.find_one_and_update(
+        {**unapplied_entry_filter(entry), **(guard or {})},
+        applied_entry_update(entry, update["$inc"]) | {k: v for k, v in update.items() if k != "$inc"},
+        projection={"_id": 0, "wallet_balance": 1},
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    if user_doc is None and redrive:
+        # The interrupted call may have moved the balance before it stopped
+        user_doc = await db.users.find_one(
+            {"id": user_id, LEDGER_APPLIED_IDS: entry["id"]},
+            {"_id": 0, "wallet_balance": 1},
+            session=session
+        )
+    if user_doc is None:
+        await db.wallet_ledger.delete_one({"id": entry["id"], "status": "pending"}, session=session)
+        return None
+    
+    await db.wallet_ledger.update_one(
+        {"id": entry["id"]},
+        {"$set": {"status": "applied", "balance_after": user_doc["wallet_balance"]}},
+        session=session
+    )
+    await db.users.update_one({"id": user_id}, {"$pull": {LEDGER_APPLIED_IDS: entry["id"]}}, session=session)
+    return user_doc
+
+async def ledger_sum(user_id: str, after_seq: int, upto_seq: Optional[int] = None) -> Dict[str, Any]:
+    """Sum and count of a user's ledger entries in (after_seq, upto_seq]"""
+    seq_range: Dict[str, Any] = {"$gt": after_seq}
+    if upto_seq is not None:
+        seq_range["$lte"] = upto_seq
+    
+    result = await db.wallet_ledger.aggregate([
+        {"$match": {"user_id": user_id, "seq": seq_range}},
+        {"$group": {"_id": None, "amount": {"$sum": "$amount"}, "count": {"$sum": 1}, "seq": {"$max": "$seq"}}}
+    ]).to_list(1)
+    return result[0] if result else {"amount": 0.0, "count": 0, "seq": after_seq}
+
+async def latest_checkpoints(user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    checkpoints = await db.wallet_checkpoints.aggregate([
+        {"$match": {"user_id": {"$in": user_ids}}},
+        {"$sort": {"user_id": 1, "seq": -1}},
+        {"$group": {"_id": "$user_id", "seq": {"$first": "$seq"}, "balance": {"$first": "$balance"}}}
+    ]).to_list(None)
+    return {cp["_id"]: cp for cp in checkpoints}
+
+async def open_wallet_ledgers() -> int:
+    """
+    Write an opening checkpoint for accounts whose balance predates the ledger.
+    Accounts created since then start at zero and are already marked opened.
+    """
+    opened = 0
+    while True:
+        users = await db.users.find(
+            {"ledger_opened": {"$ne": True}},
+            {"_id": 0, "id": 1, "wallet_balance": 1}
+        ).limit(WALLET_CHECKPOINT_CHUNK_SIZE).to_list(WALLET_CHECKPOINT_CHUNK_SIZE)
+        if not users:
+            return opened
+        
+        now = datetime.now(timezone.utc).isoformat()
+        await db.wallet_checkpoints.insert_many([{
+            "user_id": u["id"],
+            "seq": next_ledger_seq(),
+            "balance": u.get("wallet_balance", 0.0),
+            "opening": True,
+            "created_at": now
+        } for u in users])
+        await db.users.update_many(
+            {"id": {"$in": [u["id"] for u in users]}},
+            {"$set": {"ledger_opened": True}}
+        )
+        opened += len(users)
+
+async def write_wallet_checkpoints(groups: List[Dict[str, Any]], upto_seq: int) -> int:
+    previous = await latest_checkpoints([g["_id"] for g in groups])
+    now = datetime.now(timezone.utc).isoformat()
+    
+    checkpoints = []
+    for group in groups:
+        prev = previous.get(group["_id"], {"seq": 0, "balance": 0.0})
+        if prev["seq"] >= group["min_seq"]:
+            # An opening checkpoint (or a checkpoint from an interrupted run)
+            # already covers part of this window, so sum only what follows it
+            group = await ledger_sum(group["_id"], prev["seq"], upto_seq) | {"_id": group["_id"]}
+            if not group["count"]:
+                continue
+        checkpoints.append({
+            "user_id": group["_id"],
+            "seq": group["seq"],
+            "balance": prev["balance"] + group["amount"],
+            "created_at": now
+        })
+    
+    if checkpoints:
+        await db.wallet_checkpoints.insert_many(checkpoints, ordered=False)
+    return len(checkpoints)
+
+async def checkpoint_wallet_balances() -> Dict[str, Any]:
+    """
+    Roll ledger entries written since the last run into new per-user
+    checkpoints. Entries younger than the lag are left for the next run so
+    writes still in flight are not skipped.
+    """
+    opened = await open_wallet_ledgers()
+    
+    state = await db.wallet_checkpoint_state.find_one({"_id": "wallet"}) or {}
+    since = state.get("seq", 0)
+    upto = (time.time_ns() // 1000 - WALLET_CHECKPOINT_LAG_SECONDS * 1_000_000) * 1000 + 999
+    if upto <= since:
+        return {"opened": opened, "checkpoints": 0}
+    
+    cursor = db.wallet_ledger.aggregate([
+        {"$match": {"seq": {"$gt": since, "$lte": upto}}},
+        {"$group": {
+            "_id": "$user_id",
+            "amount": {"$sum": "$amount"},
+            "count": {"$sum": 1},
+            "min_seq": {"$min": "$seq"},
+            "seq": {"$max": "$seq"}
+        }}
+    ], allowDiskUse=True)
+    
+    written = 0
+    groups = []
+    async for group in cursor:
+        groups.append(group)
+        if len(groups) >= WALLET_CHECKPOINT_CHUNK_SIZE:
+            written += await write_wallet_checkpoints(groups, upto)
+            groups = []
+    if groups:
+        written += await write_wallet_checkpoints(groups, upto)
+    
+    await db.wallet_checkpoint_state.update_one(
+        {"_id": "wallet"},
+        {"$set": {"seq": upto, "updated_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+    return {"opened": opened, "checkpoints": written}
+
+async def replay_wallet_balance(user_id: str) -> Dict[str, Any]:
+    """Balance derived from the last checkpoint plus every later ledger entry"""
+    checkpoint = (await latest_checkpoints([user_id])).get(user_id, {"seq": 0, "balance": 0.0})
+    tail = await ledger_sum(user_id, checkpoint["seq"])
+    return {
+        "balance": checkpoint["balance"] + tail["amount"],
+        "checkpoint_seq": checkpoint["seq"],
+        "checkpoint_balance": checkpoint["balance"],
+        "entries_since_checkpoint": tail["count"]
+    }
+
+@api_router.get("/admin/users/{user_id}/ledger")
+async def admin_get_user_ledger(user_id: str, limit: int = 100, admin: User = Depends(require_admin)):
+    """Recent ledger entries and the replayed balance next to the stored one"""
+    user_doc = await db.users.find_one({"id": user_id}, {"_id": 0, "id": 1, "name": 1, "wallet_balance": 1})
+    if not user_doc:
+        raise HTTPException(status_code=404, detail="Kullanıcı bulunamadı")
+    
+    limit = max(1, min(limit, 1000))
+    entries = await db.wallet_ledger.find(
+        {"user_id": user_id},
+        {"_id": 0}
+    ).sort("seq", -1).limit(limit).to_list(limit)
+    
+    replay = await replay_wallet_balance(user_id)
+    return {
+        "user_id": user_id,
+        "name": user_doc.get("name"),
+        "wallet_balance": user_doc.get("wallet_balance", 0.0),
+        "ledger_balance": replay["balance"],
+        "drift": round(user_doc.get("wallet_balance", 0.0) - replay["balance"], 8),
+        "checkpoint_seq": replay["checkpoint_seq"],
+        "entries_since_checkpoint": replay["entries_since_checkpoint"],
+        "entries": entries
+    }
+
+# ==================== TRANSACTION ARCHIVE ====================
+
+# Settled transactions older than the hot window move to one collection per
+# month (transactions_YYYY_MM); transaction_partitions lists them
+TRANSACTION_HOT_MONTHS = int(os.environ.get('TRANSACTION_HOT_MONTHS', '3'))
+TRANSACTION_ARCHIVE_BATCH_SIZE = 1000
+
+def month_start(dt: datetime) -> datetime:
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def add_months(dt: datetime, months: int) -> datetime:
+    years, month_index = divmod(dt.month - 1 + months, 12)
+    return dt.replace(year=dt.year + years, month=month_index + 1)
+
+def transaction_partition_name(month: datetime) -> str:
+    return f"transactions_{month:%Y_%m}"
+
+async def transaction_partitions() -> List[Dict[str, Any]]:
+    """Archive partitions, newest month first"""
+    return await db.transaction_partitions.find({}, {"_id": 0}).sort("month_start", -1).to_list(None)
+
+async def ensure_transaction_partition(month: datetime) -> str:
+    name = transaction_partition_name(month)
+    partition = await db.transaction_partitions.find_one_and_update(
+        {"_id": name},
+        {"$setOnInsert": {
+            "collection": name,
+            "month_start": month.isoformat(),
+            "month_end": add_months(month, 1).isoformat(),
+            "count": 0,
+            "indexed": False
+        }},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    if not partition.get("indexed"):
+        await db[name].create_index("id", unique=True)
+        await db[name].create_index([("user_id", 1), ("created_at", -1)])
+        await db[name].create_index([("created_at", -1)])
+        await db[name].create_index("updated_at")
+        await db.transaction_partitions.update_one({"_id": name}, {"$set": {"indexed": True}})
+    return name
+
+async def archive_transactions() -> Dict[str, Any]:
+    """
+    Move settled transactions older than the hot window into their monthly
+    partition. Each batch is copied before it is deleted, so an interrupted
+    run is finished by the next one without losing or duplicating anything.
+    Pending transactions stay hot until an admin settles them.
+    """
+    cutoff = add_months(month_start(datetime.now(timezone.utc)), -TRANSACTION_HOT_MONTHS)
+    moved: Dict[str, int] = {}
+    
+    while True:
+        batch = await db.transactions.find(
+            {"created_at": {"$lt": cutoff.isoformat()}, "status": {"$ne": "pending"}},
+            {"_id": 0}
+        ).sort("created_at", 1).limit(TRANSACTION_ARCHIVE_BATCH_SIZE).to_list(TRANSACTION_ARCHIVE_BATCH_SIZE)
+        if not batch:
+            break
+        
+        by_month: Dict[datetime, List[Dict[str, Any]]] = {}
+        for tx in batch:
+            created_at = datetime.fromisoformat(tx["created_at"])
+            if created_at.tzinfo is None:
+                created_at = created_at.replace(tzinfo=timezone.utc)
+            by_month.setdefault(month_start(created_at.astimezone(timezone.utc)), []).append(tx)
+        
+        for month, docs in by_month.items():
+            name = await ensure_transaction_partition(month)
+            await insert_many_skip_duplicates(db[name], docs)
+            moved[name] = moved.get(name, 0) + len(docs)
+        
+        await db.transactions.delete_many({"id": {"$in": [tx["id"] for tx in batch]}})
+    
+    for name, count in moved.items():
+        await db.transaction_partitions.update_one({"_id": name}, {"$inc": {"count": count}})
+    return {"cutoff": cutoff.isoformat(), "moved": moved}
+
+async def find_transactions(query: Dict[str, Any], limit: int, before: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Newest-first transactions matching query, across the hot collection and
+    the monthly archives. Archives are only read when the page reaches back
+    past what the hot collection (plus newer archives) already filled.
+    """
+    if before:
+        query = {**query, "created_at": {"$lt": before}}
+    
+    results = await db.transactions.find(query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+    
+    for partition in await transaction_partitions():
+        if before and partition["month_start"] >= before:
+            continue
+        if len(results) >= limit and results[-1]["created_at"] >= partition["month_end"]:
+            break  # this and every older partition sort after the page
+        
+        docs = await db[partition["collection"]].find(
+            query,
+            {"_id": 0}
+        ).sort("created_at", -1).limit(limit).to_list(limit)
+        results = sorted(results + docs, key=lambda tx: tx["created_at"], reverse=True)[:limit]
+    
+    return results
+
+# ==================== RECONCILIATION ====================
+
+# Running per-user totals of the transactions collection, compared against
+# the balances stored on the user documents. Transactions are folded when
+# created and again when an admin decides them (updated_at).
+RECONCILED_FIELDS = ("wallet_balance", "total_commissions", "binary_earnings", "total_weekly_profit")
+RECONCILIATION_LAG_SECONDS = 60
+RECONCILIATION_TOLERANCE = 1e-6
+RECONCILIATION_BATCH_SIZE = 1000
+
+def _amount_if(condition) -> Dict[str, Any]:
+    return {"$cond": [condition, "$amount", 0]}
+
+def _wallet_change(status, credited) -> Dict[str, Any]:
+    """How a transaction moves wallet_balance, given its status and wallet_credited"""
+    return {"$switch": {
+        "branches": [
+            {"case": {"$in": ["$type", ["commission", "binary", "profit", "weekly_profit"]]}, "then": "$amount"},
+            # Only deposits approved by an admin credit the wallet
+            {"case": {"$and": [{"$eq": ["$type", "deposit"]}, {"$eq": [credited, True]}]}, "then": "$amount"},
+            # Withdrawals are debited when requested; rejected ones are refunded
+            {"case": {"$and": [
+                {"$eq": ["$type", "withdrawal"]},
+                {"$in": [status, ["pending", "completed"]]}
+            ]}, "then": {"$multiply": ["$amount", -1]}}
+        ],
+        "default": 0
+    }}
+
+# Transaction types as they move each user field. A transaction refolded
+# after an admin decided it was already counted as pending by an earlier
+# window, so only the difference is added (status changes only leave pending).
+RECONCILIATION_GROUP = {
+    "wallet_balance": {"$sum": {"$subtract": [
+        _wallet_change("$status", "$wallet_credited"),
+        {"$cond": ["$refolded", _wallet_change("pending", False), 0]}
+    ]}},
+    "total_commissions": {"$sum": _amount_if({"$and": [{"$eq": ["$type", "commission"]}, {"$eq": ["$refolded", False]}]})},
+    "binary_earnings": {"$sum": _amount_if({"$and": [{"$eq": ["$type", "binary"]}, {"$eq": ["$refolded", False]}]})},
+    "total_weekly_profit": {"$sum": _amount_if({"$and": [{"$eq": ["$type", "profit"]}, {"$eq": ["$refolded", False]}]})}
+}
+
+async def _next_or_none(cursor):
+    try:
+        return await cursor.__anext__()
+    except StopAsyncIteration:
+        return None
+
+async def apply_reconciliation_totals(groups: List[Dict[str, Any]], upto: str):
+    """
+    Add one window of per-user sums to the running totals. A window is
+    retried with the same upto (reconciliation_state.pending), and
+    applied_upto makes that a no-op: the filter misses and the upsert hits
+    the unique user_id index.
+    """
+    ops = [UpdateOne(
+        {"user_id": group["_id"], "applied_upto": {"$lt": upto}},
+        {
+            "$inc": {field: group[field] for field in RECONCILED_FIELDS},
+            "$set": {"applied_upto": upto}
+        },
+        upsert=True
+    ) for group in groups]
+    try:
+        await db.reconciliation_totals.bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+
+async def reconcile_balances(full: bool = False) -> Dict[str, Any]:
+    """
+    Fold transactions created or decided (updated_at) since the watermark
+    into the running totals, then merge-join the totals against the users
+    (both sorted by user id) and write every mismatch to reconciliation_drift.
+    """
+    state = await db.reconciliation_state.find_one({"_id": "transactions"}) or {}
+    if full:
+        await db.reconciliation_totals.delete_many({})
+        state = {}
+    
+    if state.get("pending"):
+        # A previous run stopped mid-fold: finish the same window, so totals it
+        # already moved to applied_upto are skipped rather than counted twice
+        since, upto = state["pending"]["since"], state["pending"]["upto"]
+    else:
+        since = state.get("watermark", "")
+        upto = (datetime.now(timezone.utc) - timedelta(seconds=RECONCILIATION_LAG_SECONDS)).isoformat()
+        await db.reconciliation_state.update_one(
+            {"_id": "transactions"},
+            {"$set": {"watermark": since, "pending": {"since": since, "upto": upto}}},
+            upsert=True
+        )
+    run_id = str(uuid.uuid4())
+    started_at = datetime.now(timezone.utc).isoformat()
+    
+    # Step 1: one $group per user over the new window, streamed in batches.
+    # A transaction decided after upto still counts as pending in this window;
+    # one created before it was counted then and only its decision is new.
+    # Every archive partition is searched, since an old transaction can be
+    # decided (and then archived) at any time.
+    in_window = {"$gt": since, "$lte": upto}
+    window = [
+        {"$match": {
+            "$or": [{"created_at": in_window}, {"updated_at": in_window}],
+            "user_id": {"$type": "string"}
+        }},
+        {"$set": {
+            "status": {"$cond": [{"$gt": ["$updated_at", upto]}, "pending", "$status"]},
+            "wallet_credited": {"$cond": [{"$gt": ["$updated_at", upto]}, False, "$wallet_credited"]},
+            "refolded": {"$lte": ["$created_at", since]}
+        }}
+    ]
+    archives = [
+        {"$unionWith": {"coll": partition["collection"], "pipeline": window}}
+        for partition in await transaction_partitions()
+    ]
+    cursor = db.transactions.aggregate([
+        *window,
+        *archives,
+        {"$group": {"_id": "$user_id", **RECONCILIATION_GROUP}},
+        {"$sort": {"_id": 1}}
+    ], allowDiskUse=True)
+    
+    folded = 0
+    groups = []
+    async for group in cursor:
+        groups.append(group)
+        if len(groups) >= RECONCILIATION_BATCH_SIZE:
+            await apply_reconciliation_totals(groups, upto)
+            folded += len(groups)
+            groups = []
+    if groups:
+        await apply_reconciliation_totals(groups, upto)
+        folded += len(groups)
+    
+    await db.reconciliation_state.update_one(
+        {"_id": "transactions"},
+        {"$set": {"watermark": upto, "pending": None, "updated_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+    
+    # Step 2: merge-join the sorted users cursor against the sorted totals
+    users = db.users.find(
+        {},
+        {"_id": 0, "id": 1, "name": 1, "email": 1, "held_balance": 1, **{field: 1 for field in RECONCILED_FIELDS}}
+    ).sort("id", 1).batch_size(RECONCILIATION_BATCH_SIZE)
+    totals = db.reconciliation_totals.find({}, {"_id": 0}).sort("user_id", 1).batch_size(RECONCILIATION_BATCH_SIZE)
+    
+    checked = 0
+    drifted = 0
+    report = []
+    total = await _next_or_none(totals)
+    async for user_doc in users:
+        while total is not None and total["user_id"] < user_doc["id"]:
+            total = await _next_or_none(totals)
+        expected = total if total is not None and total["user_id"] == user_doc["id"] else {}
+        checked += 1
+        
+        drift = {}
+        for field in RECONCILED_FIELDS:
+            stored = user_doc.get(field) or 0.0
+            if field == "wallet_balance":
+                # Funds held by pending withdrawal requests have not left the account yet
+                stored += user_doc.get("held_balance") or 0.0
+            derived = expected.get(field, 0.0)
+            if abs(stored - derived) > RECONCILIATION_TOLERANCE:
+                drift[field] = {"stored": stored, "expected": derived, "difference": stored - derived}
+        
+        if drift:
+            drifted += 1
+            report.append({
+                "run_id": run_id,
+                "user_id": user_doc["id"],
+                "name": user_doc.get("name"),
+                "email": user_doc.get("email"),
+                "drift": drift,
+                "created_at": started_at
+            })
+            if len(report) >= RECONCILIATION_BATCH_SIZE:
+                await db.reconciliation_drift.insert_many(report, ordered=False)
+                report = []
+    if report:
+        await db.reconciliation_drift.insert_many(report, ordered=False)
+    
+    # Only the latest report is kept
+    await db.reconciliation_drift.delete_many({"run_id": {"$ne": run_id}})
+    summary = {
+        "id": run_id,
+        "full": full,
+        "watermark": upto,
+        "users_folded": folded,
+        "users_checked": checked,
+        "users_drifted": drifted,
+        "started_at": started_at,
+        "finished_at": datetime.now(timezone.utc).isoformat()
+    }
+    await db.reconciliation_runs.insert_one(dict(summary))
+    return summary
+
+@api_router.get("/admin/reconciliation")
+async def admin_get_reconciliation(limit: int = 100, admin: User = Depends(require_admin)):
+    """Latest reconciliation run and the users whose balances drifted"""
+    run = await db.reconciliation_runs.find_one({}, {"_id": 0}, sort=[("started_at", -1)])
+    if not run:
+        return {"run": None, "drift": []}
+    
+    limit = max(1, min(limit, 1000))
+    drift = await db.reconciliation_drift.find(
+        {"run_id": run["id"]},
+        {"_id": 0}
+    ).limit(limit).to_list(limit)
+    return {"run": run, "drift": drift}
+
+# ==================== STATS COUNTERS ====================
+
+# One document of platform totals, kept current with $inc where the
+# underlying data changes so the stats endpoints are a single point read.
+# The increments run after the surrounding transaction commits (a shared
+# counter inside every transaction would make them all conflict), so a
+# crash in between can leave drift; reconcile_stats recounts periodically.
+STATS_DOC_ID = "platform"
+STATS_FIELDS = ("total_users", "total_investments", "total_volume", "pending_withdrawals")
+
+async def bump_stats(**deltas: float):
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if deltas:
+        await db.stats.update_one({"_id": STATS_DOC_ID}, {"$inc": deltas}, upsert=True)
+
+async def count_stats() -> Dict[str, Any]:
+    # User count and total volume share one pass over users; the other
+    # collections are counted concurrently
+    user_facet, total_investments, pending_withdrawals = await asyncio.gather(
+        db.users.aggregate([{"$facet": {
+            "count": [{"$count": "total"}],
+            "volume": [{"$group": {"_id": None, "total": {"$sum": "$total_invested"}}}]
+        }}]).to_list(1),
+        db.investments.count_documents({"is_active": True}),
+        db.withdrawal_requests.count_documents({"status": "pending"})
+    )
+    facet = user_facet[0] if user_facet else {}
+    
+    return {
+        "total_users": facet["count"][0]["total"] if facet.get("count") else 0,
+        "total_investments": total_investments,
+        "total_volume": facet["volume"][0]["total"] if facet.get("volume") else 0,
+        "pending_withdrawals": pending_withdrawals
+    }
+
+async def reconcile_stats() -> Dict[str, Any]:
+    """
+    Recount every counter from the collections and overwrite the stats
+    document. Increments landing while the counts run can be off by one
+    until the next pass.
+    """
+    before = await db.stats.find_one({"_id": STATS_DOC_ID}) or {}
+    counts = await count_stats()
+    drift = {
+        field: counts[field] - before.get(field, 0)
+        for field in STATS_FIELDS
+        if abs(counts[field] - before.get(field, 0)) > RECONCILIATION_TOLERANCE
+    }
+    await db.stats.update_one(
+        {"_id": STATS_DOC_ID},
+        {"$set": {**counts, "reconciled_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+    if drift and before.get("reconciled_at"):
+        logger.warning(f"Stats counters drifted: {drift}")
+    return {**counts, "drift": drift}
+
+async def read_stats() -> Dict[str, Any]:
+    doc = await db.stats.find_one({"_id": STATS_DOC_ID})
+    if not doc or not doc.get("reconciled_at"):
+        # Counters start from a full count; increments alone have no baseline
+        doc = await reconcile_stats()
+    return {field: doc.get(field, 0) for field in STATS_FIELDS}
+
+# ==================== RESPONSE CACHE ====================
+
+# Per-process cache for public responses. A fresh entry is served as is; a
+# stale one is served while one background task recomputes it; a miss makes
+# every concurrent caller wait on the same single computation.
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+response_cache: Dict[tuple, Dict[str, Any]] = {}
+response_cache_inflight: Dict[tuple, asyncio.Task] = {}
+
+def refresh_cached_response(key: tuple, compute) -> asyncio.Task:
+    """Start compute() for key unless it is already running (single-flight)"""
+    task = response_cache_inflight.get(key)
+    if task:
+        return task
+    
+    async def run():
+        value = jsonable_encoder(await compute())
+        response_cache.pop(key, None)
+        response_cache[key] = {"value": value, "stored_at": time.monotonic()}
+        while len(response_cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            response_cache.pop(next(iter(response_cache)))
+        return response_cache[key]
+    
+    def finished(done: asyncio.Task):
+        response_cache_inflight.pop(key, None)
+        if not done.cancelled() and done.exception():
+            logger.warning(f"Response cache refresh failed for {key[0]}: {done.exception()}")
+    
+    task = spawn_background_task(run())
+    response_cache_inflight[key] = task
+    task.add_done_callback(finished)
+    return task
+
+def cached_response(ttl: int, stale_while_revalidate: int = 0):
+    """
+    Cache a public endpoint's result for ttl seconds, then keep serving it
+    for up to stale_while_revalidate more seconds while it is refreshed.
+    The key is the endpoint plus its arguments, so only use it on
+    endpoints whose output does not depend on who is asking.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = (func.__qualname__, repr(args), repr(sorted(kwargs.items())))
+            entry = response_cache.get(key)
+            age = time.monotonic() - entry["stored_at"] if entry else None
+            
+            if entry and age < ttl:
+                status = "HIT"
+            elif entry and age < ttl + stale_while_revalidate:
+                status = "STALE"
+                refresh_cached_response(key, lambda: func(*args, **kwargs))
+            else:
+                status = "MISS"
+                # Shielded so a client hanging up does not cancel the shared computation
+                entry = await asyncio.shield(refresh_cached_response(key, lambda: func(*args, **kwargs)))
+                age = 0
+            
+            cache_control = f"public, max-age={max(0, int(ttl - age))}"
+            if stale_while_revalidate:
+                cache_control += f", stale-while-revalidate={stale_while_revalidate}"
+            return JSONResponse(
+                entry["value"],
+                headers={"Cache-Control": cache_control, "Age": str(int(age)), "X-Cache": status}
+            )
+        return wrapper
+    return decorator
+
+# ==================== CONDITIONAL GET ====================
+
+# List endpoints send a weak ETag built from a cheap version of the list
+# (document count plus newest created_at and updated_at, each answered from
+# an index) and reply 304 when the client already has that version. Every
+# write to a listed document sets updated_at, so the version moves with it.
+# Unfiltered lists take the count from collection metadata instead of a scan.
+
+async def list_version(collection, query: Dict[str, Any]) -> List[Any]:
+    count, newest, updated = await asyncio.gather(
+        collection.count_documents(query) if query else collection.estimated_document_count(),
+        collection.find_one(query, {"_id": 0, "created_at": 1}, sort=[("created_at", -1)]),
+        collection.find_one(query, {"_id": 0, "updated_at": 1}, sort=[("updated_at", -1)])
+    )
+    return [count, (newest or {}).get("created_at"), (updated or {}).get("updated_at")]
+
+def list_etag(*parts: Any) -> str:
+    return 'W/"' + hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest() + '"'
+
+async def conditional_json(request: Request, etag: str, produce) -> Response:
+    """304 if If-None-Match already names etag, otherwise await produce() and send it"""
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(jsonable_encoder(await produce()), headers=headers)
+
+# ==================== PACKAGE ENDPOINTS ====================
+
+PACKAGES = {
+    "silver": PackageInfo(name="Silver", amount=250.0, commission_rate=0.05),
+    "gold": PackageInfo(name="Gold", amount=500.0, commission_rate=0.10),
+    "platinum": PackageInfo(name="Platinum", amount=1000.0, commission_rate=0.15)
+}
+
+@api_router.get("/packages")
+@cached_response(ttl=3600, stale_while_revalidate=86400)
+async def get_packages():
+    return list(PACKAGES.values())
+
+
+@api_router.post("/investment/request")
+async def create_investment_request(
+    req: InvestmentRequestCreate,
+    user: User = Depends(require_auth)
+):
+    # Check if user already has an approved investment
+    existing_approved = await db.investment_requests.find_one({
+        "user_id": user.id,
+        "status": "approved"
+    })
+    
+    if existing_approved:
+        raise HTTPException(
+            status_code=400,
+            detail="Zaten onaylanmış bir yatırımınız var. Sadece bir kez yatırım yapabilirsiniz."
         )
     
     if req.package not in PACKAGES:
@@ -1275,18 +2564,25 @@ async def create_investment_request(
 
 
 @api_router.get("/investment/my-requests")
-async def get_my_investment_requests(user: User = Depends(require_auth)):
+async def get_my_investment_requests(request: Request, user: User = Depends(require_auth)):
     """Get current user's investment requests"""
-    requests = await db.investment_requests.find(
-        {"user_id": user.id},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
-    return {"requests": requests}
+    query = {"user_id": user.id}
+    
+    async def produce():
+        requests = await db.investment_requests.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
+        return {"requests": requests}
+    
+    etag = list_etag("investment_requests", user.id, await list_version(db.investment_requests, query))
+    return await conditional_json(request, etag, produce)
 
 @api_router.get("/admin/investment-requests")
-async def get_investment_requests(user: User = Depends(require_admin)):
-    requests = await db.investment_requests.find({}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    return {"requests": requests}
+async def get_investment_requests(request: Request, user: User = Depends(require_admin)):
+    async def produce():
+        requests = await db.investment_requests.find({}, {"_id": 0}).sort("created_at", -1).limit(100).to_list(100)
+        return {"requests": requests}
+    
+    etag = list_etag("investment_requests", await list_version(db.investment_requests, {}))
+    return await conditional_json(request, etag, produce)
 
 @api_router.get("/admin/approved-investments")
 async def get_approved_investments(user: User = Depends(require_admin)):
@@ -1294,12 +2590,13 @@ async def get_approved_investments(user: User = Depends(require_admin)):
     approved_requests = await db.investment_requests.find(
         {"status": "approved"},
         {"_id": 0}
-    ).sort("created_at", -1).to_list(500)
+    ).sort("created_at", -1).limit(500).to_list(500)
     
     # Enrich with user data
+    users = await fetch_users_by_id(req["user_id"] for req in approved_requests)
     result = []
     for req in approved_requests:
-        user_doc = await db.users.find_one({"id": req["user_id"]}, {"_id": 0, "name": 1, "email": 1})
+        user_doc = users.get(req["user_id"])
         result.append({
             **req,
             "user_name": user_doc.get("name") if user_doc else "Unknown",
@@ -1316,83 +2613,96 @@ async def get_pending_count(user: User = Depends(require_admin)):
 
 @api_router.post("/admin/investment-requests/{request_id}/approve")
 async def approve_investment_request(request_id: str, user: User = Depends(require_admin)):
-    request_doc = await db.investment_requests.find_one({"id": request_id}, {"_id": 0})
-    if not request_doc:
-        raise HTTPException(status_code=404, detail="Request not found")
-    
-    request = InvestmentRequest(**request_doc)
-    
-    # Get user
-    user_doc = await db.users.find_one({"id": request.user_id}, {"_id": 0})
-    if not user_doc:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    target_user = User(**user_doc)
-    
-    # Create actual investment
-    investment = Investment(
-        user_id=target_user.id,
-        package=request.package,
-        amount=request.amount,
-        investment_date=datetime.now(timezone.utc).isoformat()
-    )
-    
-    await db.investments.insert_one(investment.model_dump())
-    
-    # Update user (wallet_balance is NOT increased with investment amount, only with profits)
-    await db.users.update_one(
-        {"id": target_user.id},
-        {
-            "$set": {
-                "package": request.package,
-                "package_amount": request.amount,
-                "investment_date": investment.investment_date
-            },
-            "$inc": {
-                "total_invested": request.amount
-            }
-        }
-    )
-    
-    # Calculate and add commission to direct upline ONLY (single level)
-    if target_user.upline_id:
-        # Get commission rate based on package
-        commission_rates = {
-            "silver": 0.05,   # 5%
-            "gold": 0.10,     # 10%
-            "platinum": 0.15  # 15%
-        }
+    async def approve(session):
+        request_doc = await db.investment_requests.find_one({"id": request_id}, {"_id": 0}, session=session)
+        if not request_doc:
+            raise HTTPException(status_code=404, detail="Request not found")
         
-        commission_rate = commission_rates.get(request.package, 0)
-        commission_amount = request.amount * commission_rate
+        request = InvestmentRequest(**request_doc)
         
-        # Update direct upline's total commissions and wallet balance
-        await db.users.update_one(
-            {"id": target_user.upline_id},
-            {"$inc": {
-                "total_commissions": commission_amount,
-                "wallet_balance": commission_amount
-            }}
+        # Get user
+        user_doc = await db.users.find_one({"id": request.user_id}, {"_id": 0}, session=session)
+        if not user_doc:
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        target_user = User(**user_doc)
+        
+        # Mark request as approved first; a second approval finds nothing pending
+        claimed = await db.investment_requests.update_one(
+            {"id": request_id, "status": "pending"},
+            {"$set": {"status": "approved", "updated_at": datetime.now(timezone.utc).isoformat()}},
+            session=session
         )
+        if not claimed.modified_count:
+            raise HTTPException(status_code=400, detail="Request already processed")
         
-        # Create commission transaction for direct upline only
-        commission_transaction = Transaction(
-            user_id=target_user.upline_id,
-            type="commission",
-            amount=commission_amount,
-            status="completed",
-            description=f"Direkt komisyon - {target_user.name} ({request.package.upper()} paketi)"
+        # Create actual investment
+        investment = Investment(
+            user_id=target_user.id,
+            package=request.package,
+            amount=request.amount,
+            investment_date=datetime.now(timezone.utc).isoformat()
         )
-        await db.transactions.insert_one(commission_transaction.model_dump())
         
-        # Update volumes up the binary tree and check for binary earnings
-        await update_volumes_upline(target_user.id, request.amount)
+        await db.investments.insert_one(investment.model_dump(), session=session)
+        
+        # Update user (wallet_balance is NOT increased with investment amount, only with profits)
+        await db.users.update_one(
+            {"id": target_user.id},
+            {
+                "$set": {
+                    "package": request.package,
+                    "package_amount": request.amount,
+                    "investment_date": investment.investment_date
+                },
+                "$inc": {
+                    "total_invested": request.amount
+                }
+            },
+            session=session
+        )
+        
+        # Calculate and add commission to direct upline ONLY (single level)
+        if target_user.upline_id:
+            # Get commission rate based on package
+            commission_rates = {
+                "silver": 0.05,   # 5%
+                "gold": 0.10,     # 10%
+                "platinum": 0.15  # 15%
+            }
+            
+            commission_rate = commission_rates.get(request.package, 0)
+            commission_amount = request.amount * commission_rate
+            
+            # Create commission transaction for direct upline only
+            commission_transaction = Transaction(
+                user_id=target_user.upline_id,
+                type="commission",
+                amount=commission_amount,
+                status="completed",
+                description=f"Direkt komisyon - {target_user.name} ({request.package.upper()} paketi)"
+            )
+            
+            # Update direct upline's total commissions and wallet balance
+            await change_wallet(
+                target_user.upline_id,
+                commission_amount,
+                "commission",
+                commission_transaction.description,
+                ref=commission_transaction.id,
+                inc={"total_commissions": commission_amount},
+                session=session
+            )
+            await db.transactions.insert_one(commission_transaction.model_dump(), session=session)
+            
+            # Update volumes up the binary tree and check for binary earnings
+            await update_volumes_upline(target_user.id, request.amount, session=session)
+        
+        return request.amount
     
-    # Mark request as approved
-    await db.investment_requests.update_one(
-        {"id": request_id},
-        {"$set": {"status": "approved"}}
-    )
+    # Every write above commits or rolls back together
+    amount = await run_in_transaction(approve)
+    await bump_stats(total_investments=1, total_volume=amount)
     
     return {"success": True, "message": "Investment approved"}
 
@@ -1412,7 +2722,7 @@ async def reject_investment_request(request_id: str, user: User = Depends(requir
     # Mark request as rejected
     await db.investment_requests.update_one(
         {"id": request_id},
-        {"$set": {"status": "rejected"}}
+        {"$set": {"status": "rejected", "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
     
     return {"success": True, "message": "Investment rejected"}
@@ -1420,33 +2730,107 @@ async def reject_investment_request(request_id: str, user: User = Depends(requir
 
 # ==================== WITHDRAWAL ENDPOINTS ====================
 
+# Withdrawal request state machine. Funds move from wallet_balance to
+# held_balance when the request is made, so they cannot be spent twice:
+#   pending -> processing -> approved   held funds are paid out (settled)
+#   pending -> rejected                 held funds go back to the wallet (released)
+# Requests made before funds were held (funds_held False) are debited from
+# the wallet on approval instead. processing only lasts while an approval
+# runs; recover_stuck_withdrawals resolves requests an approval left there
+# when it died midway (possible only without multi-document transactions).
+WITHDRAWAL_BULK_LIMIT = 1000
+WITHDRAWAL_BULK_CHUNK_SIZE = 200
+WITHDRAWAL_PROCESSING_TIMEOUT_SECONDS = 300
+
+def withdrawal_transaction(withdrawal: WithdrawalRequest, **fields) -> Transaction:
+    return Transaction(
+        user_id=withdrawal.user_id,
+        type="withdrawal",
+        amount=withdrawal.amount,
+        status="completed",
+        description=f"IBAN: {withdrawal.iban}",
+        **fields
+    )
+
+async def transition_withdrawal(request_id: str, from_status: str, to_status: str, session=None, **fields) -> Dict[str, Any]:
+    """Compare-and-set a request's status; 404/400 if it is missing or already moved on"""
+    request_doc = await db.withdrawal_requests.find_one_and_update(
+        {"id": request_id, "status": from_status},
+        {"$set": {"status": to_status, "updated_at": datetime.now(timezone.utc).isoformat(), **fields}},
+        projection={"_id": 0},
+        session=session
+    )
+    if not request_doc:
+        if not await db.withdrawal_requests.find_one({"id": request_id}, {"_id": 0, "id": 1}, session=session):
+            raise HTTPException(status_code=404, detail="Request not found")
+        raise HTTPException(status_code=400, detail="Request already processed")
+    return request_doc
+
+async def settle_withdrawal(withdrawal: WithdrawalRequest, transaction: Transaction, session=None) -> bool:
+    """Pay out an approved request; False if the funds are not there"""
+    if withdrawal.funds_held:
+        result = await db.users.update_one(
+            {"id": withdrawal.user_id, "held_balance": {"$gte": withdrawal.amount}},
+            {"$inc": {"held_balance": -withdrawal.amount}},
+            session=session
+        )
+        return result.modified_count == 1
+    
+    # Balance check and debit are a single conditional update, so concurrent
+    # approvals for the same user can never overdraw the wallet
+    debited = await change_wallet(
+        withdrawal.user_id,
+        -withdrawal.amount,
+        "withdrawal",
+        transaction.description,
+        ref=transaction.id,
+        guard={"wallet_balance": {"$gte": withdrawal.amount}},
+        session=session
+    )
+    return debited is not None
+
 @api_router.post("/withdrawal/request")
 async def create_withdrawal_request(
     req: WithdrawalRequestCreate,
     user: User = Depends(require_auth)
 ):
-    # All earnings are in wallet_balance (commissions and binary bonus)
-    # Weekly earnings are kept separate until week completion
-    available_balance = user.wallet_balance
-    
     if req.amount <= 0:
         raise HTTPException(status_code=400, detail="Çekim tutarı 0'dan büyük olmalıdır")
     
-    if req.amount > available_balance:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Yetersiz bakiye. Kullanılabilir bakiye: ${available_balance:.2f}"
-        )
-    
     # Create withdrawal request
     withdrawal = WithdrawalRequest(
         user_id=user.id,
         full_name=req.full_name,
         iban=req.iban,
-        amount=req.amount
+        amount=req.amount,
+        funds_held=True
     )
     
-    await db.withdrawal_requests.insert_one(withdrawal.model_dump())
+    async def create(session):
+        # All earnings are in wallet_balance (commissions and binary bonus).
+        # The requested amount is held until an admin approves or rejects it.
+        held = await change_wallet(
+            user.id,
+            -req.amount,
+            "withdrawal_hold",
+            f"IBAN: {req.iban}",
+            ref=withdrawal.id,
+            inc={"held_balance": req.amount},
+            guard={"wallet_balance": {"$gte": req.amount}},
+            session=session
+        )
+        if held is None:
+            user_doc = await db.users.find_one({"id": user.id}, {"_id": 0, "wallet_balance": 1}, session=session)
+            available_balance = (user_doc or {}).get("wallet_balance", 0.0)
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Yetersiz bakiye. Kullanılabilir bakiye: ${available_balance:.2f}"
+            )
+        
+        await db.withdrawal_requests.insert_one(withdrawal.model_dump(), session=session)
+    
+    await run_in_transaction(create)
+    await bump_stats(pending_withdrawals=1)
     
     return {
         "success": True,
@@ -1455,24 +2839,31 @@ async def create_withdrawal_request(
     }
 
 @api_router.get("/withdrawal/my-requests")
-async def get_my_withdrawal_requests(user: User = Depends(require_auth)):
+async def get_my_withdrawal_requests(request: Request, user: User = Depends(require_auth)):
     """Get current user's withdrawal requests"""
-    requests = await db.withdrawal_requests.find(
-        {"user_id": user.id},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
-    return {"requests": requests}
+    query = {"user_id": user.id}
+    
+    async def produce():
+        requests = await db.withdrawal_requests.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
+        return {"requests": requests}
+    
+    etag = list_etag("withdrawal_requests", user.id, await list_version(db.withdrawal_requests, query))
+    return await conditional_json(request, etag, produce)
 
 @api_router.get("/admin/withdrawal-requests")
-async def get_withdrawal_requests(user: User = Depends(require_admin)):
+async def get_withdrawal_requests(request: Request, user: User = Depends(require_admin)):
     """Get all withdrawal requests for admin"""
+    etag = list_etag("withdrawal_requests", await list_version(db.withdrawal_requests, {}))
+    return await conditional_json(request, etag, list_withdrawal_requests)
+
+async def list_withdrawal_requests() -> Dict[str, Any]:
     requests = await db.withdrawal_requests.find({}, {"_id": 0}).sort("created_at", -1).to_list(100)
     
-    # Get user info for each request
+    # Get user info for all requests at once
+    users = await fetch_users_by_id(req_doc["user_id"] for req_doc in requests)
     result = []
     for req_doc in requests:
-        req = WithdrawalRequest(**req_doc)
-        user_doc = await db.users.find_one({"id": req.user_id}, {"_id": 0, "name": 1, "email": 1})
+        user_doc = users.get(req_doc["user_id"])
         result.append({
             **req_doc,
             "user_name": user_doc.get("name") if user_doc else "Unknown",
@@ -1481,75 +2872,201 @@ async def get_withdrawal_requests(user: User = Depends(require_admin)):
     
     return {"requests": result}
 
-@api_router.post("/admin/withdrawal-requests/{request_id}/approve")
-async def approve_withdrawal_request(request_id: str, user: User = Depends(require_admin)):
-    """Approve withdrawal request and deduct from user balance"""
-    request_doc = await db.withdrawal_requests.find_one({"id": request_id}, {"_id": 0})
-    if not request_doc:
-        raise HTTPException(status_code=404, detail="Request not found")
-    
-    withdrawal = WithdrawalRequest(**request_doc)
-    
-    if withdrawal.status != "pending":
-        raise HTTPException(status_code=400, detail="Request already processed")
-    
-    # Get user
-    user_doc = await db.users.find_one({"id": withdrawal.user_id}, {"_id": 0})
-    if not user_doc:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    target_user = User(**user_doc)
-    
-    # Check available balance (from wallet_balance only)
-    available_balance = target_user.wallet_balance
-    
-    if withdrawal.amount > available_balance:
+async def approve_withdrawal(request_id: str, session=None):
+    """Approve one request and pay it out; 400 if the funds are not there"""
+    # Claim the request first so two admins approving it cannot both pay out.
+    # The claim records the transaction id so a stuck claim can be resolved.
+    transaction_id = str(uuid.uuid4())
+    withdrawal = WithdrawalRequest(**await transition_withdrawal(
+        request_id, "pending", "processing", session,
+        transaction_id=transaction_id,
+        processing_at=datetime.now(timezone.utc).isoformat()
+    ))
+    transaction = withdrawal_transaction(withdrawal, id=transaction_id)
+    
+    # Recorded before the payout: recover_stuck_withdrawals treats a claim with
+    # its transaction as paid, so a crash can never lead to paying twice
+    await db.transactions.insert_one(transaction.model_dump(), session=session)
+    if not await settle_withdrawal(withdrawal, transaction, session):
+        # Undo the claim explicitly in case we are not inside a transaction
+        await db.transactions.delete_one({"id": transaction_id}, session=session)
+        await db.withdrawal_requests.update_one(
+            {"id": request_id, "status": "processing"},
+            {
+                "$set": {"status": "pending", "updated_at": datetime.now(timezone.utc).isoformat()},
+                "$unset": {"transaction_id": "", "processing_at": ""}
+            },
+            session=session
+        )
         raise HTTPException(status_code=400, detail="User has insufficient balance")
     
-    # Simply deduct from wallet_balance
-    await db.users.update_one(
-        {"id": target_user.id},
-        {"$inc": {"wallet_balance": -withdrawal.amount}}
-    )
-    
-    # Mark request as approved
     await db.withdrawal_requests.update_one(
-        {"id": request_id},
-        {"$set": {"status": "approved"}}
-    )
-    
-    # Create transaction record
-    transaction = Transaction(
-        user_id=target_user.id,
-        type="withdrawal",
-        amount=withdrawal.amount,
-        status="completed",
-        description=f"IBAN: {withdrawal.iban}"
+        {"id": request_id, "status": "processing"},
+        {"$set": {"status": "approved", "updated_at": datetime.now(timezone.utc).isoformat()}},
+        session=session
     )
-    await db.transactions.insert_one(transaction.model_dump())
+
+@api_router.post("/admin/withdrawal-requests/{request_id}/approve")
+async def approve_withdrawal_request(request_id: str, user: User = Depends(require_admin)):
+    """Approve withdrawal request and pay out the held funds"""
+    await run_in_transaction(lambda session: approve_withdrawal(request_id, session))
+    await bump_stats(pending_withdrawals=-1)
     
     return {"success": True, "message": "Withdrawal approved"}
 
 
+@api_router.post("/admin/withdrawal-requests/bulk-approve")
+async def bulk_approve_withdrawal_requests(
+    req: WithdrawalBulkApprove,
+    user: User = Depends(require_admin)
+):
+    """
+    Approve many requests with held funds. Each chunk is claimed with one
+    update_many and settled with one bulk_write per collection, inside a
+    transaction; a chunk whose held balances fall short is rolled back and
+    reported as failed. Requests without held funds are skipped and must be
+    approved one by one.
+    """
+    request_ids = list(dict.fromkeys(req.request_ids))
+    if len(request_ids) > WITHDRAWAL_BULK_LIMIT:
+        raise HTTPException(status_code=400, detail=f"En fazla {WITHDRAWAL_BULK_LIMIT} talep birlikte onaylanabilir")
+    
+    async def approve_each(ids: List[str]) -> tuple:
+        """Without a transaction a partly settled chunk can't be rolled back, so go one by one"""
+        pending = await db.withdrawal_requests.find(
+            {"id": {"$in": ids}, "status": "pending", "funds_held": True},
+            {"_id": 0, "id": 1}
+        ).to_list(None)
+        approved, failed = [], []
+        for doc in pending:
+            try:
+                await approve_withdrawal(doc["id"])
+                approved.append(doc["id"])
+            except HTTPException:
+                failed.append(doc["id"])
+        return approved, failed
+    
+    async def approve_chunk(ids: List[str], session) -> tuple:
+        if session is None:
+            return await approve_each(ids)
+        
+        batch_id = str(uuid.uuid4())
+        await db.withdrawal_requests.update_many(
+            {"id": {"$in": ids}, "status": "pending", "funds_held": True},
+            {"$set": {"status": "approved", "batch_id": batch_id, "updated_at": datetime.now(timezone.utc).isoformat()}},
+            session=session
+        )
+        claimed = [WithdrawalRequest(**doc) for doc in await db.withdrawal_requests.find(
+            {"batch_id": batch_id},
+            {"_id": 0},
+            session=session
+        ).to_list(None)]
+        if not claimed:
+            return [], []
+        
+        held_by_user: Dict[str, float] = {}
+        for withdrawal in claimed:
+            held_by_user[withdrawal.user_id] = held_by_user.get(withdrawal.user_id, 0.0) + withdrawal.amount
+        
+        result = await db.users.bulk_write([
+            UpdateOne(
+                {"id": user_id, "held_balance": {"$gte": amount}},
+                {"$inc": {"held_balance": -amount}}
+            ) for user_id, amount in held_by_user.items()
+        ], ordered=False, session=session)
+        if result.modified_count != len(held_by_user):
+            raise HTTPException(status_code=409, detail="Held balance does not cover the approved requests")
+        
+        transactions = [withdrawal_transaction(withdrawal) for withdrawal in claimed]
+        await db.transactions.insert_many([tx.model_dump() for tx in transactions], ordered=False, session=session)
+        await db.withdrawal_requests.bulk_write([
+            UpdateOne({"id": withdrawal.id}, {"$set": {"transaction_id": tx.id}, "$unset": {"batch_id": ""}})
+            for withdrawal, tx in zip(claimed, transactions)
+        ], ordered=False, session=session)
+        return [withdrawal.id for withdrawal in claimed], []
+    
+    approved, failed = [], []
+    for i in range(0, len(request_ids), WITHDRAWAL_BULK_CHUNK_SIZE):
+        chunk = request_ids[i:i + WITHDRAWAL_BULK_CHUNK_SIZE]
+        try:
+            chunk_approved, chunk_failed = await run_in_transaction(
+                lambda session, chunk=chunk: approve_chunk(chunk, session)
+            )
+        except HTTPException:
+            # The transaction rolled the chunk back, so its requests are still pending
+            chunk_approved, chunk_failed = [], chunk
+        approved.extend(chunk_approved)
+        failed.extend(chunk_failed)
+    await bump_stats(pending_withdrawals=-len(approved))
+    
+    done = set(approved) | set(failed)
+    return {
+        "success": not failed,
+        "approved": len(approved),
+        "failed": failed,
+        "skipped": [request_id for request_id in request_ids if request_id not in done]
+    }
+
+
 @api_router.post("/admin/withdrawal-requests/{request_id}/reject")
 async def reject_withdrawal_request(request_id: str, user: User = Depends(require_admin)):
-    """Reject withdrawal request"""
-    request_doc = await db.withdrawal_requests.find_one({"id": request_id}, {"_id": 0})
-    if not request_doc:
-        raise HTTPException(status_code=404, detail="Request not found")
+    """Reject withdrawal request and release the held funds"""
+    async def reject(session):
+        # Mark request as rejected, only if no approval got to it first
+        withdrawal = WithdrawalRequest(**await transition_withdrawal(request_id, "pending", "rejected", session))
+        if withdrawal.funds_held:
+            await change_wallet(
+                withdrawal.user_id,
+                withdrawal.amount,
+                "withdrawal_release",
+                "Çekim talebi reddedildi",
+                ref=withdrawal.id,
+                inc={"held_balance": -withdrawal.amount},
+                session=session
+            )
     
-    withdrawal = WithdrawalRequest(**request_doc)
+    await run_in_transaction(reject)
+    await bump_stats(pending_withdrawals=-1)
     
-    if withdrawal.status != "pending":
-        raise HTTPException(status_code=400, detail="Request already processed")
+    return {"success": True, "message": "Withdrawal request rejected"}
+
+async def recover_stuck_withdrawals() -> Dict[str, Any]:
+    """
+    Resolve requests left in processing by an approval that died: approved
+    if its withdrawal transaction was recorded, otherwise back to pending
+    with the funds still held, so an admin can approve or reject it again.
+    """
+    now = datetime.now(timezone.utc)
+    cutoff = (now - timedelta(seconds=WITHDRAWAL_PROCESSING_TIMEOUT_SECONDS)).isoformat()
+    approved = returned = 0
     
-    # Mark request as rejected
-    await db.withdrawal_requests.update_one(
-        {"id": request_id},
-        {"$set": {"status": "rejected"}}
+    cursor = db.withdrawal_requests.find(
+        {"status": "processing", "processing_at": {"$lt": cutoff}},
+        {"_id": 0, "id": 1, "transaction_id": 1}
     )
+    async for doc in cursor:
+        stuck = {"id": doc["id"], "status": "processing"}
+        if await db.transactions.find_one({"id": doc.get("transaction_id")}, {"_id": 1}):
+            result = await db.withdrawal_requests.update_one(
+                stuck,
+                {"$set": {"status": "approved", "updated_at": now.isoformat()}}
+            )
+            approved += result.modified_count
+        else:
+            result = await db.withdrawal_requests.update_one(
+                stuck,
+                {
+                    "$set": {"status": "pending", "updated_at": now.isoformat()},
+                    "$unset": {"transaction_id": "", "processing_at": ""}
+                }
+            )
+            returned += result.modified_count
     
-    return {"success": True, "message": "Withdrawal request rejected"}
+    if approved:
+        await bump_stats(pending_withdrawals=-approved)
+    if approved or returned:
+        logger.warning(f"Recovered stuck withdrawals: {approved} approved, {returned} back to pending")
+    return {"approved": approved, "returned_to_pending": returned}
 
 
 @api_router.delete("/admin/users/{user_id}")
@@ -1567,11 +3084,27 @@ async def delete_user(user_id: str, admin: User = Depends(require_admin)):
     await db.users.delete_one({"id": user_id})
     
     # Delete related data
+    active_investments = await db.investments.count_documents({"user_id": user_id, "is_active": True})
+    pending_withdrawals = await db.withdrawal_requests.count_documents({"user_id": user_id, "status": "pending"})
     await db.investments.delete_many({"user_id": user_id})
     await db.investment_requests.delete_many({"user_id": user_id})
     await db.withdrawal_requests.delete_many({"user_id": user_id})
     await db.transactions.delete_many({"user_id": user_id})
+    for partition in await transaction_partitions():
+        deleted = await db[partition["collection"]].delete_many({"user_id": user_id})
+        if deleted.deleted_count:
+            await db.transaction_partitions.update_one(
+                {"_id": partition["collection"]},
+                {"$inc": {"count": -deleted.deleted_count}}
+            )
     await db.referral_codes.delete_many({"user_id": user_id})
+    forget_active_referral_code(user_id)
+    await bump_stats(
+        total_users=-1,
+        total_investments=-active_investments,
+        total_volume=-user_doc.get("total_invested", 0),
+        pending_withdrawals=-pending_withdrawals
+    )
     
     return {"success": True, "message": "User deleted"}
 
@@ -1632,16 +3165,6 @@ async def create_investment(
             
             # Pay commission to upline
             commission = package_info.amount * package_info.commission_rate
-            await db.users.update_one(
-                {"id": upline_user.id},
-                {"$inc": {
-                    "total_commissions": commission,
-                    "wallet_balance": commission,
-                    "career_points": package_info.amount
-                }}
-            )
-            
-            # Create commission transaction
             commission_tx = Transaction(
                 user_id=upline_user.id,
                 type="commission",
@@ -1649,6 +3172,16 @@ async def create_investment(
                 status="completed",
                 description=f"Referral commission from {user.name}"
             )
+            await change_wallet(
+                upline_user.id,
+                commission,
+                "commission",
+                commission_tx.description,
+                ref=commission_tx.id,
+                inc={"total_commissions": commission, "career_points": package_info.amount}
+            )
+            
+            # Create commission transaction
             await db.transactions.insert_one(commission_tx.model_dump())
     
     await db.users.update_one({"id": user.id}, {"$set": update_data})
@@ -1663,62 +3196,103 @@ async def create_investment(
         description=f"{package.capitalize()} package purchase"
     )
     await db.transactions.insert_one(tx.model_dump())
+    await bump_stats(total_investments=1, total_volume=package_info.amount)
     
     return {"message": "Investment created successfully", "investment": investment.model_dump()}
 
-async def update_volumes_upline(user_id: str, amount: float):
-    """Update left/right volumes up the tree and check for binary earnings"""
-    current_user = await db.users.find_one({"id": user_id}, {"_id": 0})
-    if not current_user:
+async def update_volumes_upline(user_id: str, amount: float, session=None):
+    """
+    Update left/right volumes up the tree and check for binary earnings.
+    The whole upline chain is read with one $graphLookup and its volumes are
+    written back in bulk instead of a read and a write per level.
+    """
+    chains = await db.users.aggregate([
+        {"$match": {"id": user_id}},
+        {"$graphLookup": {
+            "from": "users",
+            "startWith": "$upline_id",
+            "connectFromField": "upline_id",
+            "connectToField": "id",
+            "as": "uplines"
+        }},
+        {"$project": {
+            "_id": 0, "id": 1, "upline_id": 1, "position": 1,
+            "uplines.id": 1, "uplines.upline_id": 1, "uplines.position": 1
+        }}
+    ], session=session).to_list(1)
+    if not chains:
+        return
+    
+    current = chains[0]
+    uplines = {u["id"]: u for u in current["uplines"]}
+    
+    # Walk to the root; the seen set stops the walk on a cyclic (corrupted) tree
+    volume_sides = {}
+    seen = {current["id"]}
+    while current.get("upline_id") in uplines and current["upline_id"] not in seen:
+        upline = uplines[current["upline_id"]]
+        # Update volume based on position
+        if current.get("position") in ("left", "right"):
+            volume_sides[upline["id"]] = f"{current['position']}_volume"
+        seen.add(upline["id"])
+        current = upline
+    
+    seen.discard(user_id)
+    if not seen:
         return
     
-    current = User(**current_user)
+    if volume_sides:
+        await db.users.bulk_write([
+            UpdateOne({"id": upline_id}, {"$inc": {side: amount}})
+            for upline_id, side in volume_sides.items()
+        ], ordered=False, session=session)
     
-    # Update volume based on position
-    if current.position == "left":
-        await db.users.update_one(
-            {"id": current.upline_id},
-            {"$inc": {"left_volume": amount}}
+    # Check binary earnings (need $1000 + $1000 on both sides)
+    upline_docs = await db.users.find(
+        {"id": {"$in": list(seen)}},
+        {"_id": 0, "id": 1, "left_volume": 1, "right_volume": 1, "binary_earnings": 1},
+        session=session
+    ).to_list(None)
+    
+    binary_txs = []
+    for upline in upline_docs:
+        left_volume = upline.get("left_volume", 0.0)
+        right_volume = upline.get("right_volume", 0.0)
+        paid = upline.get("binary_earnings", 0.0)
+        if left_volume < 1000 or right_volume < 1000:
+            continue
+        
+        # Calculate binary earnings
+        binary_earnings = (min(left_volume, right_volume) // 1000) * 100
+        if binary_earnings <= paid:
+            continue
+        
+        new_earnings = binary_earnings - paid
+        binary_tx = Transaction(
+            user_id=upline["id"],
+            type="binary",
+            amount=new_earnings,
+            status="completed",
+            description=f"Binary Eşleşme Bonusu - Sol: ${left_volume:,.0f} / Sağ: ${right_volume:,.0f}"
         )
-    elif current.position == "right":
-        await db.users.update_one(
-            {"id": current.upline_id},
-            {"$inc": {"right_volume": amount}}
+        # Add to wallet_balance and update binary_earnings tracker, unless a
+        # concurrent investment already paid this level (the tracker moved on)
+        credited = await change_wallet(
+            upline["id"],
+            new_earnings,
+            "binary",
+            binary_tx.description,
+            ref=binary_tx.id,
+            set_fields={"binary_earnings": binary_earnings},
+            guard={"binary_earnings": upline.get("binary_earnings")},
+            session=session
         )
+        if credited is not None:
+            binary_txs.append(binary_tx.model_dump())
     
-    # Check binary earnings (need $1000 + $1000 on both sides)
-    if current.upline_id:
-        upline = await db.users.find_one({"id": current.upline_id}, {"_id": 0})
-        if upline:
-            upline_user = User(**upline)
-            if upline_user.left_volume >= 1000 and upline_user.right_volume >= 1000:
-                # Calculate binary earnings
-                lesser_volume = min(upline_user.left_volume, upline_user.right_volume)
-                binary_earnings = (lesser_volume // 1000) * 100
-                
-                if binary_earnings > upline_user.binary_earnings:
-                    new_earnings = binary_earnings - upline_user.binary_earnings
-                    # Add to wallet_balance and update binary_earnings tracker
-                    await db.users.update_one(
-                        {"id": upline_user.id},
-                        {
-                            "$set": {"binary_earnings": binary_earnings},
-                            "$inc": {"wallet_balance": new_earnings}
-                        }
-                    )
-                    
-                    # Create transaction for tracking
-                    binary_tx = Transaction(
-                        user_id=upline_user.id,
-                        type="binary",
-                        amount=new_earnings,
-                        status="completed",
-                        description=f"Binary Eşleşme Bonusu - Sol: ${upline_user.left_volume:,.0f} / Sağ: ${upline_user.right_volume:,.0f}"
-                    )
-                    await db.transactions.insert_one(binary_tx.model_dump())
-            
-            # Continue up the tree (max 11 levels)
-            await update_volumes_upline(upline_user.id, amount)
+    if binary_txs:
+        # Create transactions for tracking
+        await db.transactions.insert_many(binary_txs, ordered=False, session=session)
 
 # ==================== USER DASHBOARD ====================
 
@@ -1739,10 +3313,7 @@ async def get_dashboard(user: User = Depends(require_auth)):
     )
     
     # Get recent transactions
-    transactions = await db.transactions.find(
-        {"user_id": user.id},
-        {"_id": 0}
-    ).sort("created_at", -1).limit(10).to_list(10)
+    transactions = await find_transactions({"user_id": user.id}, 10)
     
     # Get left and right children
     left_child = None
@@ -1869,56 +3440,205 @@ async def get_full_network_tree(admin: User = Depends(require_super_admin)):
     
     return {"trees": trees, "total_roots": len(trees)}
 
-# ==================== WITHDRAWAL REQUESTS ====================
+# ==================== ADMIN ENDPOINTS ====================
 
-@api_router.post("/withdrawal/request")
-async def request_withdrawal(
-    amount: float,
-    crypto_type: str,
-    wallet_address: str,
-    user: User = Depends(require_auth)
-):
-    if amount <= 0:
-        raise HTTPException(status_code=400, detail="Invalid amount")
-    
-    if user.wallet_balance < amount:
-        raise HTTPException(status_code=400, detail="Insufficient balance")
-    
-    # Create withdrawal transaction
-    tx = Transaction(
-        user_id=user.id,
-        type="withdrawal",
-        amount=amount,
-        crypto_type=crypto_type,
-        status="pending",
-        wallet_address=wallet_address,
-        description="Withdrawal request"
-    )
-    
-    await db.transactions.insert_one(tx.model_dump())
-    
-    # Deduct from wallet
-    await db.users.update_one(
-        {"id": user.id},
-        {"$inc": {"wallet_balance": -amount}}
-    )
-    
-    return {"message": "Withdrawal request submitted", "transaction": tx.model_dump()}
+# Fields the admin user list returns by default, and those it may return
+# with fields=. Password hashes and tokens are never exposed.
+ADMIN_USER_LIST_FIELDS = (
+    "id", "name", "email", "referral_code", "upline_id", "position", "package",
+    "wallet_balance", "total_invested", "total_commissions", "binary_earnings",
+    "is_admin", "created_at", "last_login"
+)
+ADMIN_USER_SELECTABLE_FIELDS = set(User.model_fields) - {
+    "password_hash", "verification_token", "verification_token_expires",
+    "password_change_token", "password_change_token_expires", "new_password_hash",
+    "name_lower", "email_lower"
+}
 
-# ==================== ADMIN ENDPOINTS ====================
+def encode_cursor(values: List[Any]) -> str:
+    """Opaque page cursor for keyset pagination"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Geçersiz sayfa imleci")
+    # Values go straight into the query, where an object would be read as an operator
+    if not all(v is None or isinstance(v, (str, int, float)) for v in values):
+        raise HTTPException(status_code=400, detail="Geçersiz sayfa imleci")
+    return values
 
 @api_router.get("/admin/users")
-async def admin_get_users(admin: User = Depends(require_admin)):
-    users = await db.users.find({}, {"_id": 0}).to_list(1000)
-    return users
+async def admin_get_users(
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    fields: Optional[str] = None,
+    admin: User = Depends(require_admin)
+):
+    """
+    Users newest first, paged by keyset on (created_at, id) so every page
+    costs one index range scan regardless of how deep it is. Pass
+    next_cursor back as cursor for the following page.
+    """
+    limit = max(1, min(limit, 500))
+    
+    selected = ADMIN_USER_LIST_FIELDS
+    if fields:
+        selected = tuple(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+        unknown = [f for f in selected if f not in ADMIN_USER_SELECTABLE_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Geçersiz alan: {', '.join(unknown)}")
+    projection = {"_id": 0, "id": 1, "created_at": 1, **{f: 1 for f in selected}}
+    
+    query: Dict[str, Any] = {}
+    if cursor:
+        created_at, user_id = decode_cursor(cursor, 2)
+        query = {"$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": user_id}}
+        ]}
+    
+    users = await db.users.find(query, projection).sort(
+        [("created_at", -1), ("id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = encode_cursor([users[-1]["created_at"], users[-1]["id"]])
+    
+    return {"users": users, "next_cursor": next_cursor}
+
+def plan_stages(plan: Dict[str, Any]) -> List[str]:
+    """Stage names of an explain() winning plan, outermost first"""
+    plan = plan.get("queryPlan", plan)
+    stages = [plan.get("stage", "")]
+    for child in [plan.get("inputStage"), *plan.get("inputStages", [])]:
+        if child:
+            stages.extend(plan_stages(child))
+    return stages
+
+@api_router.get("/admin/users/search")
+async def admin_search_users(
+    q: Optional[str] = None,
+    package: Optional[str] = None,
+    is_admin: Optional[bool] = None,
+    placed: Optional[bool] = None,
+    min_balance: Optional[float] = None,
+    max_balance: Optional[float] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+    explain: bool = False,
+    admin: User = Depends(require_admin)
+):
+    """
+    Prefix search on name / email plus filters, every one of them served by
+    an index. explain=true adds the winning query plan so it can be checked
+    for an index scan without a blocking in-memory sort.
+    """
+    limit = max(1, min(limit, 500))
+    filters: List[Dict[str, Any]] = []
+    
+    term = normalize_search(q) if q else ""
+    if term:
+        prefix = {"$regex": f"^{re.escape(term)}"}
+        if "@" in term:
+            filters.append({"email_lower": prefix})
+            sort_field = "email_lower"
+        else:
+            filters.append({"$or": [{"name_lower": prefix}, {"email_lower": prefix}]})
+            sort_field = "name_lower"
+        sort = [(sort_field, 1), ("id", 1)]
+    else:
+        sort_field = "created_at"
+        sort = [("created_at", -1), ("id", -1)]
+    
+    if package is not None:
+        filters.append({"package": None if package == "none" else package})
+    if is_admin is not None:
+        # $in rather than $ne keeps the index bounds to points, so the index still gives the sort order
+        filters.append({"is_admin": True} if is_admin else {"is_admin": {"$in": [False, None]}})
+    if placed is not None:
+        filters.append({"position": {"$in": ["left", "right"]}} if placed else {"position": None})
+    balance: Dict[str, float] = {}
+    if min_balance is not None:
+        balance["$gte"] = min_balance
+    if max_balance is not None:
+        balance["$lte"] = max_balance
+    if balance:
+        filters.append({"wallet_balance": balance})
+    
+    if cursor:
+        key, user_id = decode_cursor(cursor, 2)
+        direction = "$gt" if sort[0][1] == 1 else "$lt"
+        filters.append({"$or": [
+            {sort_field: {direction: key}},
+            {sort_field: key, "id": {direction: user_id}}
+        ]})
+    
+    query = {"$and": filters} if filters else {}
+    projection = {"_id": 0, **{f: 1 for f in ADMIN_USER_LIST_FIELDS}, sort_field: 1}
+    
+    users = await db.users.find(query, projection).sort(sort).limit(limit + 1).to_list(limit + 1)
+    
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = encode_cursor([users[-1].get(sort_field), users[-1]["id"]])
+    for user_doc in users:
+        user_doc.pop("name_lower", None)
+        user_doc.pop("email_lower", None)
+    
+    result: Dict[str, Any] = {"users": users, "next_cursor": next_cursor}
+    if explain:
+        plan = await db.users.find(query, projection).sort(sort).limit(limit + 1).explain()
+        stages = plan_stages(plan["queryPlanner"]["winningPlan"])
+        result["plan"] = {
+            "stages": stages,
+            "index_scan": "IXSCAN" in stages and "SORT" not in stages,
+            "collection_scan": "COLLSCAN" in stages,
+            "blocking_sort": "SORT" in stages
+        }
+    return result
+
+async def backfill_user_search_fields():
+    """Set name_lower / email_lower on users created before they were stored"""
+    while True:
+        users = await db.users.find(
+            {"$or": [{"name_lower": {"$exists": False}}, {"email_lower": {"$exists": False}}]},
+            {"_id": 0, "id": 1, "name": 1, "email": 1}
+        ).limit(1000).to_list(1000)
+        if not users:
+            return
+        await db.users.bulk_write([
+            UpdateOne({"id": u["id"]}, {"$set": {
+                "name_lower": normalize_search(u.get("name") or ""),
+                "email_lower": normalize_search(u.get("email") or "")
+            }}) for u in users
+        ], ordered=False)
 
 @api_router.get("/admin/transactions")
-async def admin_get_transactions(admin: User = Depends(require_admin)):
-    transactions = await db.transactions.find(
-        {},
-        {"_id": 0}
-    ).sort("created_at", -1).limit(100).to_list(100)
-    return transactions
+async def admin_get_transactions(
+    request: Request,
+    before: Optional[str] = None,
+    limit: int = 100,
+    admin: User = Depends(require_admin)
+):
+    """Newest transactions; pass the last created_at as before to page back into the archives"""
+    limit = max(1, min(limit, 500))
+    # Archives only change through archiving and user deletion, both of
+    # which keep the partition counts current
+    partitions = [(p["collection"], p.get("count")) for p in await transaction_partitions()]
+    etag = list_etag("transactions", before, limit, partitions, await list_version(db.transactions, {}))
+    return await conditional_json(request, etag, lambda: find_transactions({}, limit, before))
+
+async def raise_transaction_not_pending(tx_id: str, session=None):
+    if await db.transactions.find_one({"id": tx_id}, {"_id": 1}, session=session):
+        raise HTTPException(status_code=400, detail="Bu işlem zaten sonuçlandırılmış")
+    raise HTTPException(status_code=404, detail="Transaction not found")
 
 @api_router.post("/admin/transactions/{tx_id}/approve")
 async def admin_approve_transaction(
@@ -1926,22 +3646,28 @@ async def admin_approve_transaction(
     tx_hash: Optional[str] = None,
     admin: User = Depends(require_admin)
 ):
-    tx = await db.transactions.find_one({"id": tx_id}, {"_id": 0})
-    if not tx:
-        raise HTTPException(status_code=404, detail="Transaction not found")
-    
     update_data = {"status": "completed"}
     if tx_hash:
         update_data["tx_hash"] = tx_hash
     
-    await db.transactions.update_one({"id": tx_id}, {"$set": update_data})
-    
-    # If it's a deposit, update user balance
-    if tx["type"] == "deposit":
-        await db.users.update_one(
-            {"id": tx["user_id"]},
-            {"$inc": {"wallet_balance": tx["amount"]}}
+    async def approve(session):
+        # Only a pending transaction can be approved, so a repeated click can't credit twice
+        tx = await db.transactions.find_one_and_update(
+            {"id": tx_id, "status": "pending"},
+            {"$set": {**update_data, "updated_at": datetime.now(timezone.utc).isoformat()}},
+            projection={"_id": 0},
+            session=session
         )
+        if not tx:
+            await raise_transaction_not_pending(tx_id, session)
+        
+        # If it's a deposit, update user balance
+        if tx["type"] == "deposit":
+            await change_wallet(tx["user_id"], tx["amount"], "deposit", tx.get("description", ""), ref=tx_id, session=session)
+            # lets reconciliation tell credited deposits apart
+            await db.transactions.update_one({"id": tx_id}, {"$set": {"wallet_credited": True}}, session=session)
+    
+    await run_in_transaction(approve)
     
     return {"message": "Transaction approved"}
 
@@ -1975,18 +3701,14 @@ async def admin_distribute_profit(
     await db.transactions.insert_one(transaction.model_dump())
     
     # Update user balance and weekly profit tracking
-    await db.users.update_one(
-        {"id": user_id},
-        {
-            "$inc": {
-                "wallet_balance": amount,
-                "weekly_profit_count": 1,
-                "total_weekly_profit": amount
-            },
-            "$set": {
-                "last_profit_date": datetime.now(timezone.utc).isoformat()
-            }
-        }
+    await change_wallet(
+        user_id,
+        amount,
+        "profit",
+        description,
+        ref=transaction.id,
+        inc={"weekly_profit_count": 1, "total_weekly_profit": amount},
+        set_fields={"last_profit_date": datetime.now(timezone.utc).isoformat()}
     )
     
     return {
@@ -1998,68 +3720,357 @@ async def admin_distribute_profit(
 
 @api_router.post("/admin/transactions/{tx_id}/reject")
 async def admin_reject_transaction(tx_id: str, admin: User = Depends(require_admin)):
-    tx = await db.transactions.find_one({"id": tx_id}, {"_id": 0})
-    if not tx:
-        raise HTTPException(status_code=404, detail="Transaction not found")
-    
-    await db.transactions.update_one({"id": tx_id}, {"$set": {"status": "rejected"}})
-    
-    # If withdrawal was rejected, refund to wallet
-    if tx["type"] == "withdrawal":
-        await db.users.update_one(
-            {"id": tx["user_id"]},
-            {"$inc": {"wallet_balance": tx["amount"]}}
+    async def reject(session):
+        tx = await db.transactions.find_one_and_update(
+            {"id": tx_id, "status": "pending"},
+            {"$set": {"status": "rejected", "updated_at": datetime.now(timezone.utc).isoformat()}},
+            projection={"_id": 0},
+            session=session
         )
+        if not tx:
+            await raise_transaction_not_pending(tx_id, session)
+        
+        # If withdrawal was rejected, refund to wallet
+        if tx["type"] == "withdrawal":
+            await change_wallet(tx["user_id"], tx["amount"], "withdrawal_refund", "Withdrawal rejected", ref=tx_id, session=session)
+    
+    await run_in_transaction(reject)
     
     return {"message": "Transaction rejected"}
 
-@api_router.post("/admin/weekly-profit/distribute")
-async def admin_distribute_weekly_profit(admin: User = Depends(require_admin)):
-    """Distribute 5% weekly profit to all active investors"""
-    investments = await db.investments.find({"is_active": True}, {"_id": 0}).to_list(10000)
+DISTRIBUTION_SHARDS = int(os.environ.get('DISTRIBUTION_SHARDS', '1'))
+
+def shard_ranges(shard_count: int) -> List[tuple]:
+    """Split [0, SHARD_SPACE) into shard_count contiguous hash ranges"""
+    return [(i * SHARD_SPACE // shard_count, (i + 1) * SHARD_SPACE // shard_count) for i in range(shard_count)]
+
+async def backfill_user_shards():
+    """Set user_shard on investments created before it was stored"""
+    cursor = db.investments.find({"user_shard": None}, {"_id": 0, "id": 1, "user_id": 1}).batch_size(DISTRIBUTION_CHUNK_SIZE)
+    ops = []
+    async for inv in cursor:
+        ops.append(UpdateOne({"id": inv["id"]}, {"$set": {"user_shard": user_shard(inv["user_id"])}}))
+        if len(ops) >= DISTRIBUTION_CHUNK_SIZE:
+            await db.investments.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await db.investments.bulk_write(ops, ordered=False)
+
+def current_week_key(now: Optional[datetime] = None) -> str:
+    year, week, _ = (now or datetime.now(timezone.utc)).isocalendar()
+    return f"{year}-W{week:02d}"
+
+async def acquire_distribution_run(week_key: str, owner: str, admin_id: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Get or create this week's run and take its lease. None if another worker holds it."""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.distribution_runs.update_one(
+            {"week_key": week_key},
+            {"$setOnInsert": {
+                "id": str(uuid.uuid4()),
+                "week_key": week_key,
+                "status": "running",  # running, completed
+                "shard_count": DISTRIBUTION_SHARDS,
+                "shards": {
+                    str(index): {"range": [low, high], "checkpoint": None, "processed": 0, "total_amount": 0.0, "status": "pending"}
+                    for index, (low, high) in enumerate(shard_ranges(DISTRIBUTION_SHARDS))
+                },
+                "processed": 0,
+                "total_amount": 0.0,
+                "lease_owner": None,
+                "lease_expires_at": now.isoformat(),
+                "started_by": admin_id,
+                "started_at": now.isoformat(),
+                "finished_at": None
+            }},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        pass  # created concurrently by another request
+    
+    return await db.distribution_runs.find_one_and_update(
+        {"week_key": week_key, "$or": [
+            {"lease_expires_at": {"$lte": now.isoformat()}},
+            {"lease_owner": owner}
+        ]},
+        {"$set": {
+            "lease_owner": owner,
+            "lease_expires_at": (now + timedelta(seconds=DISTRIBUTION_LEASE_SECONDS)).isoformat()
+        }},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def run_sharded(run_id: str, shards: List[str], owner: str, process_entry, in_process):
+    """Run shards of a batch job concurrently in a process pool (or inline for one shard)"""
+    if len(shards) <= 1:
+        for shard in shards:
+            await in_process(db, run_id, shard, owner)
+        return
     
-    distributed_count = 0
-    total_distributed = 0.0
+    loop = asyncio.get_running_loop()
+    # spawn, not fork: a forked Motor/PyMongo client is not safe to reuse. The
+    # entry point lives in payout_worker, so children never import this module.
+    pool = ProcessPoolExecutor(max_workers=len(shards), mp_context=multiprocessing.get_context("spawn"))
+    try:
+        await asyncio.gather(*[
+            loop.run_in_executor(pool, process_entry, run_id, shard, owner) for shard in shards
+        ])
+    except BaseException:
+        # Don't wait for the other shards here. Queued ones are cancelled;
+        # running ones stop at their next chunk once the caller releases the lease.
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    # Every shard is done; joining the idle workers still blocks, so do it off the loop
+    await asyncio.to_thread(pool.shutdown)
+
+async def start_weekly_profit_run(admin_id: Optional[str] = None):
+    """Take this week's run (creating it if needed) and reset its attempt counters"""
+    week_key = current_week_key()
+    owner = str(uuid.uuid4())
+    run = await acquire_distribution_run(week_key, owner, admin_id)
+    if not run:
+        raise HTTPException(status_code=409, detail="Bu hafta için kar dağıtımı şu anda devam ediyor")
+    if run["status"] == "completed":
+        raise HTTPException(status_code=400, detail=f"{week_key} haftası için kar dağıtımı zaten tamamlandı")
+    
+    if "shards" not in run:
+        # Runs started before sharding kept a single top-level checkpoint
+        run["shard_count"] = 1
+        run["shards"] = {"0": {
+            "range": [0, SHARD_SPACE],
+            "checkpoint": run.get("checkpoint"),
+            "processed": run["processed"],
+            "total_amount": run["total_amount"],
+            "status": "pending"
+        }}
     
-    for inv_doc in investments:
-        inv = Investment(**inv_doc)
-        profit = inv.amount * 0.05  # 5% weekly profit
-        
-        # Update user
-        await db.users.update_one(
-            {"id": inv.user_id},
-            {"$inc": {
-                "weekly_earnings": profit,
-                "wallet_balance": profit
-            }}
-        )
+    attempt = {
+        "status": "running",
+        "error": None,
+        "shard_count": run["shard_count"],
+        "shards": run["shards"],
+        "total": await db.investments.count_documents({"is_active": True}),
+        "attempt_started_at": datetime.now(timezone.utc).isoformat(),
+        "attempt_base": run["processed"]
+    }
+    await db.distribution_runs.update_one({"id": run["id"]}, {"$set": attempt})
+    run.update(attempt)
+    return run, owner
+
+async def execute_weekly_profit_run(run: Dict[str, Any], owner: str) -> Dict[str, Any]:
+    """
+    Pay a run taken with start_weekly_profit_run, split into hash ranges of
+    user_id that are processed in parallel worker processes.
+    """
+    resumed = any(state["checkpoint"] for state in run["shards"].values())
+    
+    async def renew_lease():
+        while True:
+            await asyncio.sleep(DISTRIBUTION_LEASE_SECONDS / 3)
+            await db.distribution_runs.update_one(
+                {"id": run["id"], "lease_owner": owner},
+                {"$set": {"lease_expires_at": (datetime.now(timezone.utc) + timedelta(seconds=DISTRIBUTION_LEASE_SECONDS)).isoformat()}}
+            )
+    
+    heartbeat = asyncio.create_task(renew_lease())
+    try:
+        # Finish payouts claimed by an interrupted attempt before moving past the checkpoints
+        unapplied = await db.distribution_payouts.find(
+            {"run_id": run["id"], "status": "claimed"},
+            {"_id": 0}
+        ).to_list(None)
+        await run_in_transaction(lambda session: apply_payouts(db, unapplied, session))
         
-        # Update investment
-        await db.investments.update_one(
-            {"id": inv.id},
-            {"$set": {"last_profit_date": datetime.now(timezone.utc).isoformat()},
-             "$inc": {"total_earnings": profit}}
-        )
+        if run["shard_count"] > 1:
+            await backfill_user_shards()
         
-        # Create transaction
-        tx = Transaction(
-            user_id=inv.user_id,
-            type="weekly_profit",
-            amount=profit,
-            status="completed",
-            description=f"Weekly 5% profit on {inv.package} package"
+        pending = [shard for shard, state in run["shards"].items() if state["status"] != "completed"]
+        await run_sharded(run["id"], pending, owner, run_distribution_shard_process, distribute_shard)
+    except Exception as e:
+        # Release the lease so the run can be resumed right away, unless
+        # another worker has already taken the run over
+        await db.distribution_runs.update_one(
+            {"id": run["id"], "lease_owner": owner},
+            {"$set": {
+                "status": "failed",
+                "error": str(e),
+                "lease_owner": None,
+                "lease_expires_at": datetime.now(timezone.utc).isoformat()
+            }}
         )
-        await db.transactions.insert_one(tx.model_dump())
-        
-        distributed_count += 1
-        total_distributed += profit
+        raise
+    finally:
+        heartbeat.cancel()
+    
+    completed = await db.distribution_runs.find_one_and_update(
+        {"id": run["id"], "lease_owner": owner},
+        {"$set": {
+            "status": "completed",
+            "lease_owner": None,
+            "finished_at": datetime.now(timezone.utc).isoformat()
+        }},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not completed:
+        raise RuntimeError(f"Distribution run {run['id']} lost its lease")
+    run = completed
+    
+    return {
+        "run_id": run["id"],
+        "week_key": run["week_key"],
+        "resumed": resumed,
+        "distributed_to": run["processed"],
+        "total_amount": run["total_amount"]
+    }
+
+async def distribute_weekly_profit(admin_id: Optional[str] = None) -> Dict[str, Any]:
+    run, owner = await start_weekly_profit_run(admin_id)
+    return await execute_weekly_profit_run(run, owner)
+
+@api_router.post("/admin/weekly-profit/distribute")
+async def admin_distribute_weekly_profit(notify: bool = False, admin: User = Depends(require_admin)):
+    """
+    Start distributing 5% weekly profit to all active investors. Returns a job id
+    right away; follow progress on /api/admin/jobs/{job_id}/events.
+    """
+    run, owner = await start_weekly_profit_run(admin.id)
+    
+    async def distribute_in_background():
+        try:
+            await execute_weekly_profit_run(run, owner)
+        except Exception as e:
+            logger.error(f"Weekly profit distribution {run['id']} failed: {e}")
+            return
+        if notify and smtp_configured():
+            await start_weekly_profit_notification(run["id"], admin)
+    
+    spawn_background_task(distribute_in_background())
     
     return {
-        "message": "Weekly profit distributed",
-        "distributed_to": distributed_count,
-        "total_amount": total_distributed
+        "message": "Weekly profit distribution started",
+        "job_id": run["id"],
+        "week_key": run["week_key"],
+        "total": run["total"]
     }
 
+@api_router.get("/admin/weekly-profit/runs")
+async def admin_get_distribution_runs(admin: User = Depends(require_admin)):
+    """Recent weekly distribution runs with their checkpoints"""
+    runs = await db.distribution_runs.find({}, {"_id": 0}).sort("started_at", -1).limit(20).to_list(20)
+    return {"runs": runs}
+
+PREVIEW_BATCH_SIZE = 20000
+
+@api_router.get("/admin/weekly-profit/preview")
+async def admin_preview_weekly_profit(top: int = 20, admin: User = Depends(require_admin)):
+    """
+    Dry run of the weekly distribution: one projected scan of active investments
+    into NumPy columns, payouts computed with calculate_weekly_profit.
+    Nothing is written.
+    """
+    started = datetime.now(timezone.utc)
+    user_ids: List[str] = []
+    packages: List[str] = []
+    amounts: List[float] = []
+    
+    cursor = db.investments.find(
+        {"is_active": True},
+        {"_id": 0, "user_id": 1, "package": 1, "amount": 1}
+    ).batch_size(PREVIEW_BATCH_SIZE)
+    while True:
+        batch = await cursor.to_list(PREVIEW_BATCH_SIZE)
+        if not batch:
+            break
+        user_ids.extend([inv["user_id"] for inv in batch])
+        packages.extend([inv.get("package") or "unknown" for inv in batch])
+        amounts.extend([inv.get("amount", 0.0) for inv in batch])
+    
+    # Integer-code the keys once, then every aggregate is a single bincount
+    user_codes, user_index = pd.factorize(np.asarray(user_ids, dtype=object))
+    package_codes, package_index = pd.factorize(np.asarray(packages, dtype=object))
+    invested = np.asarray(amounts, dtype=np.float64)
+    payout = calculate_weekly_profit(invested)
+    
+    per_user = np.bincount(user_codes, weights=payout, minlength=len(user_index))
+    package_counts = np.bincount(package_codes, minlength=len(package_index))
+    package_invested = np.bincount(package_codes, weights=invested, minlength=len(package_index))
+    package_payout = np.bincount(package_codes, weights=payout, minlength=len(package_index))
+    
+    top = max(0, min(top, 100, per_user.size))
+    top_codes = np.argpartition(per_user, -top)[-top:] if top else np.array([], dtype=np.int64)
+    top_codes = top_codes[np.argsort(per_user[top_codes])[::-1]]
+    top_ids = [str(user_index[code]) for code in top_codes]
+    
+    user_docs = await db.users.find(
+        {"id": {"$in": top_ids}},
+        {"_id": 0, "id": 1, "name": 1, "email": 1}
+    ).to_list(None)
+    users_by_id = {u["id"]: u for u in user_docs}
+    
+    current_run = await db.distribution_runs.find_one(
+        {"week_key": current_week_key()},
+        {"_id": 0, "id": 1, "status": 1, "processed": 1, "total_amount": 1}
+    )
+    
+    return {
+        "week_key": current_week_key(),
+        "current_run": current_run,
+        "investments": int(invested.size),
+        "investors": int(per_user.size),
+        "total_invested": float(invested.sum()),
+        "total_payout": float(payout.sum()),
+        "per_package": [
+            {
+                "package": str(package),
+                "investments": int(package_counts[code]),
+                "invested": float(package_invested[code]),
+                "payout": float(package_payout[code])
+            }
+            for code, package in enumerate(package_index)
+        ],
+        "per_user": {
+            "mean": float(per_user.mean()) if per_user.size else 0.0,
+            "max": float(per_user.max()) if per_user.size else 0.0
+        },
+        "top_recipients": [
+            {
+                "user_id": user_id,
+                "name": users_by_id.get(user_id, {}).get("name", "Unknown"),
+                "email": users_by_id.get(user_id, {}).get("email", ""),
+                "payout": float(per_user[code])
+            }
+            for code, user_id in zip(top_codes, top_ids)
+        ],
+        "elapsed_ms": round((datetime.now(timezone.utc) - started).total_seconds() * 1000, 1)
+    }
+
+@api_router.post("/admin/notifications/weekly-profit")
+async def admin_send_weekly_profit_notifications(admin: User = Depends(require_admin)):
+    """Email everyone paid in the latest completed distribution the amount they received"""
+    if not smtp_configured():
+        raise HTTPException(status_code=400, detail="SMTP yapılandırılmamış")
+    
+    distribution = await db.distribution_runs.find_one(
+        {"status": "completed"},
+        {"_id": 0, "id": 1},
+        sort=[("finished_at", -1)]
+    )
+    if not distribution:
+        raise HTTPException(status_code=400, detail="Tamamlanmış bir kar dağıtımı bulunamadı")
+    
+    run = await start_weekly_profit_notification(distribution["id"], admin)
+    return {"run_id": run["id"], "total": run["total"]}
+
+@api_router.get("/admin/notifications/{run_id}")
+async def admin_get_notification_run(run_id: str, admin: User = Depends(require_admin)):
+    """Progress and failures of a bulk notification run"""
+    run = await db.notification_runs.find_one({"id": run_id}, {"_id": 0})
+    if not run:
+        raise HTTPException(status_code=404, detail="Notification run not found")
+    return run
+
 @api_router.post("/admin/users/{user_id}/make-admin")
 async def make_user_admin(user_id: str, admin: User = Depends(require_admin)):
     await db.users.update_one({"id": user_id}, {"$set": {"is_admin": True}})
@@ -2417,14 +4428,18 @@ async def get_placement_history(admin: User = Depends(require_admin)):
     """Get all placement history records"""
     history = await db.placement_history.find({}, {"_id": 0}).sort("created_at", -1).limit(100).to_list(100)
     
-    # Enrich with user names
+    # Enrich with user names, placed users and uplines in one query
+    users = await fetch_users_by_id(
+        [record["user_id"] for record in history] + [record.get("new_upline_id") for record in history],
+        fields=("name",)
+    )
     for record in history:
-        user_doc = await db.users.find_one({"id": record["user_id"]}, {"_id": 0, "name": 1})
+        user_doc = users.get(record["user_id"])
         if user_doc:
             record["user_name"] = user_doc["name"]
         
         if record.get("new_upline_id"):
-            upline_doc = await db.users.find_one({"id": record["new_upline_id"]}, {"_id": 0, "name": 1})
+            upline_doc = users.get(record["new_upline_id"])
             if upline_doc:
                 record["new_upline_name"] = upline_doc["name"]
     
@@ -2432,44 +4447,602 @@ async def get_placement_history(admin: User = Depends(require_admin)):
 
 @api_router.get("/admin/stats")
 async def admin_get_stats(admin: User = Depends(require_admin)):
-    total_users = await db.users.count_documents({})
-    total_investments = await db.investments.count_documents({"is_active": True})
+    return await read_stats()
+
+@api_router.get("/admin/overview")
+async def admin_get_overview(admin: User = Depends(require_admin)):
+    """
+    Everything the admin panel shows on load, in one response. Independent
+    reads run concurrently, each a find or count its own index serves.
+    """
+    (users_page, transactions, stats, investment_requests, approved, pending,
+     withdrawal_requests, placement_history) = await asyncio.gather(
+        admin_get_users(admin=admin),
+        find_transactions({}, 100),
+        read_stats(),
+        db.investment_requests.find({}, {"_id": 0}).sort("created_at", -1).limit(100).to_list(100),
+        get_approved_investments(user=admin),
+        get_pending_count(user=admin),
+        list_withdrawal_requests(),
+        get_placement_history(admin=admin)
+    )
     
-    # Calculate total volume
-    pipeline = [
-        {"$group": {"_id": None, "total": {"$sum": "$total_invested"}}}
-    ]
-    result = await db.users.aggregate(pipeline).to_list(1)
-    total_volume = result[0]["total"] if result else 0
+    return {
+        "users": users_page["users"],
+        "users_next_cursor": users_page["next_cursor"],
+        "transactions": transactions,
+        "stats": stats,
+        "investment_requests": investment_requests,
+        "withdrawal_requests": withdrawal_requests["requests"],
+        "placement_history": placement_history,
+        "pending_count": pending["pending_count"],
+        "approved_investments": approved["approved_investments"]
+    }
+
+@api_router.get("/admin/email-outbox")
+async def admin_get_email_outbox(admin: User = Depends(require_admin)):
+    """Outbox counts per status plus the most recent dead-lettered emails"""
+    counts = await db.email_outbox.aggregate([
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    dead = await db.email_outbox.find(
+        {"status": "dead"},
+        {"_id": 0, "text": 0, "html": 0}
+    ).sort("created_at", -1).limit(50).to_list(50)
     
-    pending_withdrawals = await db.transactions.count_documents({
-        "type": "withdrawal",
-        "status": "pending"
-    })
+    return {
+        "counts": {c["_id"]: c["count"] for c in counts},
+        "dead": dead
+    }
+
+@api_router.post("/admin/email-outbox/{message_id}/retry")
+async def admin_retry_email(message_id: str, admin: User = Depends(require_admin)):
+    """Move a dead-lettered email back to the queue"""
+    result = await db.email_outbox.update_one(
+        {"id": message_id, "status": "dead"},
+        {"$set": {
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": datetime.now(timezone.utc).isoformat()
+        }}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Dead-lettered email not found")
+    
+    email_outbox_wakeup.set()
+    return {"message": "Email requeued"}
+
+# ==================== ADMIN EXPORT ====================
+
+# Exports stream straight from a batched cursor, so memory stays at one
+# batch however large the collection is
+EXPORT_BATCH_SIZE = 5000
+EXPORT_COLLECTIONS = {
+    "users": (User, ADMIN_USER_LIST_FIELDS),
+    "transactions": (Transaction, tuple(Transaction.model_fields)),
+    "investments": (Investment, tuple(Investment.model_fields))
+}
+
+async def export_batches(collection: str, columns: tuple):
+    """Lists of at most EXPORT_BATCH_SIZE documents; transactions include the monthly archives"""
+    names = [collection]
+    if collection == "transactions":
+        names += [partition["collection"] for partition in await transaction_partitions()]
+    
+    projection = {"_id": 0, **{column: 1 for column in columns}}
+    for name in names:
+        cursor = db[name].find({}, projection).batch_size(EXPORT_BATCH_SIZE)
+        batch = []
+        try:
+            async for doc in cursor:
+                batch.append(doc)
+                if len(batch) >= EXPORT_BATCH_SIZE:
+                    yield batch
+                    batch = []
+        finally:
+            await cursor.close()
+        if batch:
+            yield batch
+
+async def export_csv(collection: str, columns: tuple):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+    buffer.write("\ufeff")  # lets Excel read Turkish characters as UTF-8
+    writer.writeheader()
+    
+    async for batch in export_batches(collection, columns):
+        writer.writerows(batch)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+class ParquetStreamSink(io.RawIOBase):
+    """
+    Write-only file for the Parquet writer that hands bytes on instead of
+    keeping them. Parquet only appends (the footer comes last), so each
+    row group can be sent as soon as it is written.
+    """
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, data) -> int:
+        chunk = bytes(data)
+        self.chunks.append(chunk)
+        self.position += len(chunk)
+        return len(chunk)
+    
+    def tell(self) -> int:
+        return self.position
+    
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def export_arrow_schema(pa, model, columns: tuple):
+    """Arrow schema from the model's field types; anything not numeric or boolean is a string"""
+    types = {float: pa.float64(), int: pa.int64(), bool: pa.bool_()}
+    fields = []
+    for column in columns:
+        annotation = model.model_fields[column].annotation
+        base = next((arg for arg in get_args(annotation) if arg is not type(None)), annotation)
+        fields.append(pa.field(column, types.get(base, pa.string())))
+    return pa.schema(fields)
+
+def export_frame(batch: List[Dict[str, Any]], columns: tuple, schema) -> pd.DataFrame:
+    frame = pd.DataFrame.from_records(batch, columns=list(columns))
+    for field in schema:
+        if str(field.type) == "string":
+            frame[field.name] = frame[field.name].map(lambda v: None if v is None or v != v else str(v))
+    return frame
+
+async def export_parquet(collection: str, model, columns: tuple, pa, pq):
+    schema = export_arrow_schema(pa, model, columns)
+    sink = ParquetStreamSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        async for batch in export_batches(collection, columns):
+            frame = export_frame(batch, columns, schema)
+            table = pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+            await asyncio.to_thread(writer.write_table, table)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+@api_router.get("/admin/export/{collection}")
+async def admin_export_collection(collection: str, format: str = "csv", admin: User = Depends(require_admin)):
+    """Full dump of users, transactions or investments as streamed CSV or Parquet"""
+    if collection not in EXPORT_COLLECTIONS:
+        raise HTTPException(status_code=404, detail="Bu koleksiyon dışa aktarılamaz")
+    model, columns = EXPORT_COLLECTIONS[collection]
+    filename = f"{collection}-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}"
+    
+    if format == "csv":
+        body = export_csv(collection, columns)
+        media_type = "text/csv; charset=utf-8"
+    elif format == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Parquet dışa aktarımı için sunucuda pyarrow kurulu değil")
+        body = export_parquet(collection, model, columns, pa, pq)
+        media_type = "application/vnd.apache.parquet"
+    else:
+        raise HTTPException(status_code=400, detail="Geçersiz format (csv veya parquet)")
+    
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}.{format}"',
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+# ==================== BATCH JOB PROGRESS ====================
+
+JOB_EVENTS_INTERVAL_SECONDS = 1
+
+# Collections holding background batch jobs, keyed by their "id" field
+BATCH_JOB_COLLECTIONS = ("distribution_runs", "notification_runs")
+
+async def find_batch_job(job_id: str):
+    for collection in BATCH_JOB_COLLECTIONS:
+        doc = await db[collection].find_one({"id": job_id}, {"_id": 0})
+        if doc:
+            return collection, doc
+    return None, None
+
+def batch_job_stale(collection: str, doc: Dict[str, Any]) -> bool:
+    """Whether a job still marked running has stopped heartbeating (its process died)"""
+    if doc.get("status") != "running":
+        return False
+    now = datetime.now(timezone.utc)
+    if collection == "distribution_runs":
+        # The runner renews the lease every third of its TTL while it is alive
+        return datetime.fromisoformat(doc["lease_expires_at"]) <= now
+    heartbeat_at = doc.get("heartbeat_at") or doc["started_at"]
+    return (now - datetime.fromisoformat(heartbeat_at)).total_seconds() > BULK_EMAIL_STALE_SECONDS
+
+def batch_job_progress(collection: str, doc: Dict[str, Any]) -> Dict[str, Any]:
+    if collection == "distribution_runs":
+        processed = doc.get("processed", 0)
+        progress = {
+            "kind": "weekly_profit_distribution",
+            "processed": processed,
+            "total": doc.get("total"),
+            "amount": doc.get("total_amount", 0.0),
+            "errors": [doc["error"]] if doc.get("error") else []
+        }
+        started_at = doc.get("attempt_started_at") or doc["started_at"]
+        attempt_processed = processed - doc.get("attempt_base", 0)
+    else:
+        processed = doc.get("sent", 0) + doc.get("failed", 0)
+        progress = {
+            "kind": doc.get("kind"),
+            "processed": processed,
+            "total": doc.get("total"),
+            "amount": None,
+            "errors": [f"{f['email']}: {f['error']}" for f in doc.get("failures", [])[-10:]]
+        }
+        started_at = doc["started_at"]
+        attempt_processed = processed
+    
+    finished_at = doc.get("finished_at")
+    end = datetime.fromisoformat(finished_at) if finished_at and doc.get("status") != "running" else datetime.now(timezone.utc)
+    elapsed = max((end - datetime.fromisoformat(started_at)).total_seconds(), 0.001)
     
     return {
-        "total_users": total_users,
-        "total_investments": total_investments,
-        "total_volume": total_volume,
-        "pending_withdrawals": pending_withdrawals
+        "job_id": doc["id"],
+        "status": doc.get("status"),
+        "stale": batch_job_stale(collection, doc),
+        **progress,
+        "elapsed_seconds": round(elapsed, 1),
+        "throughput_per_sec": round(attempt_processed / elapsed, 1)
     }
 
+@api_router.get("/admin/jobs/{job_id}")
+async def admin_get_job_progress(job_id: str, admin: User = Depends(require_admin)):
+    collection, doc = await find_batch_job(job_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return batch_job_progress(collection, doc)
+
+@api_router.get("/admin/jobs/{job_id}/events")
+async def admin_stream_job_progress(job_id: str, request: Request, admin: User = Depends(require_admin)):
+    """
+    Server-sent events with the job's progress until it stops running, or an
+    error event once a running job stops heartbeating.
+    """
+    collection, doc = await find_batch_job(job_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def event_stream():
+        while True:
+            if await request.is_disconnected():
+                return
+            job = await db[collection].find_one({"id": job_id}, {"_id": 0})
+            progress = batch_job_progress(collection, job)
+            payload = json.dumps(progress)
+            yield f"event: progress\ndata: {payload}\n\n"
+            if progress["stale"]:
+                stalled = {**progress, "errors": progress["errors"] + ["Job stopped responding"]}
+                yield f"event: error\ndata: {json.dumps(stalled)}\n\n"
+                return
+            if progress["status"] != "running":
+                yield f"event: done\ndata: {payload}\n\n"
+                return
+            await asyncio.sleep(JOB_EVENTS_INTERVAL_SECONDS)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # ==================== PUBLIC ENDPOINTS ====================
 
 @api_router.get("/public/stats")
+@cached_response(ttl=30, stale_while_revalidate=300)
 async def get_public_stats():
-    total_users = await db.users.count_documents({})
-    pipeline = [
-        {"$group": {"_id": None, "total": {"$sum": "$total_invested"}}}
-    ]
-    result = await db.users.aggregate(pipeline).to_list(1)
-    total_volume = result[0]["total"] if result else 0
+    stats = await read_stats()
+    return {
+        "total_users": stats["total_users"],
+        "total_volume": stats["total_volume"]
+    }
+
+# ==================== JOB SCHEDULER ====================
+
+# In-app cron. Every worker runs the loop; a Mongo lease document (removed by a
+# TTL index once expired) plus a compare-and-set on next_run_at make sure each
+# scheduled slot runs on exactly one worker.
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'true').lower() == 'true'
+SCHEDULER_TICK_SECONDS = 30
+SCHEDULER_LEASE_SECONDS = 300
+SCHEDULER_INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(4)}"
+
+class CronSchedule:
+    """
+    5-field cron expression (minute hour day-of-month month day-of-week), UTC.
+    Fields accept *, */n, a-b, a-b/n and comma separated lists; Sunday is 0.
+    """
+    FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.FIELD_RANGES)
+        ]
+        # Standard cron: when both day fields are restricted, either may match
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int) -> set:
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step_text = part.split("/")
+                step = int(step_text)
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = (int(v) for v in part.split("-"))
+            else:
+                start = end = int(part)
+            if start < low or end > high or step < 1:
+                raise ValueError(f"Cron field out of range: {field}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, dt: datetime) -> bool:
+        day_ok = dt.day in self.days
+        weekday_ok = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return weekday_ok
+        if self.any_weekday:
+            return day_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, dt: datetime) -> datetime:
+        t = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"Cron expression never fires: {self.expression}")
+
+scheduled_jobs: Dict[str, Dict[str, Any]] = {}
+
+def register_job(name: str, schedule: str, func, lease_seconds: int = SCHEDULER_LEASE_SECONDS,
+                 lease: Optional[str] = None):
+    """
+    Register a coroutine function to run on a cron schedule. Jobs that work
+    on the same state pass the same lease name so they never overlap.
+    """
+    scheduled_jobs[name] = {
+        "name": name,
+        "schedule": CronSchedule(schedule),
+        "func": func,
+        "lease": lease or name,
+        "lease_seconds": lease_seconds
+    }
+
+async def acquire_job_lease(name: str, lease_seconds: int) -> Optional[str]:
+    """
+    Take the job's lease if nobody holds it, returning a token unique to this
+    run; None while another run (on this worker or any other) holds it
+    """
+    now = datetime.now(timezone.utc)
+    token = str(uuid.uuid4())
+    try:
+        await db.job_leases.find_one_and_update(
+            {"_id": name, "expires_at": {"$lte": now}},
+            {"$set": {
+                "owner": SCHEDULER_INSTANCE_ID,
+                "token": token,
+                "expires_at": now + timedelta(seconds=lease_seconds)
+            }},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return None  # an unexpired lease exists
+    return token
+
+async def release_job_lease(name: str, token: str):
+    await db.job_leases.delete_one({"_id": name, "token": token})
+
+async def sync_job_state():
+    """Create job state documents and reschedule jobs whose expression changed"""
+    now = datetime.now(timezone.utc)
+    for job in scheduled_jobs.values():
+        expression = job["schedule"].expression
+        next_run_at = job["schedule"].next_after(now).isoformat()
+        await db.job_state.update_one(
+            {"_id": job["name"]},
+            {"$setOnInsert": {"schedule": expression, "next_run_at": next_run_at, "last_run_at": None, "last_status": None}},
+            upsert=True
+        )
+        await db.job_state.update_one(
+            {"_id": job["name"], "schedule": {"$ne": expression}},
+            {"$set": {"schedule": expression, "next_run_at": next_run_at}}
+        )
+
+async def run_scheduled_job(job: Dict[str, Any], trigger: str, token: str) -> Dict[str, Any]:
+    """Run a job while holding the lease taken with token and record the run in job_runs"""
+    name = job["name"]
+    run = {
+        "id": str(uuid.uuid4()),
+        "job": name,
+        "trigger": trigger,  # schedule, manual
+        "owner": SCHEDULER_INSTANCE_ID,
+        "status": "running",  # running, success, failed
+        "result": None,
+        "error": None,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "finished_at": None
+    }
+    await db.job_runs.insert_one(dict(run))
+    
+    async def renew_lease():
+        while True:
+            await asyncio.sleep(job["lease_seconds"] / 3)
+            await db.job_leases.update_one(
+                {"_id": job["lease"], "token": token},
+                {"$set": {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=job["lease_seconds"])}}
+            )
+    
+    heartbeat = asyncio.create_task(renew_lease())
+    try:
+        run["result"] = await job["func"]()
+        run["status"] = "success"
+    except Exception as e:
+        run["status"] = "failed"
+        run["error"] = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"Scheduled job {name} failed: {run['error']}")
+    finally:
+        heartbeat.cancel()
+        run["finished_at"] = datetime.now(timezone.utc).isoformat()
+        await db.job_runs.update_one(
+            {"id": run["id"]},
+            {"$set": {k: run[k] for k in ("status", "result", "error", "finished_at")}}
+        )
+        await db.job_state.update_one(
+            {"_id": name},
+            {"$set": {"last_run_at": run["started_at"], "last_status": run["status"]}}
+        )
+        await release_job_lease(job["lease"], token)
+    
+    return run
+
+async def maybe_run_job(job: Dict[str, Any]):
+    now = datetime.now(timezone.utc)
+    state = await db.job_state.find_one({"_id": job["name"]})
+    if not state or state["next_run_at"] > now.isoformat():
+        return
+    token = await acquire_job_lease(job["lease"], job["lease_seconds"])
+    if not token:
+        return
+    
+    # Claim this slot; a worker that loses the race leaves it alone
+    claimed = await db.job_state.find_one_and_update(
+        {"_id": job["name"], "next_run_at": state["next_run_at"]},
+        {"$set": {"next_run_at": job["schedule"].next_after(now).isoformat()}}
+    )
+    if not claimed:
+        await release_job_lease(job["lease"], token)
+        return
+    
+    spawn_background_task(run_scheduled_job(job, "schedule", token))
+
+async def scheduler_loop():
+    await sync_job_state()
+    while True:
+        for job in list(scheduled_jobs.values()):
+            try:
+                await maybe_run_job(job)
+            except Exception as e:
+                logger.error(f"Scheduler tick failed for {job['name']}: {e}")
+        await asyncio.sleep(SCHEDULER_TICK_SECONDS)
+
+async def cleanup_expired_data() -> Dict[str, Any]:
+    """Remove expired sessions, expired unused referral codes and old delivered emails"""
+    now = datetime.now(timezone.utc)
+    sessions = await db.user_sessions.delete_many({"expires_at": {"$lt": now.isoformat()}})
+    codes = await db.referral_codes.delete_many({"is_used": False, "expires_at": {"$lt": now.isoformat()}})
+    emails = await db.email_outbox.delete_many({
+        "status": "sent",
+        "sent_at": {"$lt": (now - timedelta(days=30)).isoformat()}
+    })
+    return {
+        "sessions": sessions.deleted_count,
+        "referral_codes": codes.deleted_count,
+        "emails": emails.deleted_count
+    }
+
+async def scheduled_weekly_profit_distribution() -> Dict[str, Any]:
+    return await distribute_weekly_profit()
+
+async def full_reconciliation() -> Dict[str, Any]:
+    # Rebuilds the totals, picking up status changes on already folded transactions
+    return await reconcile_balances(full=True)
+
+register_job("cleanup", os.environ.get('CLEANUP_CRON', '15 3 * * *'), cleanup_expired_data)
+register_job("wallet_checkpoints", os.environ.get('WALLET_CHECKPOINT_CRON', '0 * * * *'), checkpoint_wallet_balances)
+register_job("transaction_archive", os.environ.get('TRANSACTION_ARCHIVE_CRON', '45 2 * * *'), archive_transactions)
+register_job("reconciliation", os.environ.get('RECONCILIATION_CRON', '30 4 * * *'), reconcile_balances)
+register_job("stats_reconciliation", os.environ.get('STATS_RECONCILIATION_CRON', '*/15 * * * *'), reconcile_stats)
+# Shares the incremental job's lease: both fold into reconciliation_totals
+register_job("reconciliation_full", os.environ.get('FULL_RECONCILIATION_CRON', '30 5 * * 0'), full_reconciliation,
+             lease="reconciliation")
+register_job("withdrawal_recovery", os.environ.get('WITHDRAWAL_RECOVERY_CRON', '*/5 * * * *'), recover_stuck_withdrawals)
+# Automatic payouts are opt-in, e.g. WEEKLY_PROFIT_CRON="0 6 * * 1"
+if os.environ.get('WEEKLY_PROFIT_CRON'):
+    register_job("weekly_profit_distribution", os.environ['WEEKLY_PROFIT_CRON'], scheduled_weekly_profit_distribution)
+
+@api_router.get("/admin/scheduler/status")
+async def admin_get_scheduler_status(admin: User = Depends(require_admin)):
+    """Registered jobs with their next run, current lease holder and recent runs"""
+    states = {s["_id"]: s for s in await db.job_state.find({}).to_list(None)}
+    leases = {l["_id"]: l for l in await db.job_leases.find({}).to_list(None)}
+    
+    jobs = []
+    for name, job in scheduled_jobs.items():
+        state = states.get(name, {})
+        lease = leases.get(job["lease"])
+        jobs.append({
+            "name": name,
+            "schedule": job["schedule"].expression,
+            "next_run_at": state.get("next_run_at"),
+            "last_run_at": state.get("last_run_at"),
+            "last_status": state.get("last_status"),
+            "running_on": lease["owner"] if lease else None
+        })
+    
+    runs = await db.job_runs.find({}, {"_id": 0}).sort("started_at", -1).limit(50).to_list(50)
     
     return {
-        "total_users": total_users,
-        "total_volume": total_volume
+        "enabled": SCHEDULER_ENABLED,
+        "instance": SCHEDULER_INSTANCE_ID,
+        "jobs": jobs,
+        "recent_runs": runs
     }
 
+@api_router.post("/admin/scheduler/jobs/{name}/run")
+async def admin_run_job(name: str, admin: User = Depends(require_admin)):
+    """Run a registered job now, unless another worker is already running it"""
+    job = scheduled_jobs.get(name)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    token = await acquire_job_lease(job["lease"], job["lease_seconds"])
+    if not token:
+        raise HTTPException(status_code=409, detail="Job is already running")
+    
+    run = await run_scheduled_job(job, "manual", token)
+    return run
+
 # Include router
 app.include_router(api_router)
 
@@ -2480,6 +5053,8 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lets the admin panel name export downloads it fetches with axios
+    expose_headers=["Content-Disposition"],
 )
 
 # Logging
@@ -2489,6 +5064,102 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Long-running tasks started with the app and cancelled on shutdown
+background_tasks: set = set()
+
+def spawn_background_task(coro) -> asyncio.Task:
+    """Run a coroutine in the background and keep a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def ensure_indexes():
+    await db.email_outbox.create_index([("status", 1), ("next_attempt_at", 1)])
+    await db.email_outbox.create_index([("status", 1), ("locked_at", 1)])
+    await db.email_outbox.create_index("id", unique=True)
+    await db.notification_runs.create_index("id", unique=True)
+    await db.withdrawal_requests.create_index([("status", 1), ("processing_at", 1)])
+    await db.transactions.create_index("id", unique=True)
+    await db.investments.create_index([("is_active", 1), ("id", 1)])
+    await db.investments.create_index([("is_active", 1), ("user_shard", 1), ("id", 1)])
+    await db.distribution_runs.create_index("week_key", unique=True)
+    await db.distribution_runs.create_index("id", unique=True)
+    await db.distribution_payouts.create_index([("run_id", 1), ("investment_id", 1)], unique=True)
+    await db.distribution_payouts.create_index([("run_id", 1), ("status", 1)])
+    await db.distribution_payouts.create_index("id", unique=True)
+    await db.job_leases.create_index("expires_at", expireAfterSeconds=0)
+    await db.job_runs.create_index([("started_at", -1)])
+    await db.wallet_ledger.create_index([("user_id", 1), ("seq", 1)], unique=True)
+    await db.wallet_ledger.create_index("seq")
+    await db.wallet_ledger.create_index(
+        [("ref", 1), ("type", 1)],
+        unique=True,
+        partialFilterExpression={"ref": {"$type": "string"}}
+    )
+    await db.wallet_checkpoints.create_index([("user_id", 1), ("seq", -1)])
+    await db.users.create_index("id")
+    await db.users.create_index([("created_at", -1), ("id", -1)])
+    await db.users.create_index([("name_lower", 1), ("id", 1)])
+    await db.users.create_index([("email_lower", 1), ("id", 1)])
+    # Equality filter, then the (created_at, id) order filter-only searches page by
+    await db.users.create_index([("package", 1), ("created_at", -1), ("id", -1)])
+    await db.users.create_index([("is_admin", 1), ("created_at", -1), ("id", -1)])
+    for superseded in ("package_1_position_1_wallet_balance_1", "is_admin_1_position_1_wallet_balance_1"):
+        try:
+            await db.users.drop_index(superseded)
+        except OperationFailure:
+            pass  # already dropped
+    await db.transactions.create_index("created_at")
+    await db.transactions.create_index([("user_id", 1), ("created_at", -1)])
+    await db.transactions.create_index("updated_at")
+    for partition in await transaction_partitions():
+        # Partitions indexed before reconciliation watched updated_at
+        await db[partition["collection"]].create_index("updated_at")
+    # Approved list and pending count on the admin overview
+    await db.investment_requests.create_index([("status", 1), ("created_at", -1)])
+    for collection in (db.investment_requests, db.withdrawal_requests):
+        await collection.create_index("created_at")
+        await collection.create_index("updated_at")
+        await collection.create_index([("user_id", 1), ("created_at", -1)])
+        await collection.create_index([("user_id", 1), ("updated_at", -1)])
+    await db.reconciliation_totals.create_index("user_id", unique=True)
+    await db.referral_codes.create_index([("user_id", 1), ("is_used", 1), ("expires_at", -1)])
+    await db.referral_codes.create_index(
+        "code_normalized",
+        unique=True,
+        partialFilterExpression={"code_normalized": {"$type": "string"}}
+    )
+    await db.reconciliation_drift.create_index("run_id")
+    await db.reconciliation_runs.create_index([("started_at", -1)])
+
+async def run_startup_migrations():
+    """Backfill fields added after documents were created; safe to re-run"""
+    try:
+        await backfill_user_search_fields()
+        await backfill_referral_code_keys()
+    except Exception as e:
+        logger.error(f"Startup migration failed: {e}")
+
+@app.on_event("startup")
+async def start_background_workers():
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        logger.error(f"Index creation failed: {e}")
+    
+    for worker_id in range(EMAIL_OUTBOX_WORKERS):
+        spawn_background_task(email_outbox_worker(worker_id))
+    
+    spawn_background_task(run_startup_migrations())
+    
+    if SCHEDULER_ENABLED:
+        spawn_background_task(scheduler_loop())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    client.close()
@@ -480,17 +480,95 @@ class ParlaCapitalAPITester:
         """Test withdrawal request functionality"""
         print("\n💸 Testing Withdrawal Endpoints...")
         
-        # Test withdrawal request (using query parameters)
+        # Test withdrawal request (funds are held until an admin acts on it)
         success, response = self.run_test(
             "Create Withdrawal Request",
             "POST",
-            "withdrawal/request?amount=50.0&crypto_type=usdt&wallet_address=0x1234567890abcdef1234567890abcdef12345678",
-            200
+            "withdrawal/request",
+            200,
+            data={"full_name": "Test User", "iban": "TR000000000000000000000000", "amount": 50.0}
         )
         
         if success:
             print("   ✓ Withdrawal request created")
 
+    def test_concurrent_withdrawal_approvals(self):
+        """Concurrent withdrawal requests and approvals; the wallet must never go negative"""
+        print("\n🔒 Testing Concurrent Withdrawals...")
+        
+        # The admin user starts with a $1000 wallet
+        admin_token = self.create_admin_user_and_login()
+        if not admin_token:
+            print("❌ Cannot test concurrent withdrawals - admin user creation failed")
+            return
+        
+        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {admin_token}'}
+        from concurrent.futures import ThreadPoolExecutor
+        
+        def create_request(_):
+            try:
+                response = requests.post(
+                    f"{self.api_url}/withdrawal/request",
+                    json={"full_name": "Concurrency Test", "iban": "TR000000000000000000000000", "amount": 20.0},
+                    headers=headers,
+                    timeout=30
+                )
+                return response.json().get('request_id') if response.status_code == 200 else None
+            except Exception:
+                return None
+        
+        # 100 x $20 requests at once, twice the available balance: only 50 can hold funds
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=100) as pool:
+            request_ids = [rid for rid in pool.map(create_request, range(100)) if rid]
+        elapsed = time.time() - started
+        print(f"   ✓ 100 concurrent requests in {elapsed:.2f}s ({100 / elapsed:.0f} req/s)")
+        
+        self.log_test("Concurrent Requests Hold At Most The Balance", len(request_ids) == 50, f"Created {len(request_ids)}")
+        
+        def approve(request_id):
+            try:
+                return requests.post(
+                    f"{self.api_url}/admin/withdrawal-requests/{request_id}/approve",
+                    headers=headers,
+                    timeout=30
+                ).status_code
+            except Exception:
+                return None
+        
+        # Half approved one by one, all at once
+        single, bulk = request_ids[:len(request_ids) // 2], request_ids[len(request_ids) // 2:]
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=100) as pool:
+            statuses = list(pool.map(approve, single))
+        elapsed = time.time() - started
+        print(f"   ✓ {len(single)} concurrent approvals in {elapsed:.2f}s ({len(single) / max(elapsed, 1e-9):.0f} req/s)")
+        
+        # The rest in one bulk call
+        started = time.time()
+        response = requests.post(
+            f"{self.api_url}/admin/withdrawal-requests/bulk-approve",
+            json={"request_ids": bulk},
+            headers=headers,
+            timeout=60
+        )
+        elapsed = time.time() - started
+        bulk_approved = response.json().get('approved', 0) if response.status_code == 200 else 0
+        print(f"   ✓ Bulk approved {bulk_approved} in {elapsed:.2f}s")
+        
+        response = requests.get(f"{self.api_url}/auth/me", headers=headers, timeout=10)
+        me = response.json() if response.status_code == 200 else {}
+        balance = me.get('wallet_balance')
+        held = me.get('held_balance')
+        print(f"   ✓ Final wallet balance: ${balance}, held: ${held}")
+        
+        self.log_test(
+            "Concurrent Withdrawals Never Overdraw",
+            statuses.count(200) == len(single) and bulk_approved == len(bulk)
+            and balance is not None and balance >= 0 and held == 0,
+            f"approved={statuses.count(200)}+{bulk_approved}, balance={balance}, held={held}"
+        )
+
     def create_admin_user_and_login(self):
         """Create admin user and login to get JWT token"""
         print("\n👑 Creating admin user...")
@@ -607,6 +685,54 @@ class ParlaCapitalAPITester:
             200
         )
         
+        # Admin panel load: one overview request vs. the eight separate calls it replaces
+        headers = {'Authorization': f'Bearer {admin_token}'}
+        panel_endpoints = [
+            "admin/users", "admin/transactions", "admin/stats", "admin/investment-requests",
+            "admin/withdrawal-requests", "admin/placement-history", "admin/pending-count",
+            "admin/approved-investments"
+        ]
+        from concurrent.futures import ThreadPoolExecutor
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=len(panel_endpoints)) as pool:
+            list(pool.map(lambda ep: requests.get(f"{self.api_url}/{ep}", headers=headers, timeout=30), panel_endpoints))
+        separate_elapsed = time.time() - started
+        
+        started = time.time()
+        success, response = self.run_test(
+            "Admin Overview",
+            "GET",
+            "admin/overview",
+            200
+        )
+        overview_elapsed = time.time() - started
+        
+        if success and isinstance(response, dict):
+            print(f"   ✓ 8 separate calls: {separate_elapsed * 1000:.0f} ms, overview: {overview_elapsed * 1000:.0f} ms")
+        
+        # Test streamed CSV export
+        success, response = self.run_test(
+            "Admin Export Users CSV",
+            "GET",
+            "admin/export/users?format=csv",
+            200
+        )
+        
+        if success and isinstance(response, str):
+            header = response.lstrip('\ufeff').splitlines()[0]
+            print(f"   ✓ CSV header: {header[:60]}...")
+        
+        # Unchanged lists answer a conditional GET with 304
+        first = requests.get(f"{self.api_url}/admin/transactions", headers=headers, timeout=10)
+        etag = first.headers.get('ETag')
+        conditional = requests.get(
+            f"{self.api_url}/admin/transactions",
+            headers={**headers, 'If-None-Match': etag or ''},
+            timeout=10
+        )
+        self.log_test("Admin Transactions ETag 304", bool(etag) and conditional.status_code == 304,
+                      f"ETag {etag}, got {conditional.status_code}")
+        
         # Test weekly profit distribution
         success, response = self.run_test(
             "Weekly Profit Distribution",
@@ -616,8 +742,25 @@ class ParlaCapitalAPITester:
         )
         
         if success and isinstance(response, dict):
-            print(f"   ✓ Distributed to: {response.get('distributed_to', 0)} users")
-            print(f"   ✓ Total amount: ${response.get('total_amount', 0)}")
+            print(f"   ✓ Job started: {response.get('job_id')} ({response.get('total', 0)} investments)")
+            
+            # Distribution runs in the background, poll its progress
+            progress = {}
+            for _ in range(30):
+                success, progress = self.run_test(
+                    "Weekly Profit Distribution Progress",
+                    "GET",
+                    f"admin/jobs/{response.get('job_id')}",
+                    200
+                )
+                if not success or progress.get("status") != "running":
+                    break
+                time.sleep(1)
+            
+            if isinstance(progress, dict):
+                print(f"   ✓ Status: {progress.get('status')}")
+                print(f"   ✓ Distributed to: {progress.get('processed', 0)} investments")
+                print(f"   ✓ Total amount: ${progress.get('amount', 0)}")
         
         # Restore original token
         self.session_token = original_token
@@ -2713,11 +2856,12 @@ class ParlaCapitalAPITester:
             200
         )
         
-        if success and isinstance(response, list):
-            print(f"   ✓ Admin can see {len(response)} users")
+        if success and isinstance(response, dict):
+            users = response.get('users', [])
+            print(f"   ✓ Admin can see {len(users)} users on the first page")
             
-            # Find our test users and verify their commission totals
-            for user in response:
+            # Find our test users (newest first) and verify their commission totals
+            for user in users:
                 if user.get('id') == user1_id:
                     print(f"   ✓ User1 (Tolga) total_commissions: ${user.get('total_commissions', 0)}")
                     print(f"   ✓ User1 (Tolga) wallet_balance: ${user.get('wallet_balance', 0)}")
@@ -4743,6 +4887,45 @@ class ParlaCapitalAPITester:
         except Exception as e:
             print(f"   ❌ Failed to verify upline child_id: {str(e)}")
 
+    def test_email_templates_crlf(self):
+        """Every rendered email must use CRLF line endings, including folded Subject headers"""
+        print("\n📧 Testing Email Template Line Endings...")
+
+        render_script = """
+import json
+from server import EMAIL_TEMPLATES, sender_header
+bare_lf = {}
+for name, template in EMAIL_TEMPLATES.items():
+    fields = [p for p in template.text_parts + template.html_parts if isinstance(p, str)]
+    context = {field: 'Çok uzun bir değer ' * 20 for field in fields}
+    message = template.render(sender_header('noreply@parlacapital.com'), 'test@example.com', context)
+    bare_lf[name] = message.replace(b'\\r\\n', b'').count(b'\\n')
+print(json.dumps(bare_lf))
+"""
+        try:
+            import os
+            import subprocess
+            env = dict(os.environ)
+            env.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+            env.setdefault('DB_NAME', 'test_database')
+            result = subprocess.run(
+                [sys.executable, '-c', render_script],
+                cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'),
+                capture_output=True,
+                text=True,
+                timeout=60,
+                env=env
+            )
+            if result.returncode != 0:
+                self.log_test("Email templates render", False, result.stderr[-500:])
+                return
+
+            bare_lf = json.loads(result.stdout.strip().splitlines()[-1])
+            for name, count in bare_lf.items():
+                self.log_test(f"Email template '{name}' has no bare LF", count == 0, f"{count} bare LF found")
+        except Exception as e:
+            self.log_test("Email templates render", False, str(e))
+
     def run_all_tests(self):
         """Run comprehensive API tests"""
         print("🚀 Starting ParlaCapital API Tests")
@@ -4752,6 +4935,9 @@ class ParlaCapitalAPITester:
         # Test public endpoints first
         self.test_public_endpoints()
         
+        # Email templates must render with CRLF line endings
+        self.test_email_templates_crlf()
+        
         # PRIORITY: Test Join Network with Referral Code Feature
         self.test_join_network_with_referral_code()
         
@@ -4761,6 +4947,9 @@ class ParlaCapitalAPITester:
         # CRITICAL FOCUS: Test Multi-Level Commission System
         self.test_multi_level_commission_system()
         
+        # Withdrawal engine under concurrency
+        self.test_concurrent_withdrawal_approvals()
+        
         # Cleanup
         self.cleanup_test_data()
         
@@ -14,6 +14,12 @@ export default function AdminPanel() {
   const { user, logout } = useAuth();
   const navigate = useNavigate();
   const [users, setUsers] = useState([]);
+  const [usersCursor, setUsersCursor] = useState(null);
+  const [loadingMoreUsers, setLoadingMoreUsers] = useState(false);
+  const [userSearch, setUserSearch] = useState('');
+  const [userPackageFilter, setUserPackageFilter] = useState('');
+  const [userPlacementFilter, setUserPlacementFilter] = useState('');
+  const [usersQuery, setUsersQuery] = useState(null);
   const [transactions, setTransactions] = useState([]);
   const [stats, setStats] = useState({});
   const [investmentRequests, setInvestmentRequests] = useState([]);
@@ -33,6 +39,10 @@ export default function AdminPanel() {
   const [profitDescription, setProfitDescription] = useState('Haftalık kar payı');
   const [distributingProfit, setDistributingProfit] = useState(false);
   
+  // Weekly distribution progress (streamed from the job events endpoint)
+  const [distributionProgress, setDistributionProgress] = useState(null);
+  const [exporting, setExporting] = useState(null);
+  
   // Full Binary Tree state (Super Admin only)
   const [fullBinaryTree, setFullBinaryTree] = useState(null);
   const [loadingFullTree, setLoadingFullTree] = useState(false);
@@ -46,25 +56,21 @@ export default function AdminPanel() {
   }, []);
 
   const fetchAdminData = async () => {
+    const startedAt = performance.now();
     try {
-      const [usersRes, txRes, statsRes, investReqRes, withdrawalReqRes, placementRes, pendingRes, approvedRes] = await Promise.all([
-        axios.get(`${API}/admin/users`, { withCredentials: true }),
-        axios.get(`${API}/admin/transactions`, { withCredentials: true }),
-        axios.get(`${API}/admin/stats`, { withCredentials: true }),
-        axios.get(`${API}/admin/investment-requests`, { withCredentials: true }),
-        axios.get(`${API}/admin/withdrawal-requests`, { withCredentials: true }),
-        axios.get(`${API}/admin/placement-history`, { withCredentials: true }),
-        axios.get(`${API}/admin/pending-count`, { withCredentials: true }),
-        axios.get(`${API}/admin/approved-investments`, { withCredentials: true })
-      ]);
-      setUsers(usersRes.data);
-      setTransactions(txRes.data);
-      setStats(statsRes.data);
-      setInvestmentRequests(investReqRes.data.requests || []);
-      setWithdrawalRequests(withdrawalReqRes.data.requests || []);
-      setPlacementHistory(placementRes.data || []);
-      setPendingCount(pendingRes.data.pending_count || 0);
-      setApprovedInvestments(approvedRes.data.approved_investments || []);
+      // One request for everything the panel shows on load
+      const { data } = await axios.get(`${API}/admin/overview`, { withCredentials: true });
+      setUsers(data.users || []);
+      setUsersCursor(data.users_next_cursor);
+      setUsersQuery(null);
+      setTransactions(data.transactions || []);
+      setStats(data.stats);
+      setInvestmentRequests(data.investment_requests || []);
+      setWithdrawalRequests(data.withdrawal_requests || []);
+      setPlacementHistory(data.placement_history || []);
+      setPendingCount(data.pending_count || 0);
+      setApprovedInvestments(data.approved_investments || []);
+      console.debug(`Admin overview loaded in ${Math.round(performance.now() - startedAt)} ms`);
     } catch (error) {
       console.error('Admin data error:', error);
       toast.error('Veri yüklenirken hata oluştu');
@@ -73,6 +79,43 @@ export default function AdminPanel() {
     }
   };
 
+  const searchUsers = async () => {
+    const params = {};
+    if (userSearch.trim()) params.q = userSearch.trim();
+    if (userPackageFilter) params.package = userPackageFilter;
+    if (userPlacementFilter) params.placed = userPlacementFilter === 'placed';
+    
+    const hasQuery = Object.keys(params).length > 0;
+    try {
+      const response = await axios.get(`${API}/admin/users${hasQuery ? '/search' : ''}`, {
+        params,
+        withCredentials: true
+      });
+      setUsers(response.data.users || []);
+      setUsersCursor(response.data.next_cursor);
+      setUsersQuery(hasQuery ? params : null);
+    } catch (error) {
+      toast.error(error.response?.data?.detail || 'Arama başarısız');
+    }
+  };
+
+  const loadMoreUsers = async () => {
+    if (!usersCursor) return;
+    setLoadingMoreUsers(true);
+    try {
+      const response = await axios.get(`${API}/admin/users${usersQuery ? '/search' : ''}`, {
+        params: { ...(usersQuery || {}), cursor: usersCursor },
+        withCredentials: true
+      });
+      setUsers(prev => [...prev, ...(response.data.users || [])]);
+      setUsersCursor(response.data.next_cursor);
+    } catch (error) {
+      toast.error('Kullanıcılar yüklenemedi');
+    } finally {
+      setLoadingMoreUsers(false);
+    }
+  };
+
   const handleApproveTransaction = async (txId) => {
     try {
       await axios.post(
@@ -101,6 +144,63 @@ export default function AdminPanel() {
     }
   };
 
+  // Reads the text/event-stream with fetch so the Authorization header can be sent
+  const streamJobProgress = async (jobId) => {
+    const token = localStorage.getItem('auth_token');
+    const response = await fetch(`${API}/admin/jobs/${jobId}/events`, {
+      headers: token ? { Authorization: `Bearer ${token}` } : {},
+      credentials: 'include'
+    });
+    if (!response.ok) throw new Error('Progress stream failed');
+    
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let latest = null;
+    
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      const events = buffer.split('\n\n');
+      buffer = events.pop();
+      for (const event of events) {
+        const dataLine = event.split('\n').find((line) => line.startsWith('data: '));
+        if (!dataLine) continue;
+        latest = JSON.parse(dataLine.slice(6));
+        setDistributionProgress(latest);
+      }
+    }
+    return latest;
+  };
+
+  // Downloaded through axios so the Authorization header is sent; a plain link would not carry it
+  const handleExport = async (collection, format) => {
+    setExporting(`${collection}-${format}`);
+    try {
+      const response = await axios.get(`${API}/admin/export/${collection}`, {
+        params: { format },
+        responseType: 'blob',
+        withCredentials: true
+      });
+      const disposition = response.headers['content-disposition'] || '';
+      const filename = disposition.match(/filename="([^"]+)"/)?.[1] || `${collection}.${format}`;
+      
+      const url = window.URL.createObjectURL(response.data);
+      const link = document.createElement('a');
+      link.href = url;
+      link.download = filename;
+      document.body.appendChild(link);
+      link.click();
+      link.remove();
+      window.URL.revokeObjectURL(url);
+    } catch (error) {
+      toast.error('Dışa aktarma başarısız');
+    } finally {
+      setExporting(null);
+    }
+  };
+
   const handleDistributeWeeklyProfit = async () => {
     if (!window.confirm('Tüm aktif yatırımcılara haftalık kar dağıtılımsın mı?')) return;
     
@@ -110,10 +210,18 @@ export default function AdminPanel() {
         {},
         { withCredentials: true }
       );
-      toast.success(`${response.data.distributed_to} kişiye toplam $${response.data.total_amount.toFixed(2)} dağıtıldı`);
+      toast.info('Kar dağıtımı başlatıldı');
+      setDistributionProgress({ status: 'running', processed: 0, total: response.data.total, amount: 0, errors: [] });
+      
+      const result = await streamJobProgress(response.data.job_id);
+      if (result?.status === 'completed') {
+        toast.success(`${result.processed} yatırıma toplam $${result.amount.toFixed(2)} dağıtıldı`);
+      } else {
+        toast.error(`Kar dağıtımı başarısız${result?.errors?.length ? `: ${result.errors[0]}` : ''}`);
+      }
       fetchAdminData();
     } catch (error) {
-      toast.error('Kar dağıtımı başarısız');
+      toast.error(error.response?.data?.detail || 'Kar dağıtımı başarısız');
     }
   };
 
@@ -222,6 +330,30 @@ export default function AdminPanel() {
     }
   };
 
+  const handleBulkApproveWithdrawals = async () => {
+    const pendingIds = withdrawalRequests.filter(req => req.status === 'pending').map(req => req.id);
+    if (!window.confirm(`${pendingIds.length} çekim talebini onaylamak istediğinizden emin misiniz?`)) return;
+    
+    try {
+      const response = await axios.post(
+        `${API}/admin/withdrawal-requests/bulk-approve`,
+        { request_ids: pendingIds },
+        { withCredentials: true }
+      );
+      const { approved, failed, skipped } = response.data;
+      toast.success(`${approved} çekim talebi onaylandı`);
+      if (failed.length > 0) {
+        toast.error(`${failed.length} talep için bloke bakiye yetersiz, onaylanmadı`);
+      }
+      if (skipped.length > 0) {
+        toast.info(`${skipped.length} talep tek tek onaylanmalı`);
+      }
+      fetchAdminData();
+    } catch (error) {
+      toast.error(error.response?.data?.detail || 'Toplu onaylama başarısız');
+    }
+  };
+
   const handleDeleteUser = async (userId, userName) => {
     if (!window.confirm(`${userName} kullanıcısını silmek istediğinizden emin misiniz? Bu işlem geri alınamaz!`)) return;
     
@@ -506,6 +638,53 @@ export default function AdminPanel() {
             >
               Haftalık Kar Dağıt (%5)
             </Button>
+            
+            {distributionProgress && (
+              <div className="mt-4 space-y-2" data-testid="distribution-progress">
+                <div className="flex justify-between text-sm text-gray-300">
+                  <span>
+                    {distributionProgress.processed} / {distributionProgress.total ?? '?'} yatırım
+                    {distributionProgress.status === 'completed' && ' - tamamlandı'}
+                    {distributionProgress.status === 'failed' && ' - başarısız'}
+                  </span>
+                  <span>
+                    ${(distributionProgress.amount || 0).toFixed(2)}
+                    {distributionProgress.throughput_per_sec !== undefined && ` · ${distributionProgress.throughput_per_sec}/sn`}
+                  </span>
+                </div>
+                <div className="w-full h-3 bg-slate-700 rounded-full overflow-hidden">
+                  <div
+                    className="h-full bg-gradient-to-r from-green-500 to-green-600 transition-all"
+                    style={{
+                      width: `${distributionProgress.total ? Math.min(100, (distributionProgress.processed / distributionProgress.total) * 100) : 0}%`
+                    }}
+                  />
+                </div>
+                {distributionProgress.errors?.length > 0 && (
+                  <p className="text-sm text-red-400">{distributionProgress.errors[0]}</p>
+                )}
+              </div>
+            )}
+
+            <div className="mt-4 flex flex-wrap gap-2" data-testid="export-links">
+              {[
+                ['users', 'Kullanıcılar'],
+                ['transactions', 'İşlemler'],
+                ['investments', 'Yatırımlar']
+              ].map(([collection, label]) => (
+                ['csv', 'parquet'].map((format) => (
+                  <button
+                    key={`${collection}-${format}`}
+                    type="button"
+                    onClick={() => handleExport(collection, format)}
+                    disabled={exporting !== null}
+                    className="px-3 py-1 text-sm rounded border border-amber-500/50 text-amber-400 hover:bg-amber-500/10 disabled:opacity-50"
+                  >
+                    {exporting === `${collection}-${format}` ? 'İndiriliyor...' : `${label} (${format.toUpperCase()})`}
+                  </button>
+                ))
+              ))}
+            </div>
           </CardContent>
         </Card>
 
@@ -659,8 +838,16 @@ export default function AdminPanel() {
           {/* Withdrawal Requests Tab */}
           <TabsContent value="withdrawals">
             <Card className="glass-card">
-              <CardHeader>
+              <CardHeader className="flex flex-row items-center justify-between">
                 <CardTitle className="text-white">Çekim Talepleri</CardTitle>
+                {withdrawalRequests.filter(req => req.status === 'pending').length > 1 && (
+                  <Button
+                    onClick={handleBulkApproveWithdrawals}
+                    className="bg-green-600 hover:bg-green-700 text-white font-bold"
+                  >
+                    Tümünü Onayla
+                  </Button>
+                )}
               </CardHeader>
               <CardContent>
                 <div className="space-y-4">
@@ -986,6 +1173,41 @@ export default function AdminPanel() {
                 <CardTitle className="text-white">Tüm Kullanıcılar</CardTitle>
               </CardHeader>
               <CardContent>
+                <form
+                  onSubmit={(e) => { e.preventDefault(); searchUsers(); }}
+                  className="flex flex-col md:flex-row gap-2 mb-4"
+                >
+                  <input
+                    type="text"
+                    value={userSearch}
+                    onChange={(e) => setUserSearch(e.target.value)}
+                    placeholder="İsim veya e-posta ile ara..."
+                    className="flex-1 bg-slate-700 border border-slate-600 text-white rounded-lg px-3 py-2 focus:outline-none focus:border-amber-500"
+                  />
+                  <select
+                    value={userPackageFilter}
+                    onChange={(e) => setUserPackageFilter(e.target.value)}
+                    className="bg-slate-700 border border-slate-600 text-white rounded-lg px-3 py-2 focus:outline-none focus:border-amber-500"
+                  >
+                    <option value="">Tüm Paketler</option>
+                    <option value="silver">Silver</option>
+                    <option value="gold">Gold</option>
+                    <option value="platinum">Platinum</option>
+                    <option value="none">Paket Yok</option>
+                  </select>
+                  <select
+                    value={userPlacementFilter}
+                    onChange={(e) => setUserPlacementFilter(e.target.value)}
+                    className="bg-slate-700 border border-slate-600 text-white rounded-lg px-3 py-2 focus:outline-none focus:border-amber-500"
+                  >
+                    <option value="">Tüm Kullanıcılar</option>
+                    <option value="placed">Yerleşmiş</option>
+                    <option value="unplaced">Yerleşmemiş</option>
+                  </select>
+                  <Button type="submit" className="bg-amber-500 hover:bg-amber-600 text-slate-900 font-bold">
+                    Ara
+                  </Button>
+                </form>
                 <div className="space-y-3">
                   {users.map((u, idx) => (
                     <div key={idx} data-testid={`user-${idx}`} className="bg-slate-700/50 rounded-lg p-4">
@@ -1086,6 +1308,16 @@ export default function AdminPanel() {
                     </div>
                   ))}
                 </div>
+                {usersCursor && (
+                  <Button
+                    onClick={loadMoreUsers}
+                    disabled={loadingMoreUsers}
+                    variant="outline"
+                    className="w-full mt-4 border-slate-600 text-gray-300 hover:bg-slate-700"
+                  >
+                    {loadingMoreUsers ? 'Yükleniyor...' : 'Daha Fazla Yükle'}
+                  </Button>
+                )}
               </CardContent>
             </Card>
           </TabsContent>
@@ -630,6 +630,9 @@ export default function Dashboard() {
               <CardContent>
                 <div className="text-3xl font-bold text-white">${(user?.wallet_balance || 0).toLocaleString('tr-TR')}</div>
                 <p className="text-xs text-green-400 mt-2">Çekilebilir bakiye</p>
+                {(user?.held_balance || 0) > 0 && (
+                  <p className="text-xs text-yellow-400 mt-1">Bekleyen çekim: ${user.held_balance.toLocaleString('tr-TR')}</p>
+                )}
                 <p className="text-[10px] text-gray-500 mt-1">💰 Komisyon + Binary bonuslar dahil</p>
               </CardContent>
             </Card>